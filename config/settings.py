@@ -51,10 +51,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "habits.metrics.RequestMetricsMiddleware",
+    "habits.profiling.ProfilingMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "habits.routers.ReplicaPinningMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
     "corsheaders.middleware.CorsMiddleware",
@@ -68,6 +71,9 @@ SPECTACULAR_SETTINGS = {
     "SERVE_INCLUDE_SCHEMA": False,
 }
 
+# Каталог с собранной командой build_schema OpenAPI-схемой
+OPENAPI_SCHEMA_DIR = os.getenv("OPENAPI_SCHEMA_DIR", BASE_DIR / "openapi")
+
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
@@ -104,6 +110,47 @@ DATABASES = {
     }
 }
 
+# Реплики для чтения: DB_REPLICA_HOSTS=host1,host2 добавляет базы replica_1,
+# replica_2 с теми же учетными данными, что и основная
+DATABASE_REPLICAS = []
+for number, host in enumerate(
+    filter(None, os.getenv("DB_REPLICA_HOSTS", "").split(",")), start=1
+):
+    alias = f"replica_{number}"
+    DATABASES[alias] = {
+        **DATABASES["default"],
+        "HOST": host.strip(),
+        "TEST": {"MIRROR": "default"},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+# Шарды привычек и профилей: DB_SHARD_HOSTS=host1,host2 добавляет базы
+# shard_1, shard_2. Первым шардом всегда остается основная база
+HABIT_SHARDS = ["default"]
+for number, host in enumerate(
+    filter(None, os.getenv("DB_SHARD_HOSTS", "").split(",")), start=1
+):
+    alias = f"shard_{number}"
+    DATABASES[alias] = {**DATABASES["default"], "HOST": host.strip()}
+    HABIT_SHARDS.append(alias)
+
+# Сколько секунд ждать завершения запросов перед переносом пользователя
+SHARD_MOVE_GRACE = 2
+# Срок кэширования назначений шардов. Если кэш не общий для процессов,
+# перенос пользователя ждет еще и этот срок
+SHARD_PLACEMENT_CACHE_TTL = 60
+
+DATABASE_ROUTERS = [
+    "habits.sharding.ShardRouter",
+    "habits.routers.PrimaryReplicaRouter",
+]
+
+# Сколько секунд после записи чтение пользователя идет в основную базу
+REPLICA_PIN_SECONDS = int(os.getenv("REPLICA_PIN_SECONDS", 5))
+# Реплики, отстающие больше чем на столько секунд, не используются
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = 10
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -166,12 +213,50 @@ CELERY_BEAT_SCHEDULE = {
         "task": "habits.tasks.send_habit_reminders",
         "schedule": timedelta(minutes=1),
     },
+    "refresh-popular-habits": {
+        "task": "habits.tasks.refresh_popular_habits",
+        "schedule": timedelta(minutes=10),
+    },
+    "refresh-recommendations": {
+        "task": "habits.tasks.refresh_recommendations",
+        "schedule": timedelta(minutes=10),
+    },
 }
 
+# Cache settings
+# Кэш общий для веб-процессов и воркеров, поэтому в продакшене нужен Redis
+CACHE_URL = os.getenv("CACHE_URL", os.getenv("REDIS_URL"))
+if CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CACHE_URL,
+        }
+    }
+# Без общего кэша каждый процесс хранит свои копии назначений шардов
+SHARD_PLACEMENT_SHARED_CACHE = bool(CACHE_URL)
+
+# Рейтинг популярных публичных привычек
+POPULAR_HABITS_LIMIT = 50
+POPULAR_HABITS_GROWTH_WINDOW = timedelta(days=7)
+POPULAR_HABITS_GROWTH_WEIGHT = 2.0
+
 CORS_ALLOW_ALL_ORIGINS = (
     True  # Для разработки, в продакшене нужно указать конкретные домены
 )
 CORS_ALLOW_CREDENTIALS = True
+# Заголовки corsheaders по умолчанию и Idempotency-Key. Список задан явно,
+# чтобы настройки воркера не импортировали corsheaders
+CORS_ALLOW_HEADERS = (
+    "accept",
+    "authorization",
+    "content-type",
+    "user-agent",
+    "x-csrftoken",
+    "x-requested-with",
+    "idempotency-key",
+)
+CORS_EXPOSE_HEADERS = ("idempotent-replayed",)
 
 
 # В конец файла добавим:
@@ -180,5 +265,97 @@ SIMPLE_JWT = {
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
 }
 
+# Размер порции строк, читаемых из курсора при потоковой выгрузке
+EXPORT_CHUNK_SIZE = 2000
+
+# Metrics settings
+# Эндпоинт /metrics требует заголовок Authorization: Bearer <token>. Без
+# токена он закрыт, если METRICS_PUBLIC не включен явно
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_PUBLIC = os.getenv("METRICS_PUBLIC") == "1"
+# Хранилище метрик задач Celery, общее для воркеров и веб-процессов
+METRICS_REDIS_URL = os.getenv("METRICS_REDIS_URL", os.getenv("REDIS_URL"))
+# Период фоновой записи метрик в Redis и таймаут его сокетов, секунд
+METRICS_FLUSH_INTERVAL = 1
+METRICS_REDIS_TIMEOUT = 0.5
+
+# Profiling settings
+PROFILING_DIR = os.getenv("PROFILING_DIR", BASE_DIR / "profiles")
+PROFILING_TOKEN_MAX_AGE = int(os.getenv("PROFILING_TOKEN_MAX_AGE", 3600))
+
+# Recommendations settings
+# Каталог индекса должен быть общим для веб-процессов и воркеров Celery
+RECOMMENDATIONS_DIR = os.getenv("RECOMMENDATIONS_DIR", BASE_DIR / "recommendations")
+RECOMMENDATIONS_LIMIT = 10
+
+# Расписание привычек
+SCHEDULE_MAX_DAYS = 366
+# Диапазоны длиннее этого отдаются потоком и не кэшируются
+SCHEDULE_STREAM_DAYS = 31
+SCHEDULE_CACHE_TIMEOUT = 3600
+
+# Поток изменений привычек и профилей
+# Без EVENTS_REDIS_URL события хранятся в памяти процесса
+EVENTS_REDIS_URL = os.getenv("EVENTS_REDIS_URL", os.getenv("REDIS_URL"))
+EVENTS_STREAM = "habits:changes"
+EVENTS_STREAM_MAXLEN = 1_000_000
+
+# Server-Sent Events
+# Без SSE_REDIS_URL события раздаются только соединениям своего процесса
+SSE_REDIS_URL = os.getenv("SSE_REDIS_URL", os.getenv("REDIS_URL"))
+# Пакеты событий записываются в Redis фоновым потоком, запросы его не ждут
+EVENTS_PUBLISH_IN_BACKGROUND = bool(EVENTS_REDIS_URL or SSE_REDIS_URL)
+# Интервал комментариев-пингов, которые не дают прокси закрыть соединение
+SSE_HEARTBEAT = 15
+SSE_RETRY_MS = 3000
+SSE_QUEUE_SIZE = 100
+# Срок действия одноразового билета для подключения к потоку, секунд
+SSE_TICKET_TTL = 60
+# История для возобновления по Last-Event-ID: событий на пользователя и срок
+SSE_HISTORY_SIZE = 100
+SSE_HISTORY_TTL = 86400
+
+# Админка
+# Фильтрованные списки считаются не дальше этого числа строк, полные
+# таблицы больше него - по статистике СУБД
+ADMIN_COUNT_LIMIT = 10000
+# Привычек в одной фоновой задаче массового действия
+ADMIN_ACTION_BATCH_SIZE = 1000
+
+# Повтор запросов по Idempotency-Key
+# Срок хранения ответа и срок, на который ключ занимает выполняющийся запрос
+IDEMPOTENCY_KEY_TTL = 86400
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
 # Telegram settings
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
+# Имя бота для ссылок привязки чата t.me/<имя>?start=<токен>
+TELEGRAM_BOT_USERNAME = os.getenv("TELEGRAM_BOT_USERNAME")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+# Long polling getUpdates: время ожидания и размер пачки обновлений
+TELEGRAM_POLL_TIMEOUT = 30
+TELEGRAM_UPDATES_LIMIT = 100
+# Срок действия одноразового токена привязки чата
+TELEGRAM_LINK_TTL = 600
+
+# Каналы уведомлений: имя канала - класс бэкенда
+NOTIFICATION_BACKENDS = {
+    "telegram": "habits.notifications.TelegramBackend",
+    "email": "habits.notifications.EmailBackend",
+    "webhook": "habits.notifications.WebhookBackend",
+}
+# Сообщений одного канала в задаче отправки
+NOTIFICATION_BATCH_SIZE = 500
+# Одновременных запросов к Telegram и вебхукам при отправке пачки
+NOTIFICATION_CONCURRENCY = 20
+NOTIFICATION_TIMEOUT = 10
+# Разрешает вебхуки по http и на внутренние адреса. Только для разработки
+WEBHOOK_ALLOW_LOCAL = False
+
+# Email settings
+EMAIL_HOST = os.getenv("EMAIL_HOST", "localhost")
+EMAIL_PORT = int(os.getenv("EMAIL_PORT", 25))
+EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER", "")
+EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD", "")
+EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS") == "1"
+DEFAULT_FROM_EMAIL = os.getenv("DEFAULT_FROM_EMAIL", "habits@localhost")
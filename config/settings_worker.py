@@ -0,0 +1,19 @@
+"""
+Облегченные настройки для воркеров и планировщика Celery.
+
+Задачам нужны только модели habits и auth, поэтому админка, DRF,
+drf_spectacular и corsheaders не загружаются. Используется через
+DJANGO_SETTINGS_MODULE=config.settings_worker.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "habits",
+]
+
+MIDDLEWARE = []
+
+TEMPLATES = []
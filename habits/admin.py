@@ -1 +1,193 @@
-# Register your models here.
+"""
+Админка привычек и профилей, рассчитанная на большие таблицы.
+
+Списки не считают COUNT(*) по всей таблице: полная таблица оценивается по
+статистике СУБД, отфильтрованная - считается не дальше ADMIN_COUNT_LIMIT
+строк. Связанные объекты загружаются одним запросом, для выбора
+пользователя и связанной привычки используются поля автодополнения и ввода
+id вместо списков со всеми записями. Поиск и фильтры работают только по
+индексированным полям.
+
+Массовые действия не обрабатывают записи в запросе админки, а ставят их в
+очередь Celery пачками по ADMIN_ACTION_BATCH_SIZE id.
+
+При нескольких шардах список показывает шард, выбранный фильтром «Шард»
+(по умолчанию основную базу), а страница объекта находит его на любом
+шарде. Пользователи хранятся только в основной базе, поэтому они
+загружаются отдельным запросом, а не соединением таблиц.
+"""
+
+from itertools import islice
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.paginator import Paginator
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.utils.functional import cached_property
+
+from . import tasks
+from .models import Habit, UserProfile
+from .sharding import is_sharded, use_shard
+
+
+def estimated_count(queryset):
+    """
+    Возвращает оценку числа строк таблицы queryset по статистике СУБД или
+    None, если оценки нет.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != "postgresql":
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass",
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    # Для таблицы без собранной статистики PostgreSQL возвращает -1
+    return row[0] if row and row[0] >= 0 else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Пагинатор без точного подсчета строк больших таблиц.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        limit = settings.ADMIN_COUNT_LIMIT
+        if not queryset.query.has_filters():
+            estimate = estimated_count(queryset)
+            if estimate is not None and estimate > limit:
+                return estimate
+        return queryset.order_by()[:limit].count()
+
+
+def enqueue_in_batches(queryset, task, *args):
+    """
+    Ставит task в очередь для id объектов queryset пачками и возвращает
+    количество объектов.
+    """
+    batch_size = settings.ADMIN_ACTION_BATCH_SIZE
+    ids = (
+        queryset.order_by().values_list("pk", flat=True).iterator(chunk_size=batch_size)
+    )
+    total = 0
+    while batch := list(islice(ids, batch_size)):
+        task.delay(batch, *args)
+        total += len(batch)
+    return total
+
+
+class ShardListFilter(admin.SimpleListFilter):
+    title = "Шард"
+    parameter_name = "shard"
+
+    def lookups(self, request, model_admin):
+        if not is_sharded():
+            return []
+        return [(alias, alias) for alias in settings.HABIT_SHARDS]
+
+    def queryset(self, request, queryset):
+        if self.value() in settings.HABIT_SHARDS:
+            return queryset.using(self.value())
+        return queryset
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+    show_facets = admin.ShowFacets.NEVER
+    list_per_page = 50
+
+
+class ShardedAdmin(LargeTableAdmin):
+    """
+    Админка шардированной модели. Кроме search_fields, ищет по точному
+    имени пользователя.
+    """
+
+    def get_queryset(self, request):
+        # Пользователи не соединяются с таблицей шарда, а загружаются из
+        # основной базы отдельным запросом
+        return super().get_queryset(request).prefetch_related("user")
+
+    def get_search_results(self, request, queryset, search_term):
+        found, may_have_duplicates = super().get_search_results(
+            request, queryset, search_term
+        )
+        search_term = search_term.strip()
+        if search_term:
+            user_ids = list(
+                User.objects.using(DEFAULT_DB_ALIAS)
+                .filter(username=search_term)
+                .values_list("pk", flat=True)
+            )
+            if user_ids:
+                found |= queryset.filter(user_id__in=user_ids)
+        return found, may_have_duplicates
+
+    def get_object(self, request, object_id, from_field=None):
+        if not is_sharded():
+            return super().get_object(request, object_id, from_field)
+        for alias in settings.HABIT_SHARDS:
+            with use_shard(alias):
+                obj = super().get_object(request, object_id, from_field)
+            if obj is not None:
+                return obj
+        return None
+
+
+@admin.register(Habit)
+class HabitAdmin(ShardedAdmin):
+    list_display = (
+        "id",
+        "action",
+        "place",
+        "time",
+        "user",
+        "related_habit",
+        "frequency",
+        "is_public",
+        "updated_at",
+    )
+    list_select_related = ("related_habit",)
+    list_filter = (ShardListFilter, "is_public", "updated_at")
+    search_fields = ("=id",)
+    ordering = ("-id",)
+    autocomplete_fields = ("user",)
+    raw_id_fields = ("related_habit",)
+    readonly_fields = (
+        "current_streak",
+        "longest_streak",
+        "last_completed",
+        "created_at",
+    )
+    actions = ("make_public", "make_private", "resend_reminders")
+
+    def _enqueue(self, request, queryset, task, *args):
+        count = enqueue_in_batches(queryset, task, *args)
+        self.message_user(request, f"Поставлено в очередь привычек: {count}.")
+
+    @admin.action(description="Опубликовать выбранные привычки")
+    def make_public(self, request, queryset):
+        self._enqueue(request, queryset, tasks.set_habits_public, True)
+
+    @admin.action(description="Снять выбранные привычки с публикации")
+    def make_private(self, request, queryset):
+        self._enqueue(request, queryset, tasks.set_habits_public, False)
+
+    @admin.action(description="Повторно отправить напоминания")
+    def resend_reminders(self, request, queryset):
+        self._enqueue(request, queryset, tasks.resend_habit_reminders)
+
+
+@admin.register(UserProfile)
+class UserProfileAdmin(ShardedAdmin):
+    list_display = ("id", "user", "telegram_chat_id")
+    list_filter = (ShardListFilter,)
+    search_fields = ("=telegram_chat_id",)
+    ordering = ("-id",)
+    autocomplete_fields = ("user",)
@@ -7,3 +7,4 @@ class HabitsConfig(AppConfig):
 
     def ready(self):
         import habits.signals  # noqa: F401
+        import habits.telemetry  # noqa: F401
@@ -0,0 +1,455 @@
+"""
+Прием сообщений боту Telegram через long polling (getUpdates).
+
+Команда ``manage.py telegram_updates`` запрашивает обновления пачками до
+TELEGRAM_UPDATES_LIMIT и обрабатывает пачку целиком: пользователи по
+chat id ищутся одним запросом на шард, изменения профилей записываются
+одним bulk_update на шард. Поддерживаются команды:
+
+- /start <токен> - привязывает чат по одноразовому токену из
+  POST /api/telegram-link/;
+- /habits - список привычек;
+- /done <id> - отмечает выполнение привычки в день отправки сообщения;
+- /stop - отвязывает чат.
+
+Изменения пачки и позиция в потоке обновлений (offset в TaskCheckpoint)
+фиксируются вместе: транзакция основной базы с позицией фиксируется
+последней, после транзакций шардов. Поэтому обработанные обновления не
+обрабатываются повторно, а при сбое базы пачка обрабатывается заново
+целиком. Если пачку не удается обработать по другой причине, обновления
+обрабатываются по одному, и обновление с ошибкой записывается в журнал и
+пропускается, чтобы не блокировать остальные. Ответы отправляются после
+фиксации.
+"""
+
+import asyncio
+import logging
+import secrets
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, InterfaceError, OperationalError, transaction
+from django.utils import timezone
+
+from . import events
+from .models import Habit, TaskCheckpoint, UserProfile
+from .sharding import placement, scatter, sharded, use_shard
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_NAME = "telegram:updates"
+LINK_KEY = "habits:telegram-link:{}"
+# Наибольший id привычки (bigint)
+MAX_HABIT_ID = 2**63 - 1
+
+HELP_TEXT = (
+    "Чтобы получать напоминания, привяжите чат по ссылке из приложения.\n"
+    "/habits - список привычек\n"
+    "/done <id> - отметить выполнение привычки\n"
+    "/stop - отвязать чат"
+)
+NOT_LINKED_TEXT = "Чат не привязан. Получите ссылку для привязки в приложении."
+MOVING_TEXT = "Данные пользователя переносятся, повторите команду позже."
+
+
+def make_link_token(user_id):
+    """
+    Создает одноразовый токен привязки чата к пользователю, действующий
+    TELEGRAM_LINK_TTL секунд.
+    """
+    token = secrets.token_urlsafe(24)
+    cache.set(LINK_KEY.format(token), user_id, settings.TELEGRAM_LINK_TTL)
+    return token
+
+
+def consume_link_token(token):
+    """
+    Возвращает пользователя токена и делает токен недействительным.
+    """
+    key = LINK_KEY.format(token)
+    user_id = cache.get(key)
+    # Удаление атомарно, поэтому из одновременных попыток токен получит одна
+    if user_id is None or not cache.delete(key):
+        return None
+    return user_id
+
+
+def parse_command(text):
+    """
+    Возвращает (команду, аргумент) из текста сообщения. Имя бота в
+    команде (/done@bot) отбрасывается.
+    """
+    command, _, argument = text.strip().partition(" ")
+    return command.split("@", 1)[0].lower(), argument.strip()
+
+
+def parse_habit_id(argument):
+    """
+    Возвращает id привычки из аргумента /done или None.
+    """
+    # isdigit пропускает и не-ASCII цифры, например «²», которые int не примет
+    if not (argument.isascii() and argument.isdigit()) or len(argument) > 19:
+        return None
+    habit_id = int(argument)
+    return habit_id if 0 < habit_id <= MAX_HABIT_ID else None
+
+
+def _users_by_chat(chat_ids):
+    if not chat_ids:
+        return {}
+    users = {}
+    for found in scatter(
+        lambda alias: dict(
+            sharded(UserProfile, alias)
+            .filter(telegram_chat_id__in=chat_ids)
+            .values_list("telegram_chat_id", "user_id")
+        )
+    ):
+        users.update(found)
+    return users
+
+
+def _format_habits(habits):
+    if not habits:
+        return "У вас пока нет привычек."
+    return "\n".join(
+        f"{habit['id']}. {habit['action']} в {habit['time']:%H:%M}" for habit in habits
+    )
+
+
+class UpdateBatch:
+    """
+    Обработка одной пачки обновлений. Ответы копятся в replies как
+    [chat_id, текст].
+    """
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.replies = []
+        # id пользователя -> chat id для привязки
+        self.links = {}
+        self.unlinked = set()
+        # (номер ответа, id пользователя, id привычки, дата)
+        self.completions = []
+        # (номер ответа, id пользователя)
+        self.listings = []
+        self.tokens = {}
+
+    def process(self):
+        """
+        Обрабатывает обновления с номером не меньше сохраненной позиции и
+        сдвигает ее. Возвращает ответы.
+        """
+        TaskCheckpoint.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            name=CHECKPOINT_NAME
+        )
+        aliases = dict.fromkeys([DEFAULT_DB_ALIAS, *settings.HABIT_SHARDS])
+        try:
+            with ExitStack() as stack:
+                # Основная база с позицией фиксируется последней
+                for alias in aliases:
+                    stack.enter_context(transaction.atomic(using=alias))
+                checkpoint = (
+                    TaskCheckpoint.objects.using(DEFAULT_DB_ALIAS)
+                    .select_for_update()
+                    .get(name=CHECKPOINT_NAME)
+                )
+                offset = checkpoint.value.get("offset", 0)
+                messages = self._messages(offset)
+                self._dispatch(messages)
+                self._write_profiles()
+                self._complete_habits()
+                self._list_habits()
+                checkpoint.value = {
+                    "offset": max(
+                        [offset, *(update.update_id + 1 for update in self.updates)]
+                    )
+                }
+                checkpoint.save(using=DEFAULT_DB_ALIAS)
+        except Exception:
+            # Пачка будет обработана заново, токены должны остаться в силе
+            for token, user_id in self.tokens.items():
+                cache.set(LINK_KEY.format(token), user_id, settings.TELEGRAM_LINK_TTL)
+            raise
+        return self.replies
+
+    def _messages(self, offset):
+        messages = []
+        for update in self.updates:
+            message = update.message
+            if (
+                update.update_id < offset
+                or message is None
+                or not message.text
+                or message.chat.type != "private"
+            ):
+                continue
+            command, argument = parse_command(message.text)
+            messages.append(
+                (
+                    str(message.chat.id),
+                    command,
+                    argument,
+                    timezone.localdate(message.date),
+                )
+            )
+        return messages
+
+    def reply(self, chat_id, text=None):
+        self.replies.append([chat_id, text])
+        return len(self.replies) - 1
+
+    def _dispatch(self, messages):
+        users = _users_by_chat(
+            {chat_id for chat_id, command, _, _ in messages if command != "/start"}
+        )
+        for chat_id, command, argument, date in messages:
+            if command == "/start" and argument:
+                user_id = self._link(chat_id, argument)
+                if user_id is not None:
+                    users[chat_id] = user_id
+                continue
+            if command not in ("/habits", "/done", "/stop"):
+                self.reply(chat_id, HELP_TEXT)
+                continue
+            user_id = users.get(chat_id)
+            if user_id is None:
+                self.reply(chat_id, NOT_LINKED_TEXT)
+            elif command == "/stop":
+                self._forget_chat(chat_id)
+                self.unlinked.add(chat_id)
+                users.pop(chat_id)
+                self.reply(chat_id, "Чат отвязан, напоминания больше не придут.")
+            elif command == "/habits":
+                self.listings.append((self.reply(chat_id), user_id))
+            elif (habit_id := parse_habit_id(argument)) is None:
+                self.reply(chat_id, "Укажите номер привычки: /done <id>.")
+            elif placement(user_id)[1]:
+                self.reply(chat_id, MOVING_TEXT)
+            else:
+                self.completions.append((self.reply(chat_id), user_id, habit_id, date))
+
+    def _forget_chat(self, chat_id):
+        self.links = {
+            user_id: linked
+            for user_id, linked in self.links.items()
+            if linked != chat_id
+        }
+
+    def _link(self, chat_id, token):
+        user_id = consume_link_token(token)
+        if user_id is None:
+            self.reply(
+                chat_id,
+                "Ссылка недействительна или устарела. Получите новую в приложении.",
+            )
+            return None
+        if placement(user_id)[1]:
+            # Токен остается в силе для повтора после переноса
+            cache.set(LINK_KEY.format(token), user_id, settings.TELEGRAM_LINK_TTL)
+            self.reply(chat_id, MOVING_TEXT)
+            return None
+        self.tokens[token] = user_id
+        # Чат привязывается только к одному пользователю
+        self._forget_chat(chat_id)
+        self.links[user_id] = chat_id
+        self.unlinked.discard(chat_id)
+        self.reply(chat_id, "Чат привязан, сюда будут приходить напоминания.")
+        return user_id
+
+    def _write_profiles(self):
+        if not self.links and not self.unlinked:
+            return
+        chats = set(self.links.values()) | self.unlinked
+        by_shard = {}
+        for user_id in self.links:
+            by_shard.setdefault(placement(user_id)[0], set()).add(user_id)
+        for alias in settings.HABIT_SHARDS:
+            users = by_shard.get(alias, set())
+            profiles = list(
+                sharded(UserProfile, alias).filter(user_id__in=users)
+                | sharded(UserProfile, alias).filter(telegram_chat_id__in=chats)
+            )
+            changed = []
+            for profile in profiles:
+                # Профили, найденные по чату, отвязываются от него
+                chat_id = self.links.get(profile.user_id)
+                if profile.telegram_chat_id != chat_id:
+                    profile.telegram_chat_id = chat_id
+                    changed.append(profile)
+            sharded(UserProfile, alias).bulk_update(changed, ["telegram_chat_id"])
+            missing = users - {profile.user_id for profile in profiles}
+            created = sharded(UserProfile, alias).bulk_create(
+                [
+                    UserProfile(user_id=user_id, telegram_chat_id=self.links[user_id])
+                    for user_id in missing
+                ]
+            )
+            # bulk-операции не вызывают сигналы, события записываются здесь
+            for profile in changed:
+                events.record(profile, events.UPDATE, profile._state.db)
+            for profile in created:
+                events.record(profile, events.CREATE, profile._state.db)
+
+    def _complete_habits(self):
+        by_shard = {}
+        for _, user_id, habit_id, _ in self.completions:
+            by_shard.setdefault(placement(user_id)[0], set()).add(habit_id)
+        habits = {}
+        for alias, habit_ids in by_shard.items():
+            habits.update(
+                (habit.pk, habit)
+                for habit in sharded(Habit, alias).filter(pk__in=habit_ids)
+            )
+        for index, user_id, habit_id, date in self.completions:
+            chat_id = self.replies[index][0]
+            habit = habits.get(habit_id)
+            if habit is None or habit.user_id != user_id:
+                self.replies[index] = [chat_id, f"Привычка {habit_id} не найдена."]
+                continue
+            with use_shard(habit._state.db):
+                _, created = habit.complete(date)
+            text = (
+                f"Выполнение привычки «{habit.action}» отмечено."
+                if created
+                else f"Привычка «{habit.action}» уже отмечена за этот день."
+            )
+            self.replies[index] = [
+                chat_id,
+                f"{text} Текущая серия: {habit.current_streak}.",
+            ]
+
+    def _list_habits(self):
+        by_shard = {}
+        for _, user_id in self.listings:
+            by_shard.setdefault(placement(user_id)[0], set()).add(user_id)
+        habits = {}
+        for alias, user_ids in by_shard.items():
+            for habit in (
+                sharded(Habit, alias)
+                .filter(user_id__in=user_ids)
+                .order_by("time", "id")
+                .values("user_id", "id", "action", "time")
+            ):
+                habits.setdefault(habit["user_id"], []).append(habit)
+        for index, user_id in self.listings:
+            chat_id = self.replies[index][0]
+            self.replies[index] = [chat_id, _format_habits(habits.get(user_id, []))]
+
+
+def _skip(update):
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        checkpoint, _ = (
+            TaskCheckpoint.objects.using(DEFAULT_DB_ALIAS)
+            .select_for_update()
+            .get_or_create(name=CHECKPOINT_NAME)
+        )
+        offset = checkpoint.value.get("offset", 0)
+        checkpoint.value = {"offset": max(offset, update.update_id + 1)}
+        checkpoint.save(using=DEFAULT_DB_ALIAS)
+
+
+def process_updates(updates):
+    """
+    Обрабатывает пачку обновлений Telegram и возвращает ответы
+    [[chat_id, текст]].
+    """
+    try:
+        return UpdateBatch(updates).process()
+    except (OperationalError, InterfaceError):
+        # База недоступна: пачка будет обработана заново
+        raise
+    except Exception:
+        if len(updates) == 1:
+            logger.exception(
+                "Не удалось обработать обновление %d, оно пропущено",
+                updates[0].update_id,
+            )
+            _skip(updates[0])
+            return []
+    logger.warning("Пачка обновлений обрабатывается по одному обновлению")
+    return [reply for update in updates for reply in process_updates([update])]
+
+
+def current_offset():
+    checkpoint = (
+        TaskCheckpoint.objects.using(DEFAULT_DB_ALIAS)
+        .filter(name=CHECKPOINT_NAME)
+        .first()
+    )
+    return checkpoint.value.get("offset", 0) if checkpoint else 0
+
+
+class UpdatePoller:
+    """
+    Получение обновлений и отправка ответов через Bot API. Запросы к
+    Telegram выполняются в собственном цикле событий, обработка пачки -
+    синхронно между ними.
+    """
+
+    def __init__(self, timeout=None):
+        import telegram
+        from telegram.request import HTTPXRequest
+
+        self.timeout = settings.TELEGRAM_POLL_TIMEOUT if timeout is None else timeout
+        self.loop = asyncio.new_event_loop()
+        self.request = HTTPXRequest(
+            connection_pool_size=settings.NOTIFICATION_CONCURRENCY
+        )
+        self.updates_request = HTTPXRequest(read_timeout=self.timeout + 10)
+        self.bot = telegram.Bot(
+            token=settings.TELEGRAM_BOT_TOKEN,
+            base_url=settings.TELEGRAM_API_URL,
+            request=self.request,
+            get_updates_request=self.updates_request,
+        )
+
+    def poll(self):
+        """
+        Ждет и обрабатывает одну пачку обновлений. Возвращает ее размер.
+        """
+        offset = current_offset()
+        updates = self.loop.run_until_complete(
+            self.bot.get_updates(
+                offset=offset or None,
+                limit=settings.TELEGRAM_UPDATES_LIMIT,
+                timeout=self.timeout,
+                allowed_updates=["message"],
+            )
+        )
+        if not updates:
+            return 0
+        replies = process_updates(updates)
+        self.loop.run_until_complete(self._send(replies))
+        return len(updates)
+
+    async def _send(self, replies):
+        # Ответы одному чату отправляются по порядку, разным чатам -
+        # одновременно
+        chats = {}
+        for chat_id, text in replies:
+            chats.setdefault(chat_id, []).append(text)
+        semaphore = asyncio.Semaphore(settings.NOTIFICATION_CONCURRENCY)
+
+        async def send(chat_id, texts):
+            failed = 0
+            async with semaphore:
+                for text in texts:
+                    try:
+                        await self.bot.send_message(chat_id=chat_id, text=text)
+                    except Exception:
+                        failed += 1
+            return failed
+
+        failed = sum(await asyncio.gather(*(send(*item) for item in chats.items())))
+        if failed:
+            logger.warning("Не удалось отправить %d ответов бота", failed)
+
+    async def _shutdown(self):
+        await self.request.shutdown()
+        await self.updates_request.shutdown()
+
+    def close(self):
+        self.loop.run_until_complete(self._shutdown())
+        self.loop.close()
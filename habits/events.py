@@ -0,0 +1,391 @@
+"""
+Поток изменений привычек и профилей для внешних потребителей.
+
+События create/update/delete моделей Habit и UserProfile копятся до
+фиксации транзакции и записываются в Redis Stream (EVENTS_STREAM) одной
+командой MULTI на транзакцию, поэтому потребители видят изменения
+транзакции целиком и только после фиксации. Откаченные изменения в поток
+не попадают. С EVENTS_PUBLISH_IN_BACKGROUND (по умолчанию, если задан
+Redis) пакеты записываются фоновым потоком, и запрос не ждет Redis.
+
+Потребители читают поток через группы потребителей (read_group/ack) или
+повторно с любой позиции (replay). Без EVENTS_REDIS_URL используется
+хранилище в памяти процесса с той же семантикой, удобное для тестов.
+
+Массовые операции без сигналов (QuerySet.update, bulk_create, импорт и
+перенос между шардами) событий не создают.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+import weakref
+from collections import deque
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+
+def parse_id(raw):
+    milliseconds, _, sequence = raw.partition("-")
+    return int(milliseconds), int(sequence or 0)
+
+
+class LocalStream:
+    """
+    Поток в памяти процесса с семантикой Redis Streams.
+    """
+
+    def __init__(self, maxlen=None):
+        self._lock = threading.Lock()
+        self._entries = deque(maxlen=maxlen)
+        self._groups = {}
+        self._last = (0, 0)
+
+    def add(self, events):
+        with self._lock:
+            ids = []
+            for event in events:
+                now = int(time.time() * 1000)
+                milliseconds, sequence = self._last
+                self._last = (
+                    (now, 0) if now > milliseconds else (milliseconds, sequence + 1)
+                )
+                entry_id = "{}-{}".format(*self._last)
+                self._entries.append((entry_id, event))
+                ids.append(entry_id)
+            return ids
+
+    def _after(self, entry_id, count):
+        after = parse_id(entry_id)
+        entries = (entry for entry in self._entries if parse_id(entry[0]) > after)
+        return list(islice(entries, count))
+
+    def range(self, after, count):
+        with self._lock:
+            return self._after(after, count)
+
+    def create_group(self, group, start):
+        with self._lock:
+            if group not in self._groups:
+                if start == "$":
+                    start = "{}-{}".format(*self._last)
+                self._groups[group] = {"last": start, "pending": {}}
+
+    def read_group(self, group, consumer, count, pending, block=None):
+        with self._lock:
+            state = self._groups[group]
+            if pending:
+                return [
+                    entry
+                    for entry in self._entries
+                    if state["pending"].get(entry[0]) == consumer
+                ][:count]
+            entries = self._after(state["last"], count)
+            for entry_id, _ in entries:
+                state["pending"][entry_id] = consumer
+            if entries:
+                state["last"] = entries[-1][0]
+            return entries
+
+    def ack(self, group, ids):
+        with self._lock:
+            pending = self._groups[group]["pending"]
+            return sum(pending.pop(entry_id, None) is not None for entry_id in ids)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._groups.clear()
+
+
+class RedisStream:
+    """
+    Поток в Redis Streams. Длина потока ограничивается примерно
+    EVENTS_STREAM_MAXLEN записями.
+    """
+
+    def __init__(self, url, name):
+        self.url = url
+        self.name = name
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    def add(self, events):
+        pipe = self.client.pipeline(transaction=True)
+        for event in events:
+            pipe.xadd(
+                self.name,
+                {"event": event},
+                maxlen=settings.EVENTS_STREAM_MAXLEN,
+                approximate=True,
+            )
+        return pipe.execute()
+
+    def range(self, after, count):
+        return [
+            (entry_id, fields["event"])
+            for entry_id, fields in self.client.xrange(
+                self.name, f"({after}", "+", count
+            )
+        ]
+
+    def create_group(self, group, start):
+        import redis
+
+        try:
+            self.client.xgroup_create(self.name, group, id=start, mkstream=True)
+        except redis.ResponseError as error:
+            if "BUSYGROUP" not in str(error):
+                raise
+
+    def read_group(self, group, consumer, count, pending, block=None):
+        response = self.client.xreadgroup(
+            group,
+            consumer,
+            {self.name: "0" if pending else ">"},
+            count=count,
+            block=block,
+        )
+        return [
+            (entry_id, fields["event"])
+            for _, entries in response
+            for entry_id, fields in entries
+        ]
+
+    def ack(self, group, ids):
+        return self.client.xack(self.name, group, *ids) if ids else 0
+
+
+@lru_cache(maxsize=4)
+def _stream_for(url, name):
+    return RedisStream(url, name) if url else LocalStream()
+
+
+def get_stream():
+    return _stream_for(settings.EVENTS_REDIS_URL, settings.EVENTS_STREAM)
+
+
+def _decode(entries):
+    return [{"id": entry_id, **json.loads(event)} for entry_id, event in entries]
+
+
+def replay(after="0-0", count=100):
+    """
+    Возвращает до count событий, записанных после позиции after.
+    """
+    return _decode(get_stream().range(after, count))
+
+
+def create_group(group, start="0"):
+    """
+    Создает группу потребителей, если ее нет. start="$" - читать только
+    новые события, "0" - с начала потока.
+    """
+    get_stream().create_group(group, start)
+
+
+def read_group(group, consumer, count=100, pending=False, block=None):
+    """
+    Выдает потребителю группы новые события, ожидая их до block
+    миллисекунд. С pending=True возвращает события, выданные этому
+    потребителю ранее и еще не подтвержденные, например после его
+    перезапуска.
+    """
+    return _decode(get_stream().read_group(group, consumer, count, pending, block))
+
+
+def ack(group, ids):
+    """
+    Подтверждает обработку событий группой.
+    """
+    return get_stream().ack(group, list(ids))
+
+
+def serialize(instance):
+    return {
+        field.attname: field.value_from_object(instance)
+        for field in instance._meta.concrete_fields
+    }
+
+
+class _Publisher:
+    """
+    Фоновая запись пакетов событий, чтобы запросы и задачи не ждали Redis.
+    Пакеты записываются одним потоком в порядке поступления.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def submit(self, events):
+        with self._lock:
+            if self._pid != os.getpid():
+                # Поток и очередь родителя после fork в дочернем процессе
+                # не работают
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(
+                    target=self._run, name="habit-events", daemon=True
+                )
+                self._thread.start()
+            self._queue.put(events)
+
+    def _run(self):
+        while (events := self._queue.get()) is not None:
+            try:
+                _write(events)
+            finally:
+                self._queue.task_done()
+        self._queue.task_done()
+
+    def join(self):
+        """
+        Ждет записи поставленных пакетов.
+        """
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self, timeout=None):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+            self._queue.put(None)
+        self._thread.join(timeout)
+
+
+_publisher = _Publisher()
+# Пакеты, не записанные к завершению процесса, дописываются при выходе
+atexit.register(_publisher.close, 5)
+
+
+def publish(events):
+    """
+    Записывает пакет событий одной транзакции в поток и раздает изменения
+    привычек по SSE. С EVENTS_PUBLISH_IN_BACKGROUND запись идет в фоновом
+    потоке.
+    """
+    if settings.EVENTS_PUBLISH_IN_BACKGROUND:
+        _publisher.submit(events)
+    else:
+        _write(events)
+
+
+def _write(events):
+    transaction_id = uuid.uuid4().hex
+    encoded = [
+        json.dumps(
+            {**event, "tx": transaction_id}, cls=DjangoJSONEncoder, ensure_ascii=False
+        )
+        for event in events
+    ]
+    try:
+        get_stream().add(encoded)
+    except Exception:
+        logger.warning("Не удалось записать %d событий в поток изменений", len(events))
+    from .push import publish as push
+
+    # Изменения привычек отправляются и открытым SSE-соединениям владельцев
+    push(
+        {"user_id": event["user_id"], "event": "habit", "data": _push_data(event)}
+        for event in events
+        if event["model"] == "habits.habit"
+    )
+
+
+def _push_data(event):
+    return {"op": event["op"], "pk": event["pk"], "data": event["data"]}
+
+
+class _Collect:
+    __slots__ = ("batch", "index", "event", "__weakref__")
+
+    def __init__(self, batch, index, event):
+        self.batch = batch
+        self.index = index
+        self.event = event
+
+    def __call__(self):
+        self.batch.collect(self)
+
+
+class _Batch:
+    """
+    Пакет событий транзакций одной базы в текущем потоке.
+
+    Каждое событие регистрирует свой обработчик transaction.on_commit, и
+    обработчики событий из откаченных точек сохранения Django отбрасывает.
+    Пакет записывает последний выполненный обработчик транзакции. Ожидающие
+    обработчики хранятся по слабым ссылкам, поэтому отброшенные Django
+    обработчики из них сразу исчезают.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.pending = weakref.WeakValueDictionary()
+        self.registered = 0
+
+    def add(self, event, using):
+        self.registered += 1
+        callback = _Collect(self, self.registered, event)
+        self.pending[callback.index] = callback
+        # Вне транзакции обработчик выполняется сразу
+        transaction.on_commit(callback, using=using)
+
+    def collect(self, callback):
+        self.events.append(callback.event)
+        self.pending.pop(callback.index, None)
+        # Обработчики выполняются в порядке регистрации, поэтому пакет
+        # закрывает обработчик, после которого ждущих не осталось
+        if any(index > callback.index for index in list(self.pending.keys())):
+            return
+        events, self.events = self.events, []
+        publish(events)
+
+
+_batches = threading.local()
+
+
+def record(instance, operation, using):
+    """
+    Добавляет событие об изменении instance в пакет текущей транзакции.
+    Пакет записывается после фиксации, вне транзакции - сразу.
+    """
+    event = {
+        "model": instance._meta.label_lower,
+        "op": operation,
+        "pk": instance.pk,
+        "user_id": instance.user_id,
+        "data": serialize(instance) if operation != DELETE else None,
+        "ts": time.time(),
+    }
+    batches = _batches.__dict__.setdefault("by_alias", {})
+    batch = batches.get(using)
+    if batch is None:
+        batch = batches[using] = _Batch()
+    batch.add(event, using)
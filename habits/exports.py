@@ -0,0 +1,88 @@
+"""
+Потоковая выгрузка привычек в CSV и NDJSON.
+
+Строки читаются через QuerySet.iterator(chunk_size=...) (на PostgreSQL это
+серверный курсор) и сразу отдаются клиенту, поэтому расход памяти не зависит
+от количества привычек.
+"""
+
+import csv
+import io
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+EXPORT_FIELDS = (
+    "id",
+    "user_id",
+    "place",
+    "time",
+    "action",
+    "is_pleasant",
+    "related_habit_id",
+    "frequency",
+    "reward",
+    "duration",
+    "is_public",
+    "current_streak",
+    "longest_streak",
+    "last_completed",
+)
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+# Сколько строк склеивается в один фрагмент ответа
+ROWS_PER_CHUNK = 500
+
+
+def _rows(querysets):
+    for queryset in querysets:
+        yield from (
+            queryset.order_by("id")
+            .values_list(*EXPORT_FIELDS)
+            .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+        )
+
+
+def iter_csv(querysets):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    for count, row in enumerate(_rows(querysets), start=1):
+        writer.writerow(row)
+        if count % ROWS_PER_CHUNK == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_ndjson(querysets):
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    lines = []
+    for row in _rows(querysets):
+        lines.append(encoder.encode(dict(zip(EXPORT_FIELDS, row))))
+        if len(lines) == ROWS_PER_CHUNK:
+            yield "\n".join(lines) + "\n"
+            lines = []
+    if lines:
+        yield "\n".join(lines) + "\n"
+
+
+EXPORTERS = {"csv": iter_csv, "ndjson": iter_ndjson}
+
+
+def export_response(querysets, file_format, filename):
+    """
+    Возвращает StreamingHttpResponse с выгрузкой querysets (например, по
+    одному на шард) друг за другом в формате file_format ("csv" или "ndjson").
+    """
+    response = StreamingHttpResponse(
+        EXPORTERS[file_format](querysets), content_type=CONTENT_TYPES[file_format]
+    )
+    response["Content-Disposition"] = f'attachment; filename="{filename}.{file_format}"'
+    return response
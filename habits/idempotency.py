@@ -0,0 +1,107 @@
+"""
+Повтор запросов на изменение по заголовку Idempotency-Key.
+
+Клиент, повторяющий запрос после обрыва связи, передает тот же ключ, и
+вместо повторного выполнения получает сохраненный ответ первого запроса с
+заголовком Idempotent-Replayed. Ключи действуют для пользователя и
+эндпоинта в течение IDEMPOTENCY_KEY_TTL секунд.
+
+Первый запрос с ключом занимает его одной командой кэша (SET NX в Redis),
+которая заодно проверяет, нет ли сохраненного ответа, и после выполнения
+сохраняет ответ. Повтор ключа с другим телом запроса или пока первый
+запрос еще выполняется отклоняется с кодом 409. Сохраняются только
+успешные ответы: после ошибки ключ можно использовать снова.
+"""
+
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from rest_framework import status
+from rest_framework.request import Request
+from rest_framework.response import Response
+
+HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+KEY = "habits:idempotency:{}:{}:{}"
+MAX_KEY_LENGTH = 255
+PENDING = "pending"
+
+
+def fingerprint(request):
+    """
+    Возвращает хеш тела запроса, не зависящий от порядка полей.
+    """
+    data = request.data
+    if hasattr(data, "lists"):
+        data = dict(data.lists())
+    body = json.dumps(data, sort_keys=True, cls=DjangoJSONEncoder)
+    return hashlib.sha256(body.encode()).hexdigest()
+
+
+def _conflict(message):
+    return Response({"error": message}, status=status.HTTP_409_CONFLICT)
+
+
+def _replay(stored):
+    response = Response(stored["data"], status=stored["status"])
+    response[REPLAYED_HEADER] = "true"
+    return response
+
+
+def idempotent(handler):
+    """
+    Декоратор обработчика DRF, выполняющий запрос с Idempotency-Key не
+    больше одного раза. Запросы без заголовка выполняются как обычно.
+    """
+
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        request = next(arg for arg in args if isinstance(arg, Request))
+        key = request.headers.get(HEADER)
+        if key is None:
+            return handler(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return Response(
+                {"error": f"Некорректный заголовок {HEADER}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        cache_key = KEY.format(
+            request.user.pk, request.path, hashlib.sha256(key.encode()).hexdigest()
+        )
+        body = fingerprint(request)
+        claim = {"fingerprint": body, "status": PENDING}
+        if not cache.add(cache_key, claim, settings.IDEMPOTENCY_LOCK_TIMEOUT):
+            stored = cache.get(cache_key)
+            if stored is not None:
+                if stored["fingerprint"] != body:
+                    return _conflict(
+                        f"{HEADER} уже использован для запроса с другими данными"
+                    )
+                if stored["status"] == PENDING:
+                    return _conflict(f"Запрос с этим {HEADER} еще выполняется")
+                return _replay(stored)
+            # Ключ истек между командами: запрос выполняется как первый
+        try:
+            response = handler(*args, **kwargs)
+        except Exception:
+            cache.delete(cache_key)
+            raise
+        if not status.is_success(response.status_code) or not hasattr(response, "data"):
+            cache.delete(cache_key)
+            return response
+        cache.set(
+            cache_key,
+            {
+                "fingerprint": body,
+                "status": response.status_code,
+                "data": response.data,
+            },
+            settings.IDEMPOTENCY_KEY_TTL,
+        )
+        return response
+
+    return wrapper
@@ -0,0 +1,397 @@
+"""
+Массовый импорт пользователей, профилей и привычек из CSV или NDJSON.
+
+Файл читается потоково пакетами. Каждая строка описывает пользователя
+(username, email, password, telegram_chat_id) и, если указано действие,
+одну его привычку. Пользователь создается при первой встрече в файле,
+существующие пользователи не изменяются, к ним только добавляются привычки.
+
+Пакет проверяется целиком операциями над массивами NumPy по тем же
+правилам, что Habit.clean и HabitSerializer.validate. Пароли хешируются в
+пуле процессов, записи создаются через bulk_create (привычки в PostgreSQL -
+через COPY) без сигналов post_save, поэтому профили и назначения шардов
+создаются здесь же. После каждого пакета позиция в файле сохраняется в
+TaskCheckpoint, и повторный запуск продолжает импорт с нее.
+
+Пакет записывается в несколько баз, поэтому он не атомарен. Сначала в
+основной базе создаются пользователи и назначения шардов, а контрольная
+точка запоминает пакет и созданных пользователей. Затем каждый шард в своей
+транзакции получает профили, привычки и отметку о записи пакета. Если
+импорт прервался, повторный запуск повторяет незавершенный пакет: не
+создает его пользователей заново и пропускает шарды, на которых пакет уже
+записан.
+"""
+
+import csv
+import io
+import json
+import time
+import uuid
+from datetime import time as dt_time
+from itertools import islice
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.utils import timezone
+
+from .models import Habit, TaskCheckpoint, UserProfile
+from .schedule import bump_habit_set_version
+from .sharding import assign_shards, placement
+
+FIELDS = (
+    "username",
+    "email",
+    "password",
+    "telegram_chat_id",
+    "action",
+    "place",
+    "time",
+    "duration",
+    "frequency",
+    "reward",
+    "is_pleasant",
+    "is_public",
+)
+TRUE_VALUES = ("1", "true", "yes", "да")
+FALSE_VALUES = ("", "0", "false", "no", "нет")
+CHECKPOINT_PREFIX = "import:"
+# Отметка о последнем пакете, записанном на шард, хранится на самом шарде
+SHARD_MARKER_SUFFIX = ":shard"
+HASH_CHUNK_SIZE = 64
+# Текстовые поля привычки, пустые значения которых COPY не должен
+# превращать в NULL
+COPY_NOT_NULL = ("place", "action", "reward")
+
+
+def read_rows(stream, file_format):
+    """
+    Отдает строки файла словарями со строковыми значениями.
+    """
+    if file_format == "csv":
+        for row in csv.DictReader(stream):
+            yield {field: (row.get(field) or "").strip() for field in FIELDS}
+        return
+    for line in stream:
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        yield {
+            field: "" if row.get(field) is None else str(row[field]).strip()
+            for field in FIELDS
+        }
+
+
+def _parse_time(value):
+    try:
+        return dt_time.fromisoformat(value)
+    except ValueError:
+        return None
+
+
+def _integers(column, blank):
+    """
+    Возвращает (значения, корректность) для столбца целых чисел.
+    Пустые значения заменяются на blank.
+    """
+    column = np.where(column == "", str(blank), column)
+    valid = np.char.isdigit(column) & (np.char.str_len(column) <= 9)
+    return np.where(valid, column, "0").astype(np.int64), valid
+
+
+def validate(columns):
+    """
+    Проверяет пакет строк. Возвращает массив сообщений об ошибках
+    (None для корректных строк), признак строк с привычкой и разобранные
+    значения полей привычки.
+    """
+    size = len(columns["username"])
+    errors = np.full(size, None, dtype=object)
+
+    def reject(mask, message):
+        errors[mask & np.equal(errors, None)] = message
+
+    lengths = {name: np.char.str_len(column) for name, column in columns.items()}
+    has_habit = np.zeros(size, dtype=bool)
+    for name in ("action", "place", "time", "duration", "reward"):
+        has_habit |= lengths[name] > 0
+
+    reject(
+        (lengths["username"] == 0) | (lengths["username"] > 150),
+        "Некорректное имя пользователя.",
+    )
+    reject(lengths["email"] > 254, "Некорректный email.")
+    reject(lengths["telegram_chat_id"] > 100, "Некорректный Telegram chat ID.")
+
+    for name, limit in (("action", 255), ("place", 100)):
+        reject(
+            has_habit & ((lengths[name] == 0) | (lengths[name] > limit)),
+            f"Некорректное значение поля {name}.",
+        )
+    reject(has_habit & (lengths["reward"] > 255), "Некорректное значение поля reward.")
+
+    times = np.array([_parse_time(value) for value in columns["time"]], dtype=object)
+    reject(has_habit & np.equal(times, None), "Некорректное значение поля time.")
+
+    durations, valid = _integers(columns["duration"], "")
+    reject(
+        has_habit & (~valid | (durations > 120)), "Некорректное значение поля duration."
+    )
+
+    frequencies, valid = _integers(columns["frequency"], 1)
+    reject(
+        has_habit & (~valid | (frequencies < 1)),
+        "Некорректное значение поля frequency.",
+    )
+    reject(
+        has_habit & (frequencies > 7),
+        "Нельзя выполнять привычку реже, чем раз в 7 дней.",
+    )
+
+    flags = {}
+    for name in ("is_pleasant", "is_public"):
+        column = np.char.lower(columns[name])
+        flags[name] = np.isin(column, TRUE_VALUES)
+        reject(
+            has_habit & ~(flags[name] | np.isin(column, FALSE_VALUES)),
+            f"Некорректное значение поля {name}.",
+        )
+    reject(
+        has_habit & flags["is_pleasant"] & (lengths["reward"] > 0),
+        "Приятные привычки не могут иметь вознаграждения или связанных привычек.",
+    )
+    values = {
+        "time": times,
+        "duration": durations,
+        "frequency": frequencies,
+        **flags,
+    }
+    return errors, has_habit, values
+
+
+def _hash_passwords(passwords, pool):
+    # Пустой пароль дает пользователя без возможности входа по паролю
+    passwords = [password or None for password in passwords]
+    if pool is None:
+        return [make_password(password) for password in passwords]
+    return list(pool.map(make_password, passwords, chunksize=HASH_CHUNK_SIZE))
+
+
+def _copy_habits(connection, habits):
+    """
+    Записывает привычки в PostgreSQL одной командой COPY.
+    """
+    fields = [field for field in Habit._meta.concrete_fields if not field.primary_key]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for habit in habits:
+        writer.writerow(
+            field.get_db_prep_save(field.pre_save(habit, True), connection)
+            for field in fields
+        )
+    buffer.seek(0)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    not_null = ", ".join(connection.ops.quote_name(name) for name in COPY_NOT_NULL)
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {connection.ops.quote_name(Habit._meta.db_table)} ({columns}) "
+            f"FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL ({not_null}))",
+            buffer,
+        )
+
+
+class Importer:
+    """
+    Импорт одного файла. Результаты накапливаются в счетчиках.
+    """
+
+    def __init__(self, name, batch_size=5000, pool=None, errors=None):
+        self.name = name
+        self.batch_size = batch_size
+        self.pool = pool
+        self.errors = errors
+        self.users = self.habits = self.rejected = 0
+
+    def checkpoint(self):
+        checkpoint, _ = TaskCheckpoint.objects.using(DEFAULT_DB_ALIAS).get_or_create(
+            name=CHECKPOINT_PREFIX + self.name
+        )
+        return checkpoint
+
+    def run(self, rows, restart=False, progress=None):
+        """
+        Импортирует строки, пропуская уже обработанные в прошлых запусках.
+        Возвращает число строк, обработанных в этом запуске.
+        """
+        checkpoint = self.checkpoint()
+        if restart:
+            checkpoint.value = {}
+        # Отметки шардов сравниваются с идентификатором запуска, поэтому
+        # отметки прошлого импорта того же файла не совпадут
+        checkpoint.value.setdefault("run", uuid.uuid4().hex)
+        position = checkpoint.value.get("rows", 0)
+        # Счетчики накапливаются по всем запускам импорта файла
+        self.users = checkpoint.value.get("users", 0)
+        self.habits = checkpoint.value.get("habits", 0)
+        self.rejected = checkpoint.value.get("rejected", 0)
+        rows = islice(rows, position, None)
+        processed = 0
+        started = time.perf_counter()
+        while batch := list(islice(rows, self.batch_size)):
+            self._import_batch(batch, position, checkpoint)
+            position += len(batch)
+            processed += len(batch)
+            if progress is not None:
+                progress(position, processed / (time.perf_counter() - started))
+        return processed
+
+    def _import_batch(self, batch, position, checkpoint):
+        columns = {
+            field: np.array([row[field] for row in batch], dtype=str)
+            for field in FIELDS
+        }
+        errors, has_habit, values = validate(columns)
+        valid = np.equal(errors, None)
+
+        # Пользователи, созданные прерванной попыткой этого пакета
+        pending = checkpoint.value.get("batch") or {}
+        resumed = pending.get("users", {}) if pending.get("rows") == position else {}
+        existing = dict(
+            User.objects.using(DEFAULT_DB_ALIAS)
+            .filter(username__in=set(columns["username"][valid].tolist()))
+            .exclude(username__in=resumed.keys())
+            .values_list("username", "pk")
+        )
+        new_users = {}
+        for index in np.flatnonzero(valid).tolist():
+            username = str(columns["username"][index])
+            if username not in existing and username not in new_users:
+                new_users[username] = index
+
+        # Записи для существующих пользователей во время переноса отклоняются
+        moving = {
+            username for username, user_id in existing.items() if placement(user_id)[1]
+        }
+        for index in np.flatnonzero(valid).tolist():
+            if columns["username"][index] in moving:
+                errors[index] = "Данные пользователя переносятся."
+        valid = np.equal(errors, None)
+        self._report_errors(errors, position)
+
+        to_create = {
+            username: index
+            for username, index in new_users.items()
+            if username not in resumed
+        }
+        passwords = _hash_passwords(
+            [str(columns["password"][index]) for index in to_create.values()], self.pool
+        )
+        with transaction.atomic(using=DEFAULT_DB_ALIAS):
+            User.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+                [
+                    User(
+                        username=username,
+                        email=str(columns["email"][index]),
+                        password=password,
+                    )
+                    for (username, index), password in zip(to_create.items(), passwords)
+                ]
+            )
+            created = dict(
+                User.objects.using(DEFAULT_DB_ALIAS)
+                .filter(username__in=to_create.keys())
+                .values_list("username", "pk")
+            )
+            shards = assign_shards(created.values())
+            created.update(resumed)
+            checkpoint.value["batch"] = {"rows": position, "users": created}
+            checkpoint.save(using=DEFAULT_DB_ALIAS)
+        for user_id in [*existing.values(), *resumed.values()]:
+            shards.setdefault(user_id, placement(user_id)[0])
+        user_ids = {**existing, **created}
+
+        profiles = {}
+        for username, index in new_users.items():
+            user_id = created[username]
+            profiles.setdefault(shards[user_id], []).append(
+                UserProfile(
+                    user_id=user_id,
+                    telegram_chat_id=str(columns["telegram_chat_id"][index]) or None,
+                )
+            )
+        habits = {}
+        now = timezone.now()
+        for index in np.flatnonzero(valid & has_habit).tolist():
+            user_id = user_ids[str(columns["username"][index])]
+            habits.setdefault(shards[user_id], []).append(
+                Habit(
+                    user_id=user_id,
+                    action=str(columns["action"][index]),
+                    place=str(columns["place"][index]),
+                    time=values["time"][index],
+                    duration=int(values["duration"][index]),
+                    frequency=int(values["frequency"][index]),
+                    reward=str(columns["reward"][index]),
+                    is_pleasant=bool(values["is_pleasant"][index]),
+                    is_public=bool(values["is_public"][index]),
+                    created_at=now,
+                )
+            )
+        marker = {"run": checkpoint.value["run"], "rows": position}
+        for alias in sorted(set(profiles) | set(habits)):
+            self._write_shard(
+                alias, profiles.get(alias, []), habits.get(alias, []), marker
+            )
+
+        self.users += len(created)
+        self.habits += sum(len(items) for items in habits.values())
+        self.rejected += int((~valid).sum())
+        checkpoint.value = {
+            "run": checkpoint.value["run"],
+            "rows": position + len(batch),
+            "users": self.users,
+            "habits": self.habits,
+            "rejected": self.rejected,
+        }
+        checkpoint.save(using=DEFAULT_DB_ALIAS)
+
+        # Сигналы не вызывались, поэтому кэш расписания сбрасывается здесь
+        existing_ids = set(existing.values())
+        for user_id in {habit.user_id for items in habits.values() for habit in items}:
+            if user_id in existing_ids:
+                bump_habit_set_version(user_id)
+
+    def _write_shard(self, alias, profiles, habits, marker):
+        """
+        Записывает профили и привычки пакета на шард alias вместе с отметкой
+        marker, если пакет еще не записан туда прерванной попыткой.
+        """
+        with transaction.atomic(using=alias):
+            written, _ = (
+                TaskCheckpoint.objects.using(alias)
+                .select_for_update()
+                .get_or_create(name=CHECKPOINT_PREFIX + self.name + SHARD_MARKER_SUFFIX)
+            )
+            if written.value == marker:
+                return
+            UserProfile.objects.using(alias).bulk_create(profiles)
+            self._write_habits(alias, habits)
+            written.value = marker
+            written.save(using=alias)
+
+    @staticmethod
+    def _write_habits(alias, habits):
+        if not habits:
+            return
+        connection = connections[alias]
+        if connection.vendor == "postgresql":
+            _copy_habits(connection, habits)
+        else:
+            Habit.objects.using(alias).bulk_create(habits)
+
+    def _report_errors(self, errors, position):
+        if self.errors is None:
+            return
+        for index in np.flatnonzero(~np.equal(errors, None)).tolist():
+            self.errors.writerow([position + index + 1, errors[index]])
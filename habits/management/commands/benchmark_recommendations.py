@@ -0,0 +1,85 @@
+import random
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from habits.recommendations import RecommendationIndex, build_index, vectorize
+
+WORDS = (
+    "read walk run swim cook write draw sing stretch meditate plan clean "
+    "study code learn garden paint practice journal breathe"
+).split()
+PLACES = "home park office gym kitchen garden library studio balcony".split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Замеряет время подбора рекомендаций по индексам разного объема. "
+        "Индексы строятся из случайных текстов во временном каталоге, БД "
+        "не используется."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+        parser.add_argument("--repeat", type=int, default=50)
+        parser.add_argument("--batch", type=int, default=32)
+        parser.add_argument("--k", type=int, default=20)
+
+    def handle(self, *args, **options):
+        self.results = []
+        rng = random.Random(0)
+        since = datetime.now(timezone.utc)
+        self.stdout.write(
+            f"{'rows':>10} {'p50, ms':>10} {'p95, ms':>10} {'batch, ms/query':>17}"
+        )
+        for size in sorted(options["sizes"]):
+            texts = [self._text(rng) for _ in range(size)]
+            with tempfile.TemporaryDirectory() as directory:
+                directory = Path(directory)
+                meta = build_index(
+                    directory,
+                    (
+                        (number, action, place, number % 3 == 0)
+                        for number, (action, place) in enumerate(texts, start=1)
+                    ),
+                    size,
+                    since,
+                )
+                index = RecommendationIndex(directory, meta)
+                queries = vectorize(
+                    [self._text(rng) for _ in range(options["batch"])], index.idf
+                )
+                masks = (None, index.pleasant)
+                single = self._measure(
+                    lambda: index.search(queries[0], options["k"], masks),
+                    options["repeat"],
+                )
+                batched = self._measure(
+                    lambda: index.search(queries, options["k"], masks),
+                    max(options["repeat"] // 10, 1),
+                )
+            per_query = float(np.median(batched)) / len(queries)
+            p50, p95 = np.percentile(single, [50, 95])
+            self.results.append((size, p50, p95, per_query))
+            self.stdout.write(
+                f"{size:>10} {p50 * 1000:>10.3f} {p95 * 1000:>10.3f} "
+                f"{per_query * 1000:>17.3f}"
+            )
+
+    @staticmethod
+    def _text(rng):
+        return " ".join(rng.sample(WORDS, 2)), rng.choice(PLACES)
+
+    @staticmethod
+    def _measure(func, repeat):
+        func()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return timings
@@ -0,0 +1,104 @@
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+
+from habits.models import Habit
+from habits.search import search_habits
+
+WORDS = (
+    "read walk run swim cook write draw sing stretch meditate plan clean "
+    "study code learn garden paint practice journal breathe"
+).split()
+PLACES = "home park office gym kitchen garden library studio balcony".split()
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = (
+        "Сравнивает время поиска по индексу с перебором icontains на данных "
+        "разного объема. Данные создаются во временной транзакции и удаляются."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes", type=int, nargs="+", default=[1000, 10000, 100000]
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument("--term", default="zebrafish")
+        parser.add_argument(
+            "--matches",
+            type=int,
+            default=10,
+            help="Сколько привычек содержит искомое слово при любом объеме данных",
+        )
+
+    def handle(self, *args, **options):
+        self.results = []
+        try:
+            with transaction.atomic():
+                self._run(
+                    options["sizes"],
+                    options["repeat"],
+                    options["term"],
+                    options["matches"],
+                )
+                raise Rollback
+        except Rollback:
+            pass
+        return None
+
+    def _run(self, sizes, repeat, term, matches):
+        rng = random.Random(0)
+        user = User.objects.create(username="benchmark-search-user")
+        created = 0
+        self.stdout.write(f"{'rows':>10} {'index, ms':>12} {'icontains, ms':>15}")
+        for size in sorted(sizes):
+            Habit.objects.bulk_create(
+                (
+                    Habit(
+                        user=user,
+                        action=" ".join(rng.sample(WORDS, 3))
+                        + (f" {term}" if n < matches else ""),
+                        place=rng.choice(PLACES),
+                        time="08:00",
+                        duration=60,
+                        is_public=True,
+                    )
+                    for n in range(created, size)
+                ),
+                batch_size=5000,
+            )
+            created = size
+            public = Habit.objects.filter(is_public=True)
+            indexed = self._measure(
+                lambda: list(search_habits(public, term)[:20]), repeat
+            )
+            scanned = self._measure(
+                lambda: list(
+                    public.filter(
+                        Q(action__icontains=term) | Q(place__icontains=term)
+                    ).order_by("id")[:20]
+                ),
+                repeat,
+            )
+            self.results.append((size, indexed, scanned))
+            self.stdout.write(
+                f"{size:>10} {indexed * 1000:>12.3f} {scanned * 1000:>15.3f}"
+            )
+
+    @staticmethod
+    def _measure(func, repeat):
+        func()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return sorted(timings)[len(timings) // 2]
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from habits.recommendations import refresh_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Обновляет индекс рекомендаций привычками, измененными с прошлого "
+        "обновления, или строит его заново с --full"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--full", action="store_true")
+
+    def handle(self, *args, **options):
+        processed = refresh_index(full=options["full"])
+        self.stdout.write(f"Обработано привычек: {processed}.")
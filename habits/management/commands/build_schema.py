@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from habits.schema import generate_schema_documents, schema_artifact_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Собирает OpenAPI-схему в файлы OPENAPI_SCHEMA_DIR/schema-<VERSION>.yaml "
+        "и schema-<VERSION>.json"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--check",
+            action="store_true",
+            help="Не записывать файлы, а завершиться с ошибкой, если они устарели",
+        )
+
+    def handle(self, *args, **options):
+        documents = generate_schema_documents()
+        for format, content in documents.items():
+            path = schema_artifact_path(format)
+            if options["check"]:
+                if not path.exists():
+                    raise CommandError(f"Файл схемы {path} не найден.")
+                if path.read_bytes() != content:
+                    raise CommandError(
+                        f"Файл схемы {path} устарел, выполните manage.py build_schema."
+                    )
+                self.stdout.write(f"Файл схемы {path} актуален.")
+                continue
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(content)
+            self.stdout.write(f"Схема записана в {path}.")
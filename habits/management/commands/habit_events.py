@@ -0,0 +1,39 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from habits import events
+
+
+class Command(BaseCommand):
+    help = (
+        "Выводит события потока изменений в формате NDJSON: с позиции --after "
+        "или для потребителя группы --group с подтверждением обработки"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--after", default="0-0")
+        parser.add_argument("--count", type=int, default=100)
+        parser.add_argument("--group")
+        parser.add_argument("--consumer")
+        parser.add_argument(
+            "--pending",
+            action="store_true",
+            help="Повторно выдать неподтвержденные события потребителя",
+        )
+
+    def handle(self, *args, **options):
+        group = options["group"]
+        if group is None:
+            batch = events.replay(options["after"], options["count"])
+        else:
+            if not options["consumer"]:
+                raise CommandError("Для группы нужно указать --consumer.")
+            events.create_group(group)
+            batch = events.read_group(
+                group, options["consumer"], options["count"], options["pending"]
+            )
+        for event in batch:
+            self.stdout.write(json.dumps(event, ensure_ascii=False))
+        if group is not None:
+            events.ack(group, [event["id"] for event in batch])
@@ -0,0 +1,76 @@
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from habits.importing import Importer, read_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Импортирует пользователей, профили и привычки из CSV или NDJSON. "
+        "Прерванный импорт продолжается с последнего сохраненного пакета"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=["csv", "ndjson"])
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=os.cpu_count(),
+            help="Процессы для хеширования паролей, 0 - хешировать в текущем",
+        )
+        parser.add_argument(
+            "--checkpoint", help="Имя контрольной точки, по умолчанию имя файла"
+        )
+        parser.add_argument(
+            "--restart", action="store_true", help="Начать импорт файла заново"
+        )
+        parser.add_argument("--errors", help="CSV-файл для отклоненных строк")
+
+    def handle(self, *args, **options):
+        path = Path(options["path"])
+        if not path.is_file():
+            raise CommandError(f"Файл {path} не найден.")
+        file_format = options["format"] or (
+            "csv" if path.suffix.lower() == ".csv" else "ndjson"
+        )
+        with ExitStack() as stack:
+            stream = stack.enter_context(path.open(newline="", encoding="utf-8"))
+            pool = None
+            if options["workers"]:
+                pool = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=options["workers"])
+                )
+            errors = None
+            if options["errors"]:
+                errors = csv.writer(
+                    stack.enter_context(
+                        open(options["errors"], "w", newline="", encoding="utf-8")
+                    )
+                )
+                errors.writerow(["row", "error"])
+            importer = Importer(
+                options["checkpoint"] or path.name,
+                batch_size=options["batch_size"],
+                pool=pool,
+                errors=errors,
+            )
+            processed = importer.run(
+                read_rows(stream, file_format),
+                restart=options["restart"],
+                progress=self._progress,
+            )
+        self.stdout.write(
+            f"Обработано строк: {processed}. Всего импортировано пользователей: "
+            f"{importer.users}, привычек: {importer.habits}, "
+            f"отклонено строк: {importer.rejected}."
+        )
+
+    def _progress(self, position, rate):
+        self.stdout.write(f"Строка {position}: {rate:.0f} строк/с")
@@ -0,0 +1,19 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from habits.profiling import make_profiling_token
+
+
+class Command(BaseCommand):
+    help = "Выдает значение заголовка X-Profile для профилирования запросов"
+
+    def add_arguments(self, parser):
+        parser.add_argument("username")
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options["username"]).first()
+        if user is None:
+            raise CommandError("Пользователь не найден.")
+        if not user.is_staff:
+            raise CommandError("Профилирование доступно только сотрудникам.")
+        self.stdout.write(make_profiling_token(user))
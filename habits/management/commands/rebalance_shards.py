@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from habits.sharding import move_user, ring, shard_for_user
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит пользователей на шарды, назначенные кольцом "
+        "консистентного хеширования, по одному без остановки сервиса"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        users = (
+            User.objects.using(DEFAULT_DB_ALIAS)
+            .order_by("pk")
+            .values_list("pk", flat=True)
+        )
+        hash_ring = ring()
+        moved = 0
+        for user_id in users.iterator():
+            target = hash_ring.node_for(user_id)
+            source = shard_for_user(user_id)
+            if source == target:
+                continue
+            if options["dry_run"]:
+                self.stdout.write(f"Пользователь {user_id}: {source} -> {target}")
+            elif not move_user(user_id, target):
+                continue
+            moved += 1
+        label = "Требуют переноса" if options["dry_run"] else "Перенесено"
+        self.stdout.write(f"{label} пользователей: {moved}.")
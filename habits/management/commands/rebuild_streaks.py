@@ -0,0 +1,75 @@
+from itertools import groupby
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from habits.models import Habit, HabitCompletion, compute_streaks
+from habits.sharding import sharded
+
+COUNTER_FIELDS = ("current_streak", "longest_streak", "last_completed")
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счетчики серий привычек по журналу выполнений на всех шардах"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        fixed = reset = 0
+        for alias in settings.HABIT_SHARDS:
+            shard_fixed, shard_reset = self._rebuild_shard(alias, batch_size)
+            fixed += shard_fixed
+            reset += shard_reset
+
+        self.stdout.write(
+            f"Исправлено привычек: {fixed}, сброшено без выполнений: {reset}."
+        )
+
+    def _rebuild_shard(self, alias, batch_size):
+        reset = (
+            sharded(Habit, alias)
+            .filter(completions__isnull=True)
+            .exclude(current_streak=0, longest_streak=0, last_completed=None)
+            .update(current_streak=0, longest_streak=0, last_completed=None)
+        )
+
+        rows = (
+            sharded(HabitCompletion, alias)
+            .order_by("habit_id", "date")
+            .values_list("habit_id", "habit__frequency", "date")
+            .iterator(chunk_size=batch_size * 10)
+        )
+        batch = {}
+        fixed = 0
+        for habit_id, group in groupby(rows, key=lambda row: row[0]):
+            group = list(group)
+            frequency = group[0][1]
+            batch[habit_id] = compute_streaks((row[2] for row in group), frequency)
+            if len(batch) >= batch_size:
+                fixed += self._apply(alias, batch)
+                batch = {}
+        if batch:
+            fixed += self._apply(alias, batch)
+        return fixed, reset
+
+    @staticmethod
+    def _apply(alias, batch):
+        habits = sharded(Habit, alias)
+        with transaction.atomic(using=alias):
+            changed = []
+            for habit in (
+                habits.select_for_update()
+                .only(*COUNTER_FIELDS)
+                .filter(pk__in=batch.keys())
+            ):
+                counters = batch[habit.pk]
+                if tuple(getattr(habit, field) for field in COUNTER_FIELDS) == counters:
+                    continue
+                for field, value in zip(COUNTER_FIELDS, counters):
+                    setattr(habit, field, value)
+                changed.append(habit)
+            habits.bulk_update(changed, COUNTER_FIELDS)
+        return len(changed)
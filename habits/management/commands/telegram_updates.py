@@ -0,0 +1,47 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from habits.bot import UpdatePoller
+
+
+class Command(BaseCommand):
+    help = (
+        "Принимает сообщения боту Telegram через getUpdates (long polling) и "
+        "обрабатывает их пачками: привязка чатов и команды бота"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--timeout",
+            type=int,
+            default=None,
+            help="Время ожидания обновлений в секундах (TELEGRAM_POLL_TIMEOUT)",
+        )
+        parser.add_argument(
+            "--once", action="store_true", help="Обработать одну пачку и выйти"
+        )
+
+    def handle(self, *args, **options):
+        import telegram
+
+        poller = UpdatePoller(timeout=options["timeout"])
+        try:
+            while True:
+                try:
+                    processed = poller.poll()
+                except (telegram.error.TelegramError, DatabaseError) as error:
+                    # Сетевые ошибки, конфликт с другим получателем обновлений
+                    # и недоступность базы: пачка будет получена заново
+                    self.stderr.write(f"Ошибка получения обновлений: {error}")
+                    if options["once"]:
+                        raise
+                    time.sleep(5)
+                    continue
+                if processed:
+                    self.stdout.write(f"Обработано обновлений: {processed}.")
+                if options["once"]:
+                    return
+        finally:
+            poller.close()
@@ -0,0 +1,506 @@
+"""
+Метрики приложения в текстовом формате Prometheus.
+
+Если задан METRICS_REDIS_URL, метрики веб-запросов и задач Celery
+пишутся в Redis, и /metrics любого процесса gunicorn отдает значения,
+накопленные всеми процессами. Замеры копятся в памяти процесса и
+записываются в Redis фоновым потоком, запросы Redis не ждут. Без Redis
+метрики хранятся в памяти процесса.
+"""
+
+import atexit
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    rendered = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+    return "{" + rendered + "}"
+
+
+class LocalStore:
+    """
+    Хранилище значений метрик в памяти процесса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, metric, updates):
+        with self._lock:
+            values = self._data.setdefault(metric, {})
+            for field, amount in updates:
+                values[field] = values.get(field, 0) + amount
+
+    def add_many(self, batch):
+        with self._lock:
+            for metric, updates in batch:
+                values = self._data.setdefault(metric, {})
+                for field, amount in updates:
+                    values[field] = values.get(field, 0) + amount
+
+    def set(self, metric, field, value):
+        with self._lock:
+            self._data.setdefault(metric, {})[field] = value
+
+    def read(self, metric):
+        with self._lock:
+            return dict(self._data.get(metric, {}))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class RedisStore:
+    """
+    Хранилище значений метрик в хешах Redis.
+
+    Позволяет собирать метрики из нескольких процессов (например, воркеров
+    Celery) и отдавать их эндпоинтом /metrics веб-процесса. Изменения
+    копятся в памяти процесса и записываются фоновым потоком раз в
+    METRICS_FLUSH_INTERVAL секунд одним конвейером, поэтому запросы не
+    ждут Redis. Если Redis недоступен, накопленные замеры отбрасываются.
+    """
+
+    def __init__(self, url, prefix="habits:metrics:"):
+        self.url = url
+        self.prefix = prefix
+        self._client = None
+        self._lock = threading.Lock()
+        self._increments = {}
+        self._values = {}
+        self._pid = None
+        # Замеры, накопленные к завершению процесса, дописываются при выходе
+        atexit.register(self.flush)
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis.from_url(
+                self.url,
+                socket_timeout=settings.METRICS_REDIS_TIMEOUT,
+                socket_connect_timeout=settings.METRICS_REDIS_TIMEOUT,
+            )
+        return self._client
+
+    def _start_flusher(self):
+        # Вызывается под self._lock. Поток родителя после fork в дочернем
+        # процессе не работает, а его замеры запишет сам родитель
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._increments = {}
+            self._values = {}
+            threading.Thread(
+                target=self._run, name="habits-metrics", daemon=True
+            ).start()
+
+    def _run(self):
+        while True:
+            time.sleep(settings.METRICS_FLUSH_INTERVAL)
+            self.flush()
+
+    def add(self, metric, updates):
+        self.add_many([(metric, updates)])
+
+    def add_many(self, batch):
+        with self._lock:
+            self._start_flusher()
+            for metric, updates in batch:
+                for field, amount in updates:
+                    key = (metric, json.dumps(field))
+                    self._increments[key] = self._increments.get(key, 0) + amount
+
+    def set(self, metric, field, value):
+        with self._lock:
+            self._start_flusher()
+            self._values[(metric, json.dumps(field))] = value
+
+    def flush(self):
+        """
+        Записывает накопленные изменения в Redis.
+        """
+        with self._lock:
+            increments, self._increments = self._increments, {}
+            values, self._values = self._values, {}
+        if not increments and not values:
+            return
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            for (metric, field), amount in increments.items():
+                if isinstance(amount, float):
+                    pipe.hincrbyfloat(self.prefix + metric, field, amount)
+                else:
+                    pipe.hincrby(self.prefix + metric, field, amount)
+            for (metric, field), value in values.items():
+                pipe.hset(self.prefix + metric, field, value)
+            pipe.execute()
+        except Exception:
+            logger.warning(
+                "Не удалось записать метрики в Redis, отброшено изменений: %d",
+                len(increments) + len(values),
+            )
+
+    def read(self, metric):
+        # Замеры своего процесса видны без ожидания фоновой записи
+        self.flush()
+        try:
+            raw = self.client.hgetall(self.prefix + metric)
+        except Exception:
+            logger.warning("Не удалось прочитать метрику %s из Redis", metric)
+            return {}
+        return {tuple(json.loads(field)): float(value) for field, value in raw.items()}
+
+    def clear(self):
+        with self._lock:
+            self._increments.clear()
+            self._values.clear()
+        keys = list(self.client.scan_iter(self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _read(self):
+        return self.registry.store.read(self.name)
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        self.registry.add(self.name, [(self._key(labels), amount)])
+
+    def value(self, **labels):
+        return self._read().get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._read().items()):
+            yield self.name + "_total", _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.registry.store.set(self.name, self._key(labels), value)
+
+    def value(self, **labels):
+        return self._read().get(self._key(labels))
+
+    def samples(self):
+        for key, value in sorted(self._read().items()):
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self, registry, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS
+    ):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        # Корзины хранятся без накопления, накопление делается при выводе
+        index = bisect_left(self.buckets, value)
+        self.registry.add(
+            self.name,
+            [
+                (key + (f"bucket:{index}",), 1),
+                (key + ("sum",), float(value)),
+                (key + ("count",), 1),
+            ],
+        )
+
+    def count(self, **labels):
+        return self._read().get(self._key(labels) + ("count",), 0)
+
+    def samples(self):
+        series = {}
+        for field, value in self._read().items():
+            series.setdefault(field[:-1], {})[field[-1]] = value
+        for key, parts in sorted(series.items()):
+            cumulative = 0
+            bounds = self.buckets + (float("inf"),)
+            for index, bound in enumerate(bounds):
+                cumulative += parts.get(f"bucket:{index}", 0)
+                labels = _format_labels(
+                    self.labelnames, key, extra=[("le", _format_value(float(bound)))]
+                )
+                yield self.name + "_bucket", labels, cumulative
+            labels = _format_labels(self.labelnames, key)
+            yield self.name + "_sum", labels, parts.get("sum", 0.0)
+            yield self.name + "_count", labels, parts.get("count", 0)
+
+
+class Registry:
+    """
+    Набор метрик, отдаваемых эндпоинтом /metrics.
+
+    Хранилище создается при первом обращении вызовом store_factory.
+    """
+
+    def __init__(self, store_factory=LocalStore):
+        self._store_factory = store_factory
+        self._store = None
+        self._metrics = {}
+        self._pending = ContextVar(f"habits_metrics_pending_{id(self)}", default=None)
+
+    @property
+    def store(self):
+        if self._store is None:
+            self._store = self._store_factory()
+        return self._store
+
+    def add(self, metric, updates):
+        pending = self._pending.get()
+        if pending is None:
+            self.store.add(metric, updates)
+        else:
+            pending.append((metric, updates))
+
+    @contextmanager
+    def batch(self):
+        """
+        Копит изменения метрик внутри блока и записывает их в хранилище
+        одним обращением.
+        """
+        pending = []
+        token = self._pending.set(pending)
+        try:
+            yield
+        finally:
+            self._pending.reset(token)
+            if pending:
+                self.store.add_many(pending)
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(self, name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self.register(Gauge(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def clear(self):
+        self.store.clear()
+
+    def render(self):
+        return "".join(metric.render() + "\n" for metric in self._metrics.values())
+
+
+def _shared_store(prefix):
+    url = getattr(settings, "METRICS_REDIS_URL", None)
+    return RedisStore(url, prefix) if url else LocalStore()
+
+
+# Метрики пишутся в общее хранилище, чтобы /metrics любого процесса
+# отдавал значения всех процессов gunicorn и воркеров Celery.
+REGISTRY = Registry(partial(_shared_store, "habits:metrics:http:"))
+TASK_REGISTRY = Registry(partial(_shared_store, "habits:metrics:tasks:"))
+
+REQUEST_DURATION = REGISTRY.histogram(
+    "habits_http_request_duration_seconds",
+    "Total time spent handling a request.",
+    ("route", "method"),
+)
+REQUEST_DB_DURATION = REGISTRY.histogram(
+    "habits_http_request_db_seconds",
+    "Time spent executing SQL per request.",
+    ("route", "method"),
+)
+REQUEST_DB_QUERIES = REGISTRY.histogram(
+    "habits_http_request_db_queries",
+    "Number of SQL queries per request.",
+    ("route", "method"),
+    buckets=QUERY_COUNT_BUCKETS,
+)
+REQUEST_SERIALIZER_DURATION = REGISTRY.histogram(
+    "habits_http_request_serializer_seconds",
+    "Time spent in serializer validation and representation per request.",
+    ("route", "method"),
+)
+
+
+class RequestTimings:
+    """
+    Накопитель замеров одного запроса.
+    """
+
+    __slots__ = ("db_time", "db_queries", "serializer_time")
+
+    def __init__(self):
+        self.db_time = 0.0
+        self.db_queries = 0
+        self.serializer_time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Используется как обертка connection.execute_wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.db_queries += 1
+
+    def server_timing(self, total):
+        return ", ".join(
+            [
+                f'db;dur={self.db_time * 1000:.2f};desc="{self.db_queries} queries"',
+                f"ser;dur={self.serializer_time * 1000:.2f}",
+                f"total;dur={total * 1000:.2f}",
+            ]
+        )
+
+
+_current_timings = ContextVar("habits_request_timings", default=None)
+
+
+@contextmanager
+def serializer_timer():
+    """
+    Добавляет время выполнения блока к времени сериализации текущего запроса.
+
+    Вне запроса (например, в задачах Celery) ничего не измеряет.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.serializer_time += time.perf_counter() - start
+
+
+def _route_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.view_name or match.route
+
+
+class RequestMetricsMiddleware:
+    """
+    Замеряет количество и время SQL-запросов, время сериализации и общее
+    время обработки запроса.
+
+    Результат отдается в заголовке Server-Timing и накапливается
+    в гистограммах по маршрутам.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings))
+                response = self.get_response(request)
+        finally:
+            _current_timings.reset(token)
+        total = time.perf_counter() - start
+
+        labels = {"route": _route_label(request), "method": request.method}
+        with REGISTRY.batch():
+            REQUEST_DURATION.observe(total, **labels)
+            REQUEST_DB_DURATION.observe(timings.db_time, **labels)
+            REQUEST_DB_QUERIES.observe(timings.db_queries, **labels)
+            REQUEST_SERIALIZER_DURATION.observe(timings.serializer_time, **labels)
+
+        response["Server-Timing"] = timings.server_timing(total)
+        return response
+
+
+def metrics_view(request):
+    """
+    Отдает накопленные метрики в текстовом формате Prometheus.
+
+    Требует заголовок Authorization: Bearer <METRICS_TOKEN>. Без
+    METRICS_TOKEN эндпоинт закрыт, если не включен METRICS_PUBLIC.
+    """
+    token = getattr(settings, "METRICS_TOKEN", None)
+    if token:
+        expected = f"Bearer {token}".encode()
+        given = request.headers.get("Authorization", "").encode()
+        if not hmac.compare_digest(given, expected):
+            return HttpResponseForbidden()
+    elif not getattr(settings, "METRICS_PUBLIC", False):
+        return HttpResponseForbidden()
+    body = REGISTRY.render() + TASK_REGISTRY.render()
+    return HttpResponse(body, content_type=CONTENT_TYPE)
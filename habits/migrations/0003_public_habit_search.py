@@ -0,0 +1,73 @@
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import Q
+
+POSTGRES_INDEX_NAME = "habits_public_search_idx"
+
+# Копия SQL из habits.search на момент миграции: миграция не должна
+# меняться вместе с кодом приложения
+SQLITE_FTS_CREATE = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS habits_habit_fts USING fts5("
+    "action, place, content='habits_habit', content_rowid='id')",
+    "INSERT INTO habits_habit_fts(rowid, action, place) "
+    "SELECT id, action, place FROM habits_habit WHERE is_public",
+    "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_insert "
+    "AFTER INSERT ON habits_habit WHEN new.is_public BEGIN "
+    "INSERT INTO habits_habit_fts(rowid, action, place) "
+    "VALUES (new.id, new.action, new.place); END",
+    "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_delete "
+    "AFTER DELETE ON habits_habit WHEN old.is_public BEGIN "
+    "INSERT INTO habits_habit_fts(habits_habit_fts, rowid, action, place) "
+    "VALUES ('delete', old.id, old.action, old.place); END",
+    "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_update "
+    "AFTER UPDATE OF action, place, is_public ON habits_habit BEGIN "
+    "INSERT INTO habits_habit_fts(habits_habit_fts, rowid, action, place) "
+    "SELECT 'delete', old.id, old.action, old.place WHERE old.is_public; "
+    "INSERT INTO habits_habit_fts(rowid, action, place) "
+    "SELECT new.id, new.action, new.place WHERE new.is_public; END",
+]
+
+SQLITE_FTS_DROP = [
+    "DROP TRIGGER IF EXISTS habits_habit_fts_insert",
+    "DROP TRIGGER IF EXISTS habits_habit_fts_delete",
+    "DROP TRIGGER IF EXISTS habits_habit_fts_update",
+    "DROP TABLE IF EXISTS habits_habit_fts",
+]
+
+
+def postgres_index():
+    # Выражение совпадает с habits.search.SEARCH_VECTOR
+    return GinIndex(
+        SearchVector("action", "place", config="simple"),
+        name=POSTGRES_INDEX_NAME,
+        condition=Q(is_public=True),
+    )
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.add_index(apps.get_model("habits", "Habit"), postgres_index())
+    elif vendor == "sqlite":
+        for statement in SQLITE_FTS_CREATE:
+            schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "postgresql":
+        schema_editor.remove_index(apps.get_model("habits", "Habit"), postgres_index())
+    elif vendor == "sqlite":
+        for statement in SQLITE_FTS_DROP:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("habits", "0002_habit_completion"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
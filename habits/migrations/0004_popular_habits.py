@@ -0,0 +1,95 @@
+# Generated by Django 5.2.18 on 2026-10-19 01:40
+
+import django.db.models.functions.text
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("habits", "0003_public_habit_search"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PopularHabit",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("action", models.CharField(max_length=255)),
+                ("place", models.CharField(max_length=100)),
+                ("display_action", models.CharField(max_length=255)),
+                ("display_place", models.CharField(max_length=100)),
+                ("adoption_count", models.PositiveIntegerField(default=0)),
+                ("recent_count", models.PositiveIntegerField(default=0)),
+                ("score", models.FloatField(db_index=True, default=0)),
+                ("dirty", models.BooleanField(default=False)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name="TaskCheckpoint",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=100, unique=True)),
+                ("value", models.JSONField(default=dict)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        # Время создания существующих привычек неизвестно: они получают NULL,
+        # а не время миграции, и не считаются новыми в рейтинге популярности
+        migrations.AddField(
+            model_name="habit",
+            name="created_at",
+            field=models.DateTimeField(editable=False, null=True),
+        ),
+        migrations.AlterField(
+            model_name="habit",
+            name="created_at",
+            field=models.DateTimeField(
+                default=django.utils.timezone.now, editable=False, null=True
+            ),
+        ),
+        migrations.AddField(
+            model_name="habit",
+            name="updated_at",
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name="habit",
+            index=models.Index(
+                django.db.models.functions.text.Lower(
+                    django.db.models.functions.text.Trim("action")
+                ),
+                django.db.models.functions.text.Lower(
+                    django.db.models.functions.text.Trim("place")
+                ),
+                condition=models.Q(("is_public", True)),
+                name="habit_popularity_key_idx",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="popularhabit",
+            constraint=models.UniqueConstraint(
+                fields=("action", "place"), name="unique_popular_habit_key"
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-19 02:44
+
+import habits.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("habits", "0006_profile_chat_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userprofile",
+            name="notification_channels",
+            field=models.JSONField(default=habits.models.default_notification_channels),
+        ),
+        migrations.AddField(
+            model_name="userprofile",
+            name="webhook_url",
+            field=models.URLField(blank=True, max_length=500, null=True),
+        ),
+    ]
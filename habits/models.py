@@ -1,17 +1,52 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Lower, Trim
+from django.utils import timezone
+
+
+def popularity_key(expression):
+    """
+    Нормализованное значение действия или места для рейтинга популярности.
+
+    Нормализация выполняется в БД, чтобы запросы использовали функциональный
+    индекс по тем же выражениям.
+    """
+    return Lower(Trim(expression))
+
+
+def compute_streaks(dates, frequency):
+    """
+    Считает (текущую серию, самую длинную серию, дату последнего выполнения)
+    по отсортированным датам выполнения.
+
+    Серия продолжается, если между выполнениями прошло не больше frequency дней.
+    """
+    current = longest = 0
+    last = None
+    for date in dates:
+        if last is not None and (date - last).days <= frequency:
+            current += 1
+        else:
+            current = 1
+        longest = max(longest, current)
+        last = date
+    return current, longest, last
 
 
 class Habit(models.Model):
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="habits")
+    # Привычки могут храниться на другом шарде, чем пользователи, поэтому
+    # ссылки на пользователя и связанную привычку не проверяются СУБД
+    user = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name="habits", db_constraint=False
+    )
     place = models.CharField(max_length=100)
     time = models.TimeField()
     action = models.CharField(max_length=255)
     is_pleasant = models.BooleanField(default=False)
     related_habit = models.ForeignKey(
-        "self", on_delete=models.SET_NULL, null=True, blank=True
+        "self", on_delete=models.SET_NULL, null=True, blank=True, db_constraint=False
     )
     frequency = models.PositiveIntegerField(
         default=1, validators=[MinValueValidator(1), MaxValueValidator(7)]
@@ -21,6 +56,34 @@ class Habit(models.Model):
         validators=[MaxValueValidator(120)], help_text="Duration in seconds"
     )
     is_public = models.BooleanField(default=False)
+    current_streak = models.PositiveIntegerField(default=0, editable=False)
+    longest_streak = models.PositiveIntegerField(default=0, editable=False)
+    last_completed = models.DateField(null=True, blank=True, editable=False)
+    # NULL у привычек, созданных до появления поля
+    created_at = models.DateTimeField(default=timezone.now, editable=False, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                popularity_key("action"),
+                popularity_key("place"),
+                name="habit_popularity_key_idx",
+                condition=models.Q(is_public=True),
+            )
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Исходные значения нужны, чтобы пометить устаревшую запись рейтинга
+        # популярности при изменении или удалении привычки
+        instance._loaded_popularity = (
+            instance.__dict__.get("is_public"),
+            instance.__dict__.get("action"),
+            instance.__dict__.get("place"),
+        )
+        return instance
 
     def clean(self):
         if self.reward and self.related_habit:
@@ -42,10 +105,146 @@ class Habit(models.Model):
     def __str__(self):
         return f"{self.action} at {self.time} in {self.place}"
 
+    def active_streak(self, today):
+        """
+        Текущая серия на дату today: обнуляется, если срок выполнения пропущен.
+        """
+        if self.last_completed is None:
+            return 0
+        if (today - self.last_completed).days > self.frequency:
+            return 0
+        return self.current_streak
+
+    def complete(self, date):
+        """
+        Отмечает выполнение привычки за дату date и обновляет счетчики серий.
+
+        Возвращает (выполнение, создано ли оно). Выполнение позже последнего
+        обновляет счетчики за O(1), выполнение задним числом пересчитывает
+        их по журналу этой привычки.
+        """
+        # Блокировка и запись идут в шард, из которого загружена привычка
+        using = self._state.db
+        with transaction.atomic(using=using):
+            habit = Habit.objects.using(using).select_for_update().get(pk=self.pk)
+            completion, created = HabitCompletion.objects.using(using).get_or_create(
+                habit=habit, date=date
+            )
+            if not created:
+                return completion, False
+            if habit.last_completed is None or date > habit.last_completed:
+                streak = 1
+                if (
+                    habit.last_completed is not None
+                    and (date - habit.last_completed).days <= habit.frequency
+                ):
+                    streak = habit.current_streak + 1
+                counters = (streak, max(habit.longest_streak, streak), date)
+            else:
+                dates = habit.completions.order_by("date").values_list(
+                    "date", flat=True
+                )
+                counters = compute_streaks(dates, habit.frequency)
+            self.current_streak, self.longest_streak, self.last_completed = counters
+            Habit.objects.using(using).filter(pk=self.pk).update(
+                current_streak=self.current_streak,
+                longest_streak=self.longest_streak,
+                last_completed=self.last_completed,
+            )
+        return completion, True
+
+
+def default_notification_channels():
+    return ["telegram"]
+
 
 class UserProfile(models.Model):
-    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
-    telegram_chat_id = models.CharField(max_length=100, blank=True, null=True)
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, related_name="profile", db_constraint=False
+    )
+    telegram_chat_id = models.CharField(
+        max_length=100, blank=True, null=True, db_index=True
+    )
+    # Имена каналов из NOTIFICATION_BACKENDS, по которым приходят напоминания
+    notification_channels = models.JSONField(default=default_notification_channels)
+    webhook_url = models.URLField(max_length=500, blank=True, null=True)
 
     def __str__(self):
         return f"{self.user.username}'s profile"
+
+
+class HabitCompletion(models.Model):
+    habit = models.ForeignKey(
+        Habit, on_delete=models.CASCADE, related_name="completions"
+    )
+    date = models.DateField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["habit", "date"], name="unique_habit_completion_date"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.habit.action} done on {self.date}"
+
+
+class PopularHabit(models.Model):
+    """
+    Материализованный рейтинг популярных публичных привычек.
+
+    Обновляется задачей refresh_popular_habits.
+    """
+
+    action = models.CharField(max_length=255)
+    place = models.CharField(max_length=100)
+    display_action = models.CharField(max_length=255)
+    display_place = models.CharField(max_length=100)
+    adoption_count = models.PositiveIntegerField(default=0)
+    recent_count = models.PositiveIntegerField(default=0)
+    score = models.FloatField(default=0, db_index=True)
+    dirty = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["action", "place"], name="unique_popular_habit_key"
+            )
+        ]
+
+    def __str__(self):
+        return f"{self.display_action} in {self.display_place} ({self.score})"
+
+
+class TaskCheckpoint(models.Model):
+    """
+    Позиция, до которой периодическая задача уже обработала данные.
+    """
+
+    name = models.CharField(max_length=100, unique=True)
+    value = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+class UserShard(models.Model):
+    """
+    Шард, на котором хранятся привычки и профиль пользователя.
+
+    Хранится в основной базе. Пользователи без записи находятся на первом
+    шарде из HABIT_SHARDS.
+    """
+
+    user = models.OneToOneField(
+        User, on_delete=models.CASCADE, primary_key=True, related_name="shard"
+    )
+    shard = models.CharField(max_length=100)
+    moving = models.BooleanField(default=False)
+
+    def __str__(self):
+        return f"{self.user_id} -> {self.shard}"
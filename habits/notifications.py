@@ -0,0 +1,334 @@
+"""
+Каналы доставки напоминаний.
+
+Канал - класс NotificationBackend, зарегистрированный под именем в
+NOTIFICATION_BACKENDS. Пользователь выбирает каналы в профиле
+(notification_channels), адрес для канала берется из профиля или учетной
+записи пользователя.
+
+Тик напоминаний собирает сообщения по каналам и ставит в очередь одну
+задачу send_notifications на пачку до NOTIFICATION_BATCH_SIZE сообщений.
+Бэкенд отправляет пачку целиком: письма - через одно SMTP-соединение,
+Telegram и вебхуки - через общий пул HTTP-соединений, не больше
+NOTIFICATION_CONCURRENCY запросов одновременно. Ошибка отдельного
+сообщения не прерывает отправку остальных.
+
+Вебхуки отправляются только по https на публичные адреса. Адрес
+проверяется при сохранении и повторно при каждом подключении, так как
+DNS-запись хоста могла измениться. Соединение открывается с тем адресом,
+который прошел проверку, без повторного разрешения имени.
+"""
+
+import asyncio
+import ipaddress
+import logging
+import socket
+from collections import Counter
+from functools import lru_cache
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Поля профиля, по которым выбираются каналы и адреса
+PROFILE_FIELDS = ("user_id", "telegram_chat_id", "webhook_url", "notification_channels")
+EMAIL_SUBJECT = "Напоминание о привычке"
+
+
+def _reason(error):
+    return type(error).__name__
+
+
+class UnsafeWebhookURL(ValueError):
+    """
+    Адрес вебхука не https или ведет во внутреннюю сеть.
+    """
+
+
+def _webhook_target(url):
+    parts = urlsplit(url)
+    if parts.scheme != "https" and not settings.WEBHOOK_ALLOW_LOCAL:
+        raise UnsafeWebhookURL("Адрес вебхука должен использовать https.")
+    if not parts.hostname:
+        raise UnsafeWebhookURL("В адресе вебхука нет хоста.")
+    return parts.hostname, parts.port or (443 if parts.scheme == "https" else 80)
+
+
+def _check_addresses(addresses):
+    if settings.WEBHOOK_ALLOW_LOCAL:
+        return
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        # is_global исключает частные, loopback, link-local (в том числе
+        # адрес метаданных облака 169.254.169.254) и зарезервированные сети
+        if not address.is_global or address.is_multicast:
+            raise UnsafeWebhookURL("Адрес вебхука ведет во внутреннюю сеть.")
+
+
+def check_webhook_url(url):
+    """
+    Проверяет, что вебхук отправляется по https и все адреса его хоста
+    публичные. Иначе вызывает UnsafeWebhookURL.
+    """
+    host, port = _webhook_target(url)
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except OSError:
+        raise UnsafeWebhookURL("Не удалось определить адрес хоста вебхука.")
+    _check_addresses(addresses)
+
+
+class _PublicNetworkBackend:
+    """
+    Сетевой бэкенд httpcore, который подключается только к проверенным
+    публичным адресам хоста.
+    """
+
+    def __init__(self):
+        import httpcore
+
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, **options):
+        try:
+            addresses = await asyncio.get_running_loop().getaddrinfo(
+                host, port, type=socket.SOCK_STREAM
+            )
+        except OSError:
+            raise UnsafeWebhookURL("Не удалось определить адрес хоста вебхука.")
+        _check_addresses(addresses)
+        # TLS по-прежнему проверяет сертификат по имени хоста
+        return await self._backend.connect_tcp(addresses[0][4][0], port, **options)
+
+    async def connect_unix_socket(self, path, **options):
+        raise UnsafeWebhookURL("Вебхук нельзя отправить через unix-сокет.")
+
+    async def sleep(self, seconds):
+        await self._backend.sleep(seconds)
+
+
+class NotificationBackend:
+    """
+    Канал доставки. Наследники задают name и адреса пользователей и
+    реализуют send или send_batch.
+    """
+
+    name = None
+    # Поле профиля с адресом пользователя в канале
+    profile_field = None
+
+    def addresses(self, profiles):
+        """
+        Возвращает адреса в канале для профилей {id пользователя: поля
+        PROFILE_FIELDS}. Пользователи без адреса пропускаются.
+        """
+        return {
+            user_id: profile[self.profile_field]
+            for user_id, profile in profiles.items()
+            if profile.get(self.profile_field)
+        }
+
+    def send(self, address, text, data):
+        raise NotImplementedError
+
+    def send_batch(self, messages):
+        """
+        Отправляет сообщения [адрес, текст, данные] и возвращает Counter
+        причин неудачных отправок.
+        """
+        failures = Counter()
+        for address, text, data in messages:
+            try:
+                self.send(address, text, data)
+            except Exception as error:
+                failures[_reason(error)] += 1
+        return failures
+
+
+class AsyncBatchBackend(NotificationBackend):
+    """
+    Канал, сообщения пачки которого отправляются конкурентно в одном
+    цикле событий.
+    """
+
+    def send_batch(self, messages):
+        return asyncio.run(self._send_batch(messages))
+
+    async def _send_batch(self, messages):
+        semaphore = asyncio.Semaphore(settings.NOTIFICATION_CONCURRENCY)
+        async with self.session() as session:
+
+            async def send(address, text, data):
+                async with semaphore:
+                    await self.send_async(session, address, text, data)
+
+            results = await asyncio.gather(
+                *(send(*message) for message in messages), return_exceptions=True
+            )
+        return Counter(
+            _reason(result) for result in results if isinstance(result, BaseException)
+        )
+
+    def session(self):
+        raise NotImplementedError
+
+    async def send_async(self, session, address, text, data):
+        raise NotImplementedError
+
+
+class _TelegramSession:
+    """
+    Bot с собственными пулами соединений, которые закрываются на выходе.
+    """
+
+    def __init__(self):
+        import telegram
+        from telegram.request import HTTPXRequest
+
+        # Пул getUpdates передается явно: иначе Bot создает его сам и он
+        # остается открытым. async with bot не подходит, так как вызывает
+        # getMe для каждой пачки
+        self.requests = (
+            HTTPXRequest(connection_pool_size=settings.NOTIFICATION_CONCURRENCY),
+            HTTPXRequest(connection_pool_size=1),
+        )
+        self.bot = telegram.Bot(
+            token=settings.TELEGRAM_BOT_TOKEN,
+            base_url=settings.TELEGRAM_API_URL,
+            request=self.requests[0],
+            get_updates_request=self.requests[1],
+        )
+
+    async def __aenter__(self):
+        return self.bot
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.gather(*(request.shutdown() for request in self.requests))
+
+
+class TelegramBackend(AsyncBatchBackend):
+    name = "telegram"
+    profile_field = "telegram_chat_id"
+
+    def session(self):
+        return _TelegramSession()
+
+    async def send_async(self, bot, address, text, data):
+        await bot.send_message(chat_id=address, text=text)
+
+
+class WebhookBackend(AsyncBatchBackend):
+    """
+    POST-запрос с JSON {"event": "reminder", "text": ..., данные
+    напоминания} на адрес пользователя.
+    """
+
+    name = "webhook"
+    profile_field = "webhook_url"
+
+    def session(self):
+        import httpcore
+        import httpx
+
+        transport = httpx.AsyncHTTPTransport()
+        # httpx не принимает сетевой бэкенд, поэтому пул соединений
+        # транспорта заменяется пулом с проверкой адресов
+        transport._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=settings.NOTIFICATION_CONCURRENCY,
+            network_backend=_PublicNetworkBackend(),
+        )
+        return httpx.AsyncClient(
+            transport=transport, timeout=settings.NOTIFICATION_TIMEOUT
+        )
+
+    async def send_async(self, client, address, text, data):
+        _webhook_target(address)
+        response = await client.post(
+            address, json={"event": "reminder", "text": text, **data}
+        )
+        response.raise_for_status()
+
+
+class EmailBackend(NotificationBackend):
+    """
+    Письма на email учетной записи через EMAIL_BACKEND Django.
+    """
+
+    name = "email"
+
+    def addresses(self, profiles):
+        from django.contrib.auth.models import User
+
+        return dict(
+            User.objects.using(DEFAULT_DB_ALIAS)
+            .filter(pk__in=list(profiles))
+            .exclude(email="")
+            .values_list("pk", "email")
+        )
+
+    def send_batch(self, messages):
+        from django.core.mail import EmailMessage, get_connection
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as error:
+            logger.warning("Не удалось подключиться к SMTP-серверу")
+            return Counter({_reason(error): len(messages)})
+        failures = Counter()
+        try:
+            for address, text, _ in messages:
+                message = EmailMessage(
+                    EMAIL_SUBJECT, text, to=[address], connection=connection
+                )
+                try:
+                    message.send()
+                except Exception as error:
+                    failures[_reason(error)] += 1
+        finally:
+            connection.close()
+        return failures
+
+
+@lru_cache(maxsize=None)
+def _backend_for(path):
+    return import_string(path)()
+
+
+def get_backend(channel):
+    return _backend_for(settings.NOTIFICATION_BACKENDS[channel])
+
+
+def channels():
+    return list(settings.NOTIFICATION_BACKENDS)
+
+
+def route(reminders, profiles):
+    """
+    Раскладывает напоминания [(id пользователя, текст, данные)] по каналам,
+    выбранным пользователями. Возвращает {канал: [[адрес, текст, данные]]}.
+    """
+    batches = {}
+    for channel in channels():
+        subscribed = {
+            user_id: profile
+            for user_id, profile in profiles.items()
+            if channel in (profile["notification_channels"] or ())
+        }
+        if not subscribed:
+            continue
+        addresses = get_backend(channel).addresses(subscribed)
+        messages = [
+            [addresses[user_id], text, data]
+            for user_id, text, data in reminders
+            if user_id in addresses
+        ]
+        if messages:
+            batches[channel] = messages
+    return batches
@@ -0,0 +1,195 @@
+"""
+Рейтинг популярных публичных привычек.
+
+Популярность считается по нормализованной паре (действие, место): число
+публичных привычек с этой парой и число новых за последние
+POPULAR_HABITS_GROWTH_WINDOW. Привычки считаются на всех шардах, рейтинг
+хранится в таблице PopularHabit основной базы, а его верхняя часть - в
+кэше, откуда ее отдает API.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Min, Q, Value
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Habit, PopularHabit, TaskCheckpoint, popularity_key
+from .sharding import scatter, sharded
+
+CACHE_KEY = "habits:popular-habits"
+CHECKPOINT_NAME = "popular-habits"
+KEYS_PER_QUERY = 200
+# Изменения, закоммиченные во время прошлого обновления, могут иметь
+# updated_at чуть раньше его отметки, поэтому окно берется с запасом.
+# Повторный пересчет пары ничего не портит.
+REFRESH_OVERLAP = timedelta(minutes=1)
+
+
+def _score(adoption_count, recent_count):
+    return adoption_count + settings.POPULAR_HABITS_GROWTH_WEIGHT * recent_count
+
+
+def _public_with_keys(alias):
+    return (
+        sharded(Habit, alias)
+        .filter(is_public=True)
+        .annotate(
+            action_key=popularity_key("action"), place_key=popularity_key("place")
+        )
+    )
+
+
+def mark_stale(action, place):
+    """
+    Помечает запись рейтинга для пары (action, place) как требующую пересчета.
+    """
+    PopularHabit.objects.filter(
+        action=popularity_key(Value(action)), place=popularity_key(Value(place))
+    ).update(dirty=True)
+
+
+def _aggregate_shard(alias, keys, window_start):
+    condition = Q()
+    for action, place in keys:
+        condition |= Q(action_key=action, place_key=place)
+    return list(
+        _public_with_keys(alias)
+        .filter(condition)
+        .values("action_key", "place_key")
+        .annotate(
+            adoption_count=Count("id"),
+            recent_count=Count("id", filter=Q(created_at__gte=window_start)),
+            display_action=Min("action"),
+            display_place=Min("place"),
+        )
+    )
+
+
+def _aggregate(keys, window_start):
+    """
+    Возвращает {(action, place): счетчики} по привычкам всех шардов.
+    """
+    rows = {}
+    for shard_rows in scatter(
+        lambda alias: _aggregate_shard(alias, keys, window_start)
+    ):
+        for row in shard_rows:
+            key = (row["action_key"], row["place_key"])
+            total = rows.get(key)
+            if total is None:
+                rows[key] = row
+                continue
+            total["adoption_count"] += row["adoption_count"]
+            total["recent_count"] += row["recent_count"]
+            total["display_action"] = min(
+                total["display_action"], row["display_action"]
+            )
+            total["display_place"] = min(total["display_place"], row["display_place"])
+    return rows
+
+
+def _changed_keys(alias, since):
+    changed = _public_with_keys(alias)
+    if since is not None:
+        changed = changed.filter(updated_at__gt=since - REFRESH_OVERLAP)
+    return set(changed.values_list("action_key", "place_key").distinct())
+
+
+def refresh_popular_habits():
+    """
+    Обновляет рейтинг по привычкам, измененным с прошлого запуска.
+
+    Пересчитываются только затронутые пары: измененные публичные привычки,
+    помеченные устаревшими записи (удаление, снятие публикации, смена
+    действия или места) и записи с ненулевым ростом, так как окно роста
+    сдвигается со временем. Возвращает количество пересчитанных пар.
+    """
+    now = timezone.now()
+    window_start = now - settings.POPULAR_HABITS_GROWTH_WINDOW
+    checkpoint, _ = TaskCheckpoint.objects.get_or_create(name=CHECKPOINT_NAME)
+    since = checkpoint.value.get("since")
+    since = parse_datetime(since) if since else None
+
+    keys = set().union(*scatter(lambda alias: _changed_keys(alias, since)))
+    keys.update(
+        PopularHabit.objects.filter(Q(dirty=True) | Q(recent_count__gt=0))
+        .values_list("action", "place")
+        .distinct()
+    )
+
+    refreshed = len(keys)
+    keys = list(keys)
+    while keys:
+        chunk, keys = keys[:KEYS_PER_QUERY], keys[KEYS_PER_QUERY:]
+        rows = _aggregate(chunk, window_start)
+        with transaction.atomic():
+            PopularHabit.objects.bulk_create(
+                [
+                    PopularHabit(
+                        action=action,
+                        place=place,
+                        display_action=row["display_action"],
+                        display_place=row["display_place"],
+                        adoption_count=row["adoption_count"],
+                        recent_count=row["recent_count"],
+                        score=_score(row["adoption_count"], row["recent_count"]),
+                        dirty=False,
+                    )
+                    for (action, place), row in rows.items()
+                ],
+                update_conflicts=True,
+                unique_fields=["action", "place"],
+                update_fields=[
+                    "display_action",
+                    "display_place",
+                    "adoption_count",
+                    "recent_count",
+                    "score",
+                    "dirty",
+                    "updated_at",
+                ],
+            )
+            gone = Q()
+            for action, place in set(chunk) - set(rows):
+                gone |= Q(action=action, place=place)
+            if gone:
+                PopularHabit.objects.filter(gone).delete()
+
+    checkpoint.value = {"since": now.isoformat()}
+    checkpoint.save(update_fields=["value", "updated_at"])
+    cache.set(CACHE_KEY, _top_from_table(), None)
+    return refreshed
+
+
+def _top_from_table():
+    return [
+        {
+            "rank": rank,
+            "action": item.display_action,
+            "place": item.display_place,
+            "adoption_count": item.adoption_count,
+            "recent_count": item.recent_count,
+            "score": item.score,
+        }
+        for rank, item in enumerate(
+            PopularHabit.objects.order_by("-score", "id")[
+                : settings.POPULAR_HABITS_LIMIT
+            ],
+            start=1,
+        )
+    ]
+
+
+def get_popular_habits():
+    """
+    Возвращает верхнюю часть рейтинга из кэша, при промахе - из таблицы.
+    """
+    top = cache.get(CACHE_KEY)
+    if top is None:
+        top = _top_from_table()
+        cache.set(CACHE_KEY, top, None)
+    return top
@@ -0,0 +1,160 @@
+"""
+Профилирование отдельных запросов по подписанному заголовку X-Profile.
+
+Заголовок выдается командой ``manage.py profiling_token <username>`` только
+для сотрудников (is_staff). Запросы без заголовка проходят middleware
+без дополнительной работы.
+"""
+
+import cProfile
+import io
+import pstats
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import signing
+from django.db import connections
+from django.http import FileResponse, Http404
+from django.urls import reverse
+from drf_spectacular.utils import extend_schema
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
+
+HEADER = "HTTP_X_PROFILE"
+SALT = "habits.profiling"
+TOP_FUNCTIONS = 60
+
+
+def make_profiling_token(user):
+    """
+    Возвращает значение заголовка X-Profile для сотрудника.
+    """
+    return signing.TimestampSigner(salt=SALT).sign(str(user.pk))
+
+
+def _staff_from_token(token):
+    try:
+        user_id = signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=settings.PROFILING_TOKEN_MAX_AGE
+        )
+    except signing.BadSignature:
+        return None
+    return User.objects.filter(pk=user_id, is_staff=True, is_active=True).first()
+
+
+def _profile_dir():
+    path = Path(settings.PROFILING_DIR)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class SQLCapture:
+    """
+    Обертка execute_wrapper, сохраняющая выполненные SQL-запросы и их время.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((time.perf_counter() - start, sql, params))
+
+
+class ProfilingMiddleware:
+    """
+    Профилирует запрос с помощью cProfile, если он содержит действительный
+    заголовок X-Profile сотрудника.
+
+    Отчет (дерево вызовов и SQL) сохраняется в PROFILING_DIR, ссылка на него
+    возвращается в заголовке X-Profile-URL.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = request.META.get(HEADER)
+        if not token:
+            return self.get_response(request)
+        staff = _staff_from_token(token)
+        if staff is None:
+            return self.get_response(request)
+        return self._profile(request, staff)
+
+    def _profile(self, request, staff):
+        profiler = cProfile.Profile()
+        capture = SQLCapture()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(capture))
+            start = time.perf_counter()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Другой профилировщик уже активен в этом потоке
+                profiler = None
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+                total = time.perf_counter() - start
+        if profiler is None:
+            return response
+
+        profile_id = uuid.uuid4()
+        directory = _profile_dir()
+        profiler.dump_stats(directory / f"{profile_id.hex}.prof")
+        report = self._report(request, response, staff, profiler, capture, total)
+        (directory / f"{profile_id.hex}.txt").write_text(report, encoding="utf-8")
+        response["X-Profile-URL"] = request.build_absolute_uri(
+            reverse("profile-report", args=[profile_id])
+        )
+        return response
+
+    @staticmethod
+    def _report(request, response, staff, profiler, capture, total):
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+        sql_time = sum(duration for duration, _, _ in capture.queries)
+        lines = [
+            f"{request.method} {request.get_full_path()} -> {response.status_code}",
+            f"Profiled by: {staff.username}",
+            f"Total: {total * 1000:.2f} ms",
+            f"SQL: {len(capture.queries)} queries, {sql_time * 1000:.2f} ms",
+            "",
+            "== Call tree (cumulative) ==",
+            stream.getvalue(),
+            "== SQL ==",
+        ]
+        for duration, sql, params in capture.queries:
+            lines.append(f"[{duration * 1000:.2f} ms] {sql} {params!r}")
+        return "\n".join(lines) + "\n"
+
+
+@extend_schema(exclude=True)
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def profile_report(request, profile_id):
+    """
+    Отдает отчет профилирования. С параметром ``raw=1`` отдает файл cProfile
+    для просмотра во внешних инструментах (snakeviz, flameprof).
+    """
+    raw = request.query_params.get("raw") == "1"
+    path = Path(settings.PROFILING_DIR) / (
+        f"{profile_id.hex}.prof" if raw else f"{profile_id.hex}.txt"
+    )
+    if not path.exists():
+        raise Http404
+    if raw:
+        return FileResponse(path.open("rb"), as_attachment=True, filename=path.name)
+    return FileResponse(path.open("rb"), content_type="text/plain; charset=utf-8")
@@ -0,0 +1,343 @@
+"""
+Доставка событий пользователям через Server-Sent Events.
+
+Напоминания и изменения привычек публикуются в общий канал Redis pub/sub
+(PUSH_CHANNEL) и в короткую историю пользователя (Redis Stream с
+SSE_HISTORY_SIZE последними событиями). Каждый ASGI-процесс держит одну
+подписку на канал и раздает события открытым соединениям своих
+пользователей через очереди asyncio, поэтому соединения в ожидании не
+обращаются ни к Redis, ни к БД.
+
+Клиент, переподключившийся с заголовком Last-Event-ID, получает
+пропущенные события из истории. Если подписка процесса прерывается или
+клиент не успевает читать события, соединение закрывается, и клиент
+догоняет пропущенное тем же способом.
+
+EventSource в браузере не передает заголовки, поэтому соединение
+открывается по одноразовому билету (make_ticket), который действует
+SSE_TICKET_TTL секунд. Токен доступа в URL не попадает.
+
+Без SSE_REDIS_URL история и раздача работают в памяти процесса.
+"""
+
+import asyncio
+import json
+import logging
+import re
+import secrets
+import threading
+from collections import defaultdict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .events import LocalStream, parse_id
+
+logger = logging.getLogger(__name__)
+
+PUSH_CHANNEL = "habits:push"
+HISTORY_KEY = "habits:push:user:{}"
+TICKET_KEY = "habits:push:ticket:{}"
+EVENT_ID = re.compile(r"^\d+-\d+$")
+# Очередь соединения закрывается этим значением
+CLOSE = None
+
+
+class Hub:
+    """
+    Раздача событий соединениям процесса по пользователям.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._listeners = defaultdict(set)
+        self._reader = None
+
+    def subscribe(self, user_id):
+        """
+        Регистрирует соединение пользователя и возвращает его очередь.
+        Вызывается из цикла событий ASGI-сервера.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._loop is not loop:
+                # Соединения старого цикла (например, в тестах) уже закрыты
+                self._loop = loop
+                self._listeners.clear()
+                self._reader = None
+            queue = asyncio.Queue(maxsize=settings.SSE_QUEUE_SIZE)
+            self._listeners[user_id].add(queue)
+        backend = get_backend()
+        if self._reader is None and backend.subscribes:
+            self._reader = loop.create_task(backend.listen(self))
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        with self._lock:
+            listeners = self._listeners.get(user_id)
+            if listeners is not None:
+                listeners.discard(queue)
+                if not listeners:
+                    del self._listeners[user_id]
+
+    def connections(self):
+        with self._lock:
+            return sum(len(queues) for queues in self._listeners.values())
+
+    def dispatch(self, message):
+        """
+        Передает событие соединениям из любого потока.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        if loop is _running_loop():
+            self.deliver(message)
+        else:
+            loop.call_soon_threadsafe(self.deliver, message)
+
+    def deliver(self, message):
+        with self._lock:
+            queues = list(self._listeners.get(message["user_id"], ()))
+        for queue in queues:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Клиент не успевает читать: соединение закрывается, и клиент
+                # догонит события из истории по Last-Event-ID
+                _close(queue)
+
+    def disconnect_all(self):
+        with self._lock:
+            queues = [queue for queues in self._listeners.values() for queue in queues]
+        for queue in queues:
+            _close(queue)
+
+
+def make_ticket(user_id):
+    """
+    Создает одноразовый билет для подключения пользователя к потоку
+    событий, действующий SSE_TICKET_TTL секунд.
+    """
+    ticket = secrets.token_urlsafe(24)
+    cache.set(TICKET_KEY.format(ticket), user_id, settings.SSE_TICKET_TTL)
+    return ticket
+
+
+def consume_ticket(ticket):
+    """
+    Возвращает id пользователя билета и делает билет недействительным.
+    """
+    key = TICKET_KEY.format(ticket)
+    user_id = cache.get(key)
+    # Удаление атомарно, поэтому из одновременных подключений билет
+    # использует одно
+    if user_id is None or not cache.delete(key):
+        return None
+    return user_id
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def _close(queue):
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(CLOSE)
+
+
+hub = Hub()
+
+
+class LocalBackend:
+    """
+    История и раздача событий в памяти процесса.
+    """
+
+    subscribes = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._history = {}
+
+    def _stream(self, user_id):
+        with self._lock:
+            if user_id not in self._history:
+                self._history[user_id] = LocalStream(maxlen=settings.SSE_HISTORY_SIZE)
+            return self._history[user_id]
+
+    def publish(self, messages):
+        for message in messages:
+            payload = json.dumps([message["event"], message["data"]])
+            message["id"] = self._stream(message["user_id"]).add([payload])[0]
+            hub.dispatch(message)
+
+    async def history(self, user_id, after):
+        return [
+            _history_message(user_id, entry_id, payload)
+            for entry_id, payload in self._stream(user_id).range(
+                after, settings.SSE_HISTORY_SIZE
+            )
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._history.clear()
+
+
+class RedisBackend:
+    """
+    История в Redis Streams и раздача через Redis pub/sub.
+    """
+
+    subscribes = True
+
+    def __init__(self, url):
+        self.url = url
+        self._client = None
+        self._async_clients = {}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis
+
+            self._client = redis.Redis.from_url(self.url, decode_responses=True)
+        return self._client
+
+    def async_client(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._async_clients:
+            import redis.asyncio
+
+            self._async_clients = {
+                loop: redis.asyncio.Redis.from_url(self.url, decode_responses=True)
+            }
+        return self._async_clients[loop]
+
+    def publish(self, messages):
+        pipe = self.client.pipeline(transaction=False)
+        for message in messages:
+            key = HISTORY_KEY.format(message["user_id"])
+            pipe.xadd(
+                key,
+                {"payload": json.dumps([message["event"], message["data"]])},
+                maxlen=settings.SSE_HISTORY_SIZE,
+                approximate=True,
+            )
+            pipe.expire(key, settings.SSE_HISTORY_TTL)
+        ids = pipe.execute()[::2]
+        pipe = self.client.pipeline(transaction=False)
+        for message, entry_id in zip(messages, ids):
+            pipe.publish(PUSH_CHANNEL, json.dumps({**message, "id": entry_id}))
+        pipe.execute()
+
+    async def history(self, user_id, after):
+        entries = await self.async_client().xrange(
+            HISTORY_KEY.format(user_id), f"({after}", "+", settings.SSE_HISTORY_SIZE
+        )
+        return [
+            _history_message(user_id, entry_id, fields["payload"])
+            for entry_id, fields in entries
+        ]
+
+    async def listen(self, target):
+        """
+        Держит единственную подписку процесса на канал событий.
+        """
+        while True:
+            try:
+                async with self.async_client().pubsub() as pubsub:
+                    await pubsub.subscribe(PUSH_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            target.deliver(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning("Подписка на события прервана, переподключение")
+            # События, пришедшие без подписки, клиенты получат из истории
+            target.disconnect_all()
+            await asyncio.sleep(1)
+
+
+def _history_message(user_id, entry_id, payload):
+    event, data = json.loads(payload)
+    return {"id": entry_id, "user_id": user_id, "event": event, "data": data}
+
+
+@lru_cache(maxsize=4)
+def _backend_for(url):
+    return RedisBackend(url) if url else LocalBackend()
+
+
+def get_backend():
+    return _backend_for(settings.SSE_REDIS_URL)
+
+
+def publish(messages):
+    """
+    Публикует события пользователям. messages - словари с ключами
+    user_id, event и data. Ошибки Redis не прерывают вызывающий код.
+    """
+    messages = [
+        {
+            "user_id": message["user_id"],
+            "event": message["event"],
+            "data": json.loads(json.dumps(message["data"], cls=DjangoJSONEncoder)),
+        }
+        for message in messages
+    ]
+    if not messages:
+        return
+    try:
+        get_backend().publish(messages)
+    except Exception:
+        logger.warning("Не удалось опубликовать %d событий SSE", len(messages))
+
+
+def format_event(message):
+    data = json.dumps(message["data"], ensure_ascii=False)
+    return f"id: {message['id']}\nevent: {message['event']}\ndata: {data}\n\n"
+
+
+async def stream(user_id, last_event_id=None):
+    """
+    Отдает события пользователя в формате text/event-stream, начиная с
+    пропущенных после last_event_id.
+    """
+    if last_event_id is not None and not EVENT_ID.match(last_event_id):
+        last_event_id = None
+    # Подписка до чтения истории, чтобы не пропустить события между ними
+    queue = hub.subscribe(user_id)
+    try:
+        yield f"retry: {settings.SSE_RETRY_MS}\n\n"
+        sent = None
+        if last_event_id is not None:
+            sent = parse_id(last_event_id)
+            for message in await get_backend().history(user_id, last_event_id):
+                sent = parse_id(message["id"])
+                yield format_event(message)
+        while True:
+            try:
+                async with asyncio.timeout(settings.SSE_HEARTBEAT):
+                    message = await queue.get()
+            except TimeoutError:
+                yield ": ping\n\n"
+                continue
+            if message is CLOSE:
+                return
+            entry_id = parse_id(message["id"])
+            if sent is not None and entry_id <= sent:
+                continue
+            sent = entry_id
+            yield format_event(message)
+    finally:
+        hub.unsubscribe(user_id, queue)
@@ -0,0 +1,438 @@
+"""
+Рекомендации похожих публичных привычек.
+
+Действие и место привычки разбиваются на слова и символьные триграммы,
+которые хешируются в вектор длины DIMENSIONS с весами TF-IDF. Нормированные
+векторы публичных привычек хранятся в файле .npy и открываются через
+np.memmap: индекс не загружается в память процесса целиком, а страницы
+файла общие для всех процессов на сервере. Поиск - скалярные произведения
+запроса с блоками матрицы и выбор top-k в каждом блоке.
+
+Индекс строится командой ``manage.py build_recommendations`` и обновляется
+периодической задачей refresh_recommendations: измененные с прошлого
+запуска привычки перезаписываются или добавляются в конец файла, снятые
+с публикации исключаются из выдачи. Значения IDF фиксируются при полной
+перестройке, она выполняется, когда заканчивается место в файле или число
+документов выросло больше чем в REBUILD_GROWTH раз. Удаленные привычки
+остаются в индексе до перестройки и отсеиваются при чтении из БД. Индекс
+строится по публичным привычкам всех шардов: id привычек уникальны между
+шардами.
+"""
+
+import json
+import os
+import re
+import time
+import uuid
+import zlib
+from datetime import timedelta
+from itertools import chain
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Habit
+from .sharding import scatter, sharded
+
+DIMENSIONS = 512
+DTYPE = np.float32
+PLACE_WEIGHT = 0.5
+ROWS_PER_BLOCK = 16384
+MIN_CAPACITY = 1024
+CAPACITY_FACTOR = 2
+REBUILD_GROWTH = 1.5
+BUILD_BATCH = 2000
+META_FILE = "index.json"
+# Изменения, закоммиченные во время прошлого обновления, могут иметь
+# updated_at чуть раньше его отметки, поэтому окно берется с запасом
+REFRESH_OVERLAP = timedelta(minutes=1)
+# Файлы прошлых версий удаляются не сразу: их могут читать другие процессы
+STALE_FILE_AGE = 600
+# Сколько лишних кандидатов берется на случай удаленных привычек
+CANDIDATE_MARGIN = 10
+
+
+def _features(text):
+    words = re.findall(r"\w+", text.lower())
+    features = list(words)
+    for word in words:
+        padded = f" {word} "
+        features.extend(map("".join, zip(padded, padded[1:], padded[2:])))
+    return features
+
+
+def _term_counts(action, place):
+    counts = {}
+    for text, weight in ((action, 1.0), (place, PLACE_WEIGHT)):
+        for feature in _features(text):
+            column = zlib.crc32(feature.encode()) % DIMENSIONS
+            counts[column] = counts.get(column, 0.0) + weight
+    return counts
+
+
+def term_frequencies(texts):
+    """
+    Возвращает матрицу (len(texts), DIMENSIONS) сублинейных частот признаков
+    для списка пар (действие, место).
+    """
+    rows, columns, values = [], [], []
+    for row, (action, place) in enumerate(texts):
+        for column, count in _term_counts(action, place).items():
+            rows.append(row)
+            columns.append(column)
+            values.append(count)
+    matrix = np.zeros((len(texts), DIMENSIONS), dtype=DTYPE)
+    matrix[rows, columns] = np.log1p(values)
+    return matrix
+
+
+def inverse_document_frequencies(document_frequencies, documents):
+    return (
+        np.log((1 + documents) / (1 + np.asarray(document_frequencies))) + 1
+    ).astype(DTYPE)
+
+
+def _normalize(matrix, idf):
+    matrix *= idf
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix
+
+
+def vectorize(texts, idf):
+    """
+    Возвращает нормированные векторы TF-IDF для списка пар (действие, место).
+    """
+    return _normalize(term_frequencies(texts), idf)
+
+
+def _top(scores, rows, k):
+    if scores.shape[1] <= k:
+        return scores, rows
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(scores, part, axis=1), np.take_along_axis(
+        rows, part, axis=1
+    )
+
+
+class RecommendationIndex:
+    """
+    Индекс, открытый только для чтения.
+    """
+
+    def __init__(self, directory, meta):
+        self.meta = meta
+        self.count = meta["count"]
+        self.idf = np.load(directory / meta["idf"])
+        with np.load(directory / meta["rows"]) as rows:
+            self.ids = rows["ids"]
+            self.pleasant = rows["pleasant"]
+            self.live = rows["live"]
+        self.vectors = np.load(directory / meta["vectors"], mmap_mode="r")
+
+    def search(self, queries, k, masks=(None,)):
+        """
+        Ищет k ближайших по косинусу привычек для каждого вектора запроса.
+
+        Для каждой маски строк из masks возвращает список по запросам
+        из пар (id привычки, сходство), начиная с самых похожих.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=DTYPE))
+        masks = [self.live if mask is None else self.live & mask for mask in masks]
+        empty = (
+            np.empty((len(queries), 0), dtype=DTYPE),
+            np.empty((len(queries), 0), dtype=np.int64),
+        )
+        best = [empty] * len(masks)
+        for start in range(0, self.count, ROWS_PER_BLOCK):
+            stop = min(start + ROWS_PER_BLOCK, self.count)
+            scores = queries @ self.vectors[start:stop].T
+            rows = np.broadcast_to(np.arange(start, stop), scores.shape)
+            for position, mask in enumerate(masks):
+                masked = np.where(mask[start:stop], scores, -np.inf)
+                best_scores, best_rows = best[position]
+                best[position] = _top(
+                    np.concatenate([best_scores, masked], axis=1),
+                    np.concatenate([best_rows, rows], axis=1),
+                    k,
+                )
+        results = []
+        for scores, rows in best:
+            order = np.argsort(-scores, axis=1, kind="stable")
+            scores = np.take_along_axis(scores, order, axis=1)
+            rows = np.take_along_axis(rows, order, axis=1)
+            results.append(
+                [
+                    [
+                        (int(self.ids[row]), float(score))
+                        for score, row in zip(query_scores, query_rows)
+                        if score > 0
+                    ]
+                    for query_scores, query_rows in zip(scores, rows)
+                ]
+            )
+        return results
+
+
+def _directory():
+    return Path(settings.RECOMMENDATIONS_DIR)
+
+
+def _read_meta(directory):
+    try:
+        return json.loads((directory / META_FILE).read_text())
+    except FileNotFoundError:
+        return None
+
+
+def _write_meta(directory, meta):
+    meta = dict(meta, revision=uuid.uuid4().hex)
+    tmp = directory / f"{META_FILE}.{meta['revision']}.tmp"
+    tmp.write_text(json.dumps(meta))
+    os.replace(tmp, directory / META_FILE)
+    _remove_stale_files(directory, meta)
+    return meta
+
+
+def _remove_stale_files(directory, meta):
+    used = {meta["vectors"], meta["idf"], meta["rows"], META_FILE}
+    threshold = time.time() - STALE_FILE_AGE
+    for path in directory.iterdir():
+        if path.name not in used and path.stat().st_mtime < threshold:
+            path.unlink(missing_ok=True)
+
+
+def _write_rows(directory, ids, pleasant, live):
+    name = f"rows-{uuid.uuid4().hex}.npz"
+    with open(directory / name, "wb") as file:
+        np.savez(file, ids=ids, pleasant=pleasant, live=live)
+    return name
+
+
+_loaded = {"key": None, "index": None}
+
+
+def get_index():
+    """
+    Возвращает текущий индекс или None, если он еще не построен.
+
+    Индекс открывается заново, только когда обновление записало новую версию.
+    """
+    directory = _directory()
+    meta = _read_meta(directory)
+    if meta is None:
+        return None
+    key = (str(directory), meta["revision"])
+    if _loaded["key"] != key:
+        _loaded["index"] = RecommendationIndex(directory, meta)
+        _loaded["key"] = key
+    return _loaded["index"]
+
+
+def _batches(iterator, size):
+    batch = []
+    for item in iterator:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def build_index(directory, rows, count, since):
+    """
+    Строит новую версию индекса из count строк (id, действие, место, приятная).
+
+    Частоты признаков пишутся в файл за один проход по строкам, затем
+    блоки матрицы взвешиваются IDF и нормируются на месте.
+    """
+    directory.mkdir(parents=True, exist_ok=True)
+    capacity = max(MIN_CAPACITY, count * CAPACITY_FACTOR)
+    vectors_name = f"vectors-{uuid.uuid4().hex}.npy"
+    vectors = np.lib.format.open_memmap(
+        directory / vectors_name, mode="w+", dtype=DTYPE, shape=(capacity, DIMENSIONS)
+    )
+    ids = np.zeros(capacity, dtype=np.int64)
+    pleasant = np.zeros(capacity, dtype=bool)
+    document_frequencies = np.zeros(DIMENSIONS, dtype=np.int64)
+    filled = 0
+    for batch in _batches(rows, BUILD_BATCH):
+        batch = batch[: capacity - filled]
+        if not batch:
+            break
+        stop = filled + len(batch)
+        matrix = term_frequencies([(action, place) for _, action, place, _ in batch])
+        document_frequencies += np.count_nonzero(matrix, axis=0)
+        vectors[filled:stop] = matrix
+        ids[filled:stop] = [row[0] for row in batch]
+        pleasant[filled:stop] = [row[3] for row in batch]
+        filled = stop
+    idf = inverse_document_frequencies(document_frequencies, filled)
+    for start in range(0, filled, ROWS_PER_BLOCK):
+        stop = min(start + ROWS_PER_BLOCK, filled)
+        vectors[start:stop] = _normalize(np.array(vectors[start:stop]), idf)
+    vectors.flush()
+    del vectors
+
+    idf_name = f"idf-{uuid.uuid4().hex}.npy"
+    np.save(directory / idf_name, idf)
+    live = np.arange(capacity) < filled
+    return _write_meta(
+        directory,
+        {
+            "dimensions": DIMENSIONS,
+            "count": filled,
+            "capacity": capacity,
+            "documents": filled,
+            "since": since.isoformat(),
+            "vectors": vectors_name,
+            "idf": idf_name,
+            "rows": _write_rows(directory, ids, pleasant, live),
+        },
+    )
+
+
+def rebuild_index():
+    """
+    Полностью перестраивает индекс по всем публичным привычкам.
+    """
+    since = timezone.now()
+    count = sum(
+        scatter(lambda alias: sharded(Habit, alias).filter(is_public=True).count())
+    )
+    # Шарды читаются по очереди, каждый - курсором порциями
+    rows = chain.from_iterable(
+        sharded(Habit, alias)
+        .filter(is_public=True)
+        .order_by("id")
+        .values_list("id", "action", "place", "is_pleasant")
+        .iterator(chunk_size=BUILD_BATCH)
+        for alias in settings.HABIT_SHARDS
+    )
+    return build_index(_directory(), rows, count, since)
+
+
+def refresh_index(full=False):
+    """
+    Обновляет индекс привычками, измененными с прошлого обновления.
+
+    Строит индекс заново, если его нет, если передан full или если новые
+    привычки не помещаются в файл либо заметно меняют статистику IDF.
+    Возвращает количество обработанных привычек.
+    """
+    directory = _directory()
+    meta = _read_meta(directory)
+    if full or meta is None or meta["dimensions"] != DIMENSIONS:
+        return rebuild_index()["count"]
+
+    since = timezone.now()
+    changed_since = parse_datetime(meta["since"]) - REFRESH_OVERLAP
+    changed = sorted(
+        chain.from_iterable(
+            scatter(
+                lambda alias: list(
+                    sharded(Habit, alias)
+                    .filter(updated_at__gt=changed_since)
+                    .values_list("id", "action", "place", "is_pleasant", "is_public")
+                )
+            )
+        )
+    )
+    if not changed:
+        return 0
+
+    count, capacity = meta["count"], meta["capacity"]
+    with np.load(directory / meta["rows"]) as stored:
+        ids = stored["ids"].copy()
+        pleasant = stored["pleasant"].copy()
+        live = stored["live"].copy()
+    changed_ids = np.array([row[0] for row in changed], dtype=np.int64)
+    positions = np.full(len(changed), -1)
+    if count:
+        indexed = ids[:count]
+        order = np.argsort(indexed, kind="stable")
+        found = order[
+            np.minimum(np.searchsorted(indexed, changed_ids, sorter=order), count - 1)
+        ]
+        hit = indexed[found] == changed_ids
+        positions[hit] = found[hit]
+
+    public_rows = []
+    for (habit_id, action, place, is_pleasant, is_public), position in zip(
+        changed, positions
+    ):
+        if is_public:
+            if position < 0:
+                position = count
+                count += 1
+            public_rows.append((position, habit_id, action, place, is_pleasant))
+        elif position >= 0:
+            live[position] = False
+
+    if count > capacity or count > meta["documents"] * REBUILD_GROWTH:
+        return rebuild_index()["count"]
+
+    if public_rows:
+        idf = np.load(directory / meta["idf"])
+        vectors = np.load(directory / meta["vectors"], mmap_mode="r+")
+        rows = np.array([row[0] for row in public_rows])
+        # Новые строки пишутся за пределы count и не видны читателям до
+        # записи метаданных; измененные строки перезаписываются на месте
+        vectors[rows] = vectorize([(row[2], row[3]) for row in public_rows], idf)
+        vectors.flush()
+        del vectors
+        ids[rows] = [row[1] for row in public_rows]
+        pleasant[rows] = [row[4] for row in public_rows]
+        live[rows] = True
+
+    _write_meta(
+        directory,
+        dict(
+            meta,
+            count=count,
+            since=since.isoformat(),
+            rows=_write_rows(directory, ids, pleasant, live),
+        ),
+    )
+    return len(changed)
+
+
+def recommend(action, place, limit):
+    """
+    Возвращает (похожие публичные привычки, приятные привычки для связи)
+    для текста новой привычки. У привычек заполнен атрибут similarity.
+    """
+    index = get_index()
+    if index is None:
+        return [], []
+    query = vectorize([(action, place)], index.idf)
+    similar, related = index.search(
+        query, limit + CANDIDATE_MARGIN, masks=(None, index.pleasant)
+    )
+    candidate_ids = [habit_id for habit_id, _ in similar[0] + related[0]]
+    habits = {
+        habit.id: habit
+        for candidates in scatter(
+            lambda alias: list(
+                sharded(Habit, alias).filter(id__in=candidate_ids, is_public=True)
+            )
+        )
+        for habit in candidates
+    }
+    results = []
+    for matches, pleasant_only in ((similar[0], False), (related[0], True)):
+        found = []
+        for habit_id, score in matches:
+            habit = habits.get(habit_id)
+            if habit is None or (pleasant_only and not habit.is_pleasant):
+                continue
+            habit.similarity = score
+            found.append(habit)
+            if len(found) == limit:
+                break
+        results.append(found)
+    return results[0], results[1]
@@ -0,0 +1,218 @@
+"""
+Маршрутизация запросов к БД между основной базой и репликами.
+
+Запись всегда идет в основную базу, чтение - в одну из реплик из
+DATABASE_REPLICAS. Реплика, которая не отвечает или отстает больше чем на
+REPLICA_MAX_LAG секунд, исключается из выбора до следующей проверки.
+Если подходящих реплик нет, чтение идет в основную базу.
+
+Чтобы пользователь видел свои изменения, после запроса с записью его
+чтения на REPLICA_PIN_SECONDS закрепляются за основной базой: клиенту
+ставится cookie, а в кэше - отметка для пользователя, которая действует
+и для запросов с других устройств.
+"""
+
+import logging
+import random
+import threading
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+PRIMARY = DEFAULT_DB_ALIAS
+PIN_COOKIE = "db_pin"
+PIN_KEY = "habits:db-pin:{}"
+# Приложения, которые всегда читаются из основной базы
+PRIMARY_APPS = {"sessions"}
+
+POSTGRES_LAG_SQL = (
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class RoutingState:
+    """
+    Состояние маршрутизации текущего запроса.
+    """
+
+    __slots__ = ("pinned", "wrote")
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar("habits_db_routing", default=None)
+
+
+def pin_user(user_id):
+    cache.set(PIN_KEY.format(user_id), True, settings.REPLICA_PIN_SECONDS)
+
+
+def is_user_pinned(user_id):
+    return bool(cache.get(PIN_KEY.format(user_id)))
+
+
+def measure_lag(connection):
+    """
+    Возвращает отставание реплики в секундах.
+
+    Для PostgreSQL используется время последней примененной транзакции,
+    для остальных СУБД проверяется только доступность.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(POSTGRES_LAG_SQL)
+            return float(cursor.fetchone()[0] or 0)
+        cursor.execute("SELECT 1")
+    return 0.0
+
+
+class ReplicaHealth:
+    """
+    Результаты проверок реплик в процессе, не старше REPLICA_CHECK_INTERVAL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checks = {}
+
+    def available(self):
+        """
+        Возвращает реплики, которые отвечают и отстают не больше допустимого.
+        """
+        now = time.monotonic()
+        result = []
+        for alias in settings.DATABASE_REPLICAS:
+            with self._lock:
+                checked = self._checks.get(alias)
+            if checked is None or now - checked[0] >= settings.REPLICA_CHECK_INTERVAL:
+                checked = (now, self._check(alias))
+                with self._lock:
+                    self._checks[alias] = checked
+            lag = checked[1]
+            if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+                result.append(alias)
+        return result
+
+    @staticmethod
+    def _check(alias):
+        connection = connections[alias]
+        try:
+            lag = measure_lag(connection)
+        except DatabaseError:
+            logger.warning("Реплика %s недоступна", alias)
+            connection.close()
+            return None
+        if lag > settings.REPLICA_MAX_LAG:
+            logger.warning("Реплика %s отстает на %.1f с", alias, lag)
+        return lag
+
+    def reset(self):
+        with self._lock:
+            self._checks.clear()
+
+
+health = ReplicaHealth()
+
+
+class PrimaryReplicaRouter:
+    """
+    Роутер, отправляющий чтение в реплики, а запись - в основную базу.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS:
+            return None
+        if model._meta.app_label in PRIMARY_APPS:
+            return PRIMARY
+        state = _state.get()
+        if state is not None and state.pinned:
+            return PRIMARY
+        # Внутри транзакции основной базы реплика не видит ее изменений
+        if connections[PRIMARY].in_atomic_block:
+            return PRIMARY
+        replicas = health.available()
+        return random.choice(replicas) if replicas else PRIMARY
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+            state.pinned = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {PRIMARY, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема реплик приходит из основной базы через репликацию
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+def _user_id(request):
+    user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return user.pk
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, TokenError
+    from rest_framework_simplejwt.settings import api_settings
+
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        token = authentication.get_validated_token(raw_token)
+    except (InvalidToken, TokenError):
+        return None
+    return token.get(api_settings.USER_ID_CLAIM)
+
+
+class ReplicaPinningMiddleware:
+    """
+    Закрепляет чтение за основной базой после запросов с записью.
+
+    Пользователь определяется по сессии или по JWT без обращения к БД.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        pinned = PIN_COOKIE in request.COOKIES
+        if not pinned:
+            user_id = _user_id(request)
+            pinned = user_id is not None and is_user_pinned(user_id)
+        state = RoutingState(pinned)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote:
+            response.set_cookie(
+                PIN_COOKIE,
+                "1",
+                max_age=settings.REPLICA_PIN_SECONDS,
+                httponly=True,
+                samesite="Lax",
+            )
+            user_id = _user_id(request)
+            if user_id is not None:
+                pin_user(user_id)
+        return response
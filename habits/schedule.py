@@ -0,0 +1,148 @@
+"""
+Расписание привычек пользователя на диапазон дат.
+
+Привычка выполняется в день создания и далее каждые frequency дней в свое
+время time. Привычки без даты создания (созданные до появления поля
+created_at) отсчитываются от LEGACY_ANCHOR. Даты всех привычек считаются
+векторно: для каждой привычки находится первое выполнение в диапазоне и
+число выполнений, после чего все даты получаются одной операцией над
+массивами NumPy, без перебора привычек по дням.
+
+Результат кэшируется по версии набора привычек пользователя, которая
+меняется при любом сохранении или удалении его привычки.
+"""
+
+import uuid
+from datetime import date, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+from .models import Habit
+
+VERSION_KEY = "habits:schedule-version:{}"
+CACHE_KEY = "habits:schedule:{}:{}:{}:{}"
+LEGACY_ANCHOR = date(1970, 1, 1)
+
+
+def habit_set_version(user_id):
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        version = uuid.uuid4().hex
+        if not cache.add(key, version, None):
+            version = cache.get(key, version)
+    return version
+
+
+def bump_habit_set_version(user_id):
+    """
+    Делает недействительным кэш расписания пользователя.
+    """
+    cache.set(VERSION_KEY.format(user_id), uuid.uuid4().hex, None)
+
+
+class HabitArrays:
+    """
+    Привычки пользователя в виде массивов для расчета расписания.
+    """
+
+    def __init__(self, rows):
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.actions = [row[1] for row in rows]
+        self.places = [row[2] for row in rows]
+        self.times = [row[3] for row in rows]
+        self.seconds = np.array(
+            [time.hour * 3600 + time.minute * 60 + time.second for time in self.times],
+            dtype=np.int64,
+        )
+        self.frequencies = np.array([row[4] for row in rows], dtype=np.int64)
+        self.anchors = np.array(
+            [
+                timezone.localdate(row[5]) if row[5] is not None else LEGACY_ANCHOR
+                for row in rows
+            ],
+            dtype="datetime64[D]",
+        )
+
+    @classmethod
+    def for_user(cls, user):
+        return cls(
+            list(
+                Habit.objects.filter(user=user)
+                .order_by("id")
+                .values_list("id", "action", "place", "time", "frequency", "created_at")
+            )
+        )
+
+
+def project(habits, start, end):
+    """
+    Возвращает (индексы привычек, даты) выполнений в диапазоне [start, end),
+    отсортированные по дате, времени и id привычки.
+    """
+    start = np.datetime64(start, "D")
+    end = np.datetime64(end, "D")
+    elapsed = (start - habits.anchors).astype(np.int64)
+    # Первое выполнение не раньше start: сдвиг до ближайшего кратного frequency
+    skip = np.maximum(-(-elapsed // habits.frequencies), 0)
+    first = habits.anchors + skip * habits.frequencies
+    last_offset = (end - first).astype(np.int64) - 1
+    counts = np.where(last_offset >= 0, last_offset // habits.frequencies + 1, 0)
+
+    index = np.repeat(np.arange(len(counts)), counts)
+    steps = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    dates = first[index] + steps * habits.frequencies[index]
+    order = np.lexsort((habits.ids[index], habits.seconds[index], dates))
+    return index[order], dates[order]
+
+
+def _occurrences(habits, start, end):
+    index, dates = project(habits, start, end)
+    return [
+        {
+            "date": date,
+            "time": habits.times[position],
+            "habit": int(habits.ids[position]),
+            "action": habits.actions[position],
+            "place": habits.places[position],
+        }
+        for position, date in zip(index.tolist(), np.datetime_as_string(dates))
+    ]
+
+
+def get_schedule(user, start, days):
+    """
+    Возвращает выполнения привычек пользователя за days дней начиная с start.
+    """
+    key = CACHE_KEY.format(user.pk, habit_set_version(user.pk), start, days)
+    occurrences = cache.get(key)
+    if occurrences is None:
+        habits = HabitArrays.for_user(user)
+        occurrences = _occurrences(habits, start, start + timedelta(days=days))
+        cache.set(key, occurrences, settings.SCHEDULE_CACHE_TIMEOUT)
+    return occurrences
+
+
+def iter_schedule_json(user, start, days):
+    """
+    Отдает расписание за days дней массивом JSON по частям: даты считаются
+    окнами по SCHEDULE_STREAM_DAYS дней, поэтому длинный диапазон не
+    собирается в памяти целиком.
+    """
+    habits = HabitArrays.for_user(user)
+    encoder = DjangoJSONEncoder(ensure_ascii=False)
+    separator = "["
+    end = start + timedelta(days=days)
+    window = timedelta(days=settings.SCHEDULE_STREAM_DAYS)
+    while start < end:
+        stop = min(start + window, end)
+        items = [encoder.encode(item) for item in _occurrences(habits, start, stop)]
+        if items:
+            yield separator + ",".join(items)
+            separator = ","
+        start = stop
+    yield "[]" if separator == "[" else "]"
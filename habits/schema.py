@@ -0,0 +1,93 @@
+"""
+Раздача OpenAPI-схемы из заранее собранного файла.
+
+Файлы в форматах YAML и JSON собираются командой ``manage.py build_schema``
+при сборке образа. Формат выбирается, как в SpectacularAPIView, по
+параметру ?format= и заголовку Accept, по умолчанию отдается YAML. Если
+файлов нет, схема генерируется один раз на процесс и запоминается.
+"""
+
+import hashlib
+import json
+from pathlib import Path
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils import translation
+from django.utils.cache import patch_vary_headers
+from drf_spectacular.renderers import OpenApiYamlRenderer
+from drf_spectacular.settings import spectacular_settings
+from drf_spectacular.utils import extend_schema
+from drf_spectacular.views import SpectacularAPIView
+from rest_framework.utils.encoders import JSONEncoder
+
+_documents = {}
+
+
+def schema_artifact_path(format):
+    return Path(settings.OPENAPI_SCHEMA_DIR) / (
+        f"schema-{settings.SPECTACULAR_SETTINGS['VERSION']}.{format}"
+    )
+
+
+def generate_schema_documents():
+    """
+    Генерирует схему и возвращает ее во всех форматах: {формат: bytes}.
+    """
+    generator = spectacular_settings.DEFAULT_GENERATOR_CLASS()
+    with translation.override(settings.LANGUAGE_CODE):
+        schema = generator.get_schema(request=None, public=True)
+        content = json.dumps(schema, cls=JSONEncoder, ensure_ascii=False, indent=2)
+        return {
+            "yaml": OpenApiYamlRenderer().render(schema),
+            "json": content.encode("utf-8") + b"\n",
+        }
+
+
+def get_schema_document(format):
+    """
+    Возвращает пару (содержимое схемы в формате format, ETag).
+
+    Предпочитает собранный файл, иначе генерирует схему. Результат
+    запоминается до перезапуска процесса.
+    """
+    path = schema_artifact_path(format)
+    key = str(path)
+    if key not in _documents:
+        if path.exists():
+            content = path.read_bytes()
+        else:
+            content = generate_schema_documents()[format]
+        _documents[key] = (content, '"%s"' % hashlib.sha256(content).hexdigest())
+    return _documents[key]
+
+
+def clear_schema_cache():
+    _documents.clear()
+
+
+def _etag_matches(request, etag):
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in [tag.strip() for tag in header.split(",")]
+
+
+class SchemaArtifactView(SpectacularAPIView):
+    """
+    OpenAPI-схема из собранного файла с сильным ETag.
+    """
+
+    @extend_schema(exclude=True)
+    def get(self, request, *args, **kwargs):
+        # Формат уже выбран согласованием содержимого DRF в initial()
+        renderer = request.accepted_renderer
+        content, etag = get_schema_document(renderer.format)
+        if _etag_matches(request, etag):
+            response = HttpResponseNotModified()
+        else:
+            response = HttpResponse(content, content_type=request.accepted_media_type)
+        response["ETag"] = etag
+        response["Cache-Control"] = "public, no-cache"
+        patch_vary_headers(response, ["Accept"])
+        return response
@@ -0,0 +1,140 @@
+"""
+Полнотекстовый поиск по публичным привычкам.
+
+На PostgreSQL используется частичный GIN-индекс по to_tsvector('simple', ...)
+от action и place, на SQLite - таблица FTS5 habits_habit_fts, которую
+поддерживают триггеры. Оба индекса создаются миграцией 0003.
+
+SQLite пересоздает таблицу при изменении ее схемы и при этом теряет триггеры,
+поэтому после каждой миграции install_sqlite_search восстанавливает их.
+Миграция 0003 содержит свою копию SQL и не зависит от этого модуля.
+
+На обеих СУБД каждое слово запроса ищется по префиксу, слова объединяются
+через AND.
+"""
+
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connections
+from django.db.models import F, Q
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = "simple"
+
+# Выражение должно совпадать с выражением индекса из миграции 0003,
+# иначе PostgreSQL не сможет его использовать
+SEARCH_VECTOR = SearchVector("action", "place", config=SEARCH_CONFIG)
+
+FTS_TABLE = "habits_habit_fts"
+
+SQLITE_TRIGGERS = {
+    "habits_habit_fts_insert": (
+        "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_insert "
+        "AFTER INSERT ON habits_habit WHEN new.is_public BEGIN "
+        "INSERT INTO habits_habit_fts(rowid, action, place) "
+        "VALUES (new.id, new.action, new.place); END"
+    ),
+    "habits_habit_fts_delete": (
+        "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_delete "
+        "AFTER DELETE ON habits_habit WHEN old.is_public BEGIN "
+        "INSERT INTO habits_habit_fts(habits_habit_fts, rowid, action, place) "
+        "VALUES ('delete', old.id, old.action, old.place); END"
+    ),
+    # Удаление старой записи должно выполняться до вставки новой, поэтому
+    # оба шага находятся в одном триггере
+    "habits_habit_fts_update": (
+        "CREATE TRIGGER IF NOT EXISTS habits_habit_fts_update "
+        "AFTER UPDATE OF action, place, is_public ON habits_habit BEGIN "
+        "INSERT INTO habits_habit_fts(habits_habit_fts, rowid, action, place) "
+        "SELECT 'delete', old.id, old.action, old.place WHERE old.is_public; "
+        "INSERT INTO habits_habit_fts(rowid, action, place) "
+        "SELECT new.id, new.action, new.place WHERE new.is_public; END"
+    ),
+}
+
+
+def install_sqlite_search(connection):
+    """
+    Создает таблицу FTS5 и триггеры, если их нет, и заново заполняет индекс,
+    если какой-либо триггер отсутствовал.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+            (FTS_TABLE + "%",),
+        )
+        existing = {row[0] for row in cursor.fetchall()}
+        if existing >= set(SQLITE_TRIGGERS):
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            "action, place, content='habits_habit', content_rowid='id')"
+        )
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('delete-all')")
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE}(rowid, action, place) "
+            "SELECT id, action, place FROM habits_habit WHERE is_public"
+        )
+        for statement in SQLITE_TRIGGERS.values():
+            cursor.execute(statement)
+
+
+def _query_tokens(query):
+    return re.findall(r"\w+", query.lower())
+
+
+def _fts5_query(query):
+    return " ".join(f'"{token}"*' for token in _query_tokens(query))
+
+
+def _tsquery(query):
+    return " & ".join(f"'{token}':*" for token in _query_tokens(query))
+
+
+def search_order_key(habit):
+    """
+    Ключ сортировки результатов search_habits для слияния выдачи шардов.
+    """
+    return -getattr(habit, "rank", 0), habit.pk
+
+
+def search_habits(queryset, query):
+    """
+    Фильтрует публичные привычки по запросу и сортирует их по релевантности.
+    """
+    vendor = connections[queryset.db].vendor
+    if vendor == "postgresql":
+        tsquery = _tsquery(query)
+        if not tsquery:
+            return queryset.none()
+        search_query = SearchQuery(tsquery, config=SEARCH_CONFIG, search_type="raw")
+        return (
+            queryset.annotate(search=SEARCH_VECTOR)
+            .filter(search=search_query)
+            .annotate(rank=SearchRank(SEARCH_VECTOR, search_query))
+            .order_by("-rank", "id")
+        )
+    if vendor == "sqlite":
+        match = _fts5_query(query)
+        if not match:
+            return queryset.none()
+        return (
+            queryset.filter(
+                id__in=RawSQL(
+                    f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                    (match,),
+                )
+            )
+            .annotate(
+                rank=RawSQL(
+                    f"SELECT -bm25({FTS_TABLE}) FROM {FTS_TABLE} "
+                    f"WHERE {FTS_TABLE} MATCH %s AND rowid = habits_habit.id",
+                    (match,),
+                )
+            )
+            .order_by(F("rank").desc(), "id")
+        )
+    return queryset.filter(
+        Q(action__icontains=query) | Q(place__icontains=query)
+    ).order_by("id")
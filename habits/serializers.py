@@ -1,17 +1,73 @@
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.utils import timezone
+from drf_spectacular.utils import extend_schema_field
 from rest_framework import serializers
-from .models import Habit
 
+from .metrics import serializer_timer
+from .models import Habit, HabitCompletion, UserProfile
+from .notifications import UnsafeWebhookURL, check_webhook_url
+from .sharding import is_sharded, scatter, sharded
 
-class HabitSerializer(serializers.ModelSerializer):
+
+class TimedSerializerMixin:
+    """
+    Учитывает время валидации и представления данных в метриках запроса.
+    """
+
+    def is_valid(self, *, raise_exception=False):
+        with serializer_timer():
+            return super().is_valid(raise_exception=raise_exception)
+
+    @property
+    def data(self):
+        with serializer_timer():
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, serializers.ListSerializer):
+    pass
+
+
+class RelatedHabitField(serializers.PrimaryKeyRelatedField):
+    """
+    Связанная привычка. При нескольких шардах ищется на всех: приятные
+    публичные привычки других пользователей хранятся на их шардах, а id
+    привычек уникальны между шардами.
+    """
+
+    def to_internal_value(self, data):
+        if not is_sharded():
+            return super().to_internal_value(data)
+        value = str(data)
+        if isinstance(data, bool) or not (value.isascii() and value.isdigit()):
+            self.fail("incorrect_type", data_type=type(data).__name__)
+        pk = int(value)
+        # id привычек хранятся в bigint
+        if pk < 2**63:
+            for found in scatter(
+                lambda alias: list(sharded(Habit, alias).filter(pk=pk))
+            ):
+                if found:
+                    return found[0]
+        self.fail("does_not_exist", pk_value=data)
+
+
+class HabitSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели Habit.
     """
 
+    current_streak = serializers.SerializerMethodField()
+    related_habit = RelatedHabitField(
+        queryset=Habit.objects.all(), required=False, allow_null=True
+    )
+
     class Meta:
         model = Habit
         fields = "__all__"
         read_only_fields = ("user",)
+        list_serializer_class = TimedListSerializer
 
     def validate(self, data):
         """
@@ -42,8 +98,86 @@ class HabitSerializer(serializers.ModelSerializer):
             )
         return data
 
+    @extend_schema_field(serializers.IntegerField())
+    def get_current_streak(self, obj):
+        return obj.active_streak(timezone.localdate())
+
+
+class HabitCompletionSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Сериализатор для отметки о выполнении привычки.
+    """
+
+    date = serializers.DateField(required=False)
+
+    class Meta:
+        model = HabitCompletion
+        fields = ("date", "created_at")
+        read_only_fields = ("created_at",)
+        list_serializer_class = TimedListSerializer
+
+    def validate_date(self, value):
+        if value > timezone.localdate():
+            raise serializers.ValidationError(
+                "Нельзя отметить выполнение привычки в будущем."
+            )
+        return value
+
+
+class PopularHabitSerializer(serializers.Serializer):
+    """
+    Сериализатор для записи рейтинга популярных привычек.
+    """
+
+    rank = serializers.IntegerField()
+    action = serializers.CharField()
+    place = serializers.CharField()
+    adoption_count = serializers.IntegerField()
+    recent_count = serializers.IntegerField()
+    score = serializers.FloatField()
+
+
+class RecommendedHabitSerializer(HabitSerializer):
+    """
+    Сериализатор для рекомендованной привычки со степенью сходства.
+    """
+
+    similarity = serializers.FloatField(read_only=True)
+
 
-class UserSerializer(serializers.ModelSerializer):
+class HabitRecommendationsSerializer(serializers.Serializer):
+    """
+    Сериализатор для рекомендаций к новой привычке.
+    """
+
+    similar = RecommendedHabitSerializer(many=True)
+    related = RecommendedHabitSerializer(many=True)
+
+
+class ScheduleQuerySerializer(serializers.Serializer):
+    """
+    Сериализатор для параметров запроса расписания.
+    """
+
+    start = serializers.DateField(required=False)
+    days = serializers.IntegerField(
+        required=False, default=7, min_value=1, max_value=settings.SCHEDULE_MAX_DAYS
+    )
+
+
+class ScheduleOccurrenceSerializer(serializers.Serializer):
+    """
+    Сериализатор для выполнения привычки в расписании.
+    """
+
+    date = serializers.DateField()
+    time = serializers.TimeField()
+    habit = serializers.IntegerField()
+    action = serializers.CharField()
+    place = serializers.CharField()
+
+
+class UserSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     """
     Сериализатор для модели User.
     """
@@ -64,3 +198,52 @@ class UserSerializer(serializers.ModelSerializer):
             password=validated_data["password"],
         )
         return user
+
+
+class NotificationSettingsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Сериализатор каналов уведомлений из профиля пользователя.
+    """
+
+    notification_channels = serializers.ListField(child=serializers.CharField())
+
+    class Meta:
+        model = UserProfile
+        fields = ("notification_channels", "telegram_chat_id", "webhook_url")
+        read_only_fields = ("telegram_chat_id",)
+
+    def validate_notification_channels(self, value):
+        unknown = sorted(set(value) - set(settings.NOTIFICATION_BACKENDS))
+        if unknown:
+            raise serializers.ValidationError(
+                f"Неизвестные каналы: {', '.join(unknown)}."
+            )
+        return list(dict.fromkeys(value))
+
+    def validate_webhook_url(self, value):
+        if value:
+            try:
+                check_webhook_url(value)
+            except UnsafeWebhookURL as error:
+                raise serializers.ValidationError(str(error))
+        return value
+
+    def validate(self, data):
+        """
+        Проверяет, что для выбранных каналов есть адреса.
+        """
+        channels = data.get(
+            "notification_channels", self.instance.notification_channels
+        )
+        webhook_url = data.get("webhook_url", self.instance.webhook_url)
+        if "webhook" in channels and not webhook_url:
+            raise serializers.ValidationError(
+                {"webhook_url": "Укажите адрес для канала webhook."}
+            )
+        if "email" in channels and not self.context["request"].user.email:
+            raise serializers.ValidationError(
+                {
+                    "notification_channels": "Для канала email укажите email пользователя."
+                }
+            )
+        return data
@@ -0,0 +1,408 @@
+"""
+Шардирование привычек и профилей по пользователям.
+
+Привычки (вместе с журналом выполнения) и профиль пользователя хранятся
+на одном из шардов HABIT_SHARDS. Новый пользователь получает шард по кольцу
+консистентного хеширования, назначение записывается в UserShard основной
+базы. Пользователи без записи (созданные до включения шардирования)
+находятся на первом шарде. Поэтому добавление шарда ничего не ломает:
+пользователи переносятся на назначенные кольцом шарды командой
+``manage.py rebalance_shards`` по одному, без остановки сервиса.
+
+Назначения кэшируются на SHARD_PLACEMENT_CACHE_TTL секунд. Если кэш не
+общий для процессов (SHARD_PLACEMENT_SHARED_CACHE выключен), перенос
+пользователя дополнительно ждет, пока устареют назначения в кэшах
+других процессов.
+
+Запросы к шардированным моделям направляет ShardRouter: объекты, уже
+загруженные из шарда, остаются в нем, остальные запросы идут в шард,
+выбранный контекстом use_shard. Без контекста и при одном шарде роутер
+не вмешивается. Чтения по всем пользователям (публичные привычки, поиск,
+рейтинг, рекомендации) обходят все шарды через scatter и ScatteredQuery.
+"""
+
+import bisect
+import hashlib
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from itertools import islice
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+SHARDED_MODELS = {"habits.habit", "habits.habitcompletion", "habits.userprofile"}
+VIRTUAL_NODES = 128
+PLACEMENT_KEY = "habits:user-shard:{}"
+# Каждый шард выдает id привычек из своего диапазона, чтобы привычки
+# сохраняли id при переносе между шардами
+ID_RANGE = 2**40
+
+_current_shard = ContextVar("habits_current_shard", default=None)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Кольцо консистентного хеширования с виртуальными узлами.
+
+    При добавлении узла на него переходит примерно 1/N ключей, остальные
+    ключи остаются на прежних узлах.
+    """
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (_hash(f"{node}#{number}"), node)
+            for node in nodes
+            for number in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key):
+        position = bisect.bisect(self._hashes, _hash(str(key)))
+        return self._nodes[position % len(self._nodes)]
+
+
+@lru_cache(maxsize=8)
+def _ring(shards):
+    return HashRing(shards)
+
+
+def ring():
+    return _ring(tuple(settings.HABIT_SHARDS))
+
+
+def is_sharded():
+    return len(settings.HABIT_SHARDS) > 1
+
+
+def placement(user_id):
+    """
+    Возвращает (шард, идет ли перенос) для пользователя.
+    """
+    if not is_sharded():
+        return settings.HABIT_SHARDS[0], False
+    key = PLACEMENT_KEY.format(user_id)
+    value = cache.get(key)
+    if value is None:
+        from .models import UserShard
+
+        row = (
+            UserShard.objects.using(DEFAULT_DB_ALIAS)
+            .filter(user_id=user_id)
+            .values_list("shard", "moving")
+            .first()
+        )
+        value = tuple(row) if row else (settings.HABIT_SHARDS[0], False)
+        cache.set(key, value, settings.SHARD_PLACEMENT_CACHE_TTL)
+    return value
+
+
+def shard_for_user(user_id):
+    return placement(user_id)[0]
+
+
+def set_placement(user_id, shard, moving=False):
+    from .models import UserShard
+
+    UserShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        user_id=user_id, defaults={"shard": shard, "moving": moving}
+    )
+    cache.set(
+        PLACEMENT_KEY.format(user_id),
+        (shard, moving),
+        settings.SHARD_PLACEMENT_CACHE_TTL,
+    )
+
+
+def assign_shard(user_id):
+    """
+    Назначает новому пользователю шард по кольцу и возвращает его.
+    """
+    if not is_sharded():
+        return settings.HABIT_SHARDS[0]
+    shard = ring().node_for(user_id)
+    set_placement(user_id, shard)
+    return shard
+
+
+def assign_shards(user_ids):
+    """
+    Назначает шарды пачке новых пользователей одним запросом.
+    Возвращает словарь {id пользователя: шард}.
+    """
+    if not is_sharded():
+        return dict.fromkeys(user_ids, settings.HABIT_SHARDS[0])
+    from .models import UserShard
+
+    hash_ring = ring()
+    shards = {user_id: hash_ring.node_for(user_id) for user_id in user_ids}
+    UserShard.objects.using(DEFAULT_DB_ALIAS).bulk_create(
+        [UserShard(user_id=user_id, shard=shard) for user_id, shard in shards.items()]
+    )
+    # При откате транзакции в кэше не должно остаться назначений
+    # несуществующих пользователей
+    transaction.on_commit(
+        lambda: cache.set_many(
+            {
+                PLACEMENT_KEY.format(user_id): (shard, False)
+                for user_id, shard in shards.items()
+            },
+            settings.SHARD_PLACEMENT_CACHE_TTL,
+        ),
+        using=DEFAULT_DB_ALIAS,
+    )
+    return shards
+
+
+@contextmanager
+def use_shard(alias):
+    """
+    Направляет запросы к шардированным моделям внутри блока в шард alias.
+    """
+    token = _current_shard.set(alias)
+    try:
+        yield
+    finally:
+        _current_shard.reset(token)
+
+
+def iter_in_shard(alias, iterable):
+    """
+    Перебирает iterable в контексте use_shard(alias). Нужен для потоковых
+    ответов: их тело читается уже после выхода из обработчика запроса.
+    """
+    with use_shard(alias):
+        yield from iterable
+
+
+def activate_shard(alias):
+    return _current_shard.set(alias)
+
+
+def deactivate_shard(token):
+    _current_shard.reset(token)
+
+
+def sharded(model, alias):
+    """
+    Менеджер модели для шарда alias. При одном шарде запросы проходят через
+    остальные роутеры, например к репликам.
+    """
+    return model.objects.using(alias) if is_sharded() else model.objects.all()
+
+
+def _close_and_call(func, alias):
+    try:
+        return func(alias)
+    finally:
+        for connection in connections.all(initialized_only=True):
+            connection.close()
+
+
+def scatter(func):
+    """
+    Вызывает func(alias) для всех шардов параллельно и возвращает
+    результаты в порядке HABIT_SHARDS.
+    """
+    shards = settings.HABIT_SHARDS
+    if len(shards) == 1:
+        return [func(shards[0])]
+    with ThreadPoolExecutor(max_workers=len(shards)) as pool:
+        return list(pool.map(lambda alias: _close_and_call(func, alias), shards))
+
+
+class ScatteredQuery:
+    """
+    Упорядоченная выборка со всех шардов для постраничной выдачи.
+
+    build(alias) возвращает queryset шарда, упорядоченный по key. Срез
+    [start:stop] читает с каждого шарда первые stop строк и сливает их,
+    count() складывает количества строк шардов.
+    """
+
+    def __init__(self, build, key):
+        self.build = build
+        self.key = key
+
+    def count(self):
+        return sum(scatter(lambda alias: self.build(alias).count()))
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[slice(index, index + 1)][0]
+        start, stop = index.start or 0, index.stop
+        chunks = scatter(lambda alias: list(self.build(alias)[:stop]))
+        return list(islice(heapq.merge(*chunks, key=self.key), start, stop))
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def owned_by_shard(alias, user_ids):
+    """
+    Отбирает пользователей, данные которых сейчас находятся на шарде alias.
+
+    Нужен, чтобы во время переноса данные пользователя не обрабатывались
+    дважды: со старого и с нового шарда.
+    """
+    if not is_sharded():
+        return set(user_ids)
+    from .models import UserShard
+
+    user_ids = set(user_ids)
+    placed = dict(
+        UserShard.objects.using(DEFAULT_DB_ALIAS)
+        .filter(user_id__in=user_ids)
+        .values_list("user_id", "shard")
+    )
+    default = settings.HABIT_SHARDS[0]
+    return {user_id for user_id in user_ids if placed.get(user_id, default) == alias}
+
+
+def prepare_shard(alias):
+    """
+    Сдвигает счетчик id привычек шарда alias в его диапазон.
+    """
+    if alias not in settings.HABIT_SHARDS:
+        return
+    start = settings.HABIT_SHARDS.index(alias) * ID_RANGE
+    if not start:
+        return
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            cursor.execute(
+                "SELECT setval(pg_get_serial_sequence('habits_habit', 'id'), "
+                "GREATEST(%s, (SELECT COALESCE(MAX(id), 0) FROM habits_habit)))",
+                [start],
+            )
+        elif connection.vendor == "sqlite":
+            cursor.execute(
+                "INSERT INTO sqlite_sequence (name, seq) SELECT 'habits_habit', 0 "
+                "WHERE NOT EXISTS "
+                "(SELECT 1 FROM sqlite_sequence WHERE name = 'habits_habit')"
+            )
+            cursor.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, %s) "
+                "WHERE name = 'habits_habit'",
+                [start],
+            )
+
+
+def _wait_for_routing():
+    # Запросы, которые успели выбрать шард по прежнему назначению, должны
+    # завершиться, а кэши процессов - получить новое назначение
+    delay = settings.SHARD_MOVE_GRACE
+    if not settings.SHARD_PLACEMENT_SHARED_CACHE:
+        delay += settings.SHARD_PLACEMENT_CACHE_TTL
+    time.sleep(delay)
+
+
+def move_user(user_id, target):
+    """
+    Переносит привычки, журнал выполнения и профиль пользователя на шард
+    target. Возвращает False, если пользователь уже там.
+
+    На время переноса запись для пользователя запрещена (API отвечает 503),
+    чтение идет со старого шарда до переключения назначения.
+    """
+    from .models import Habit, HabitCompletion, UserProfile
+
+    source, _ = placement(user_id)
+    if source == target:
+        return False
+    set_placement(user_id, source, moving=True)
+    _wait_for_routing()
+    try:
+        habits = list(Habit.objects.using(source).filter(user_id=user_id))
+        completions = list(
+            HabitCompletion.objects.using(source).filter(habit__user_id=user_id)
+        )
+        profiles = list(UserProfile.objects.using(source).filter(user_id=user_id))
+        for row in completions + profiles:
+            row.pk = None
+        with transaction.atomic(using=target):
+            Habit.objects.using(target).bulk_create(habits)
+            HabitCompletion.objects.using(target).bulk_create(completions)
+            UserProfile.objects.using(target).bulk_create(profiles)
+            set_placement(user_id, target)
+    except Exception:
+        set_placement(user_id, source)
+        raise
+    # Чтения, выбравшие старый шард до переключения, должны завершиться
+    _wait_for_routing()
+    # Удаление без Collector: ссылки других привычек на перенесенные
+    # должны сохраниться
+    with transaction.atomic(using=source):
+        for queryset in (
+            HabitCompletion.objects.using(source).filter(habit__user_id=user_id),
+            Habit.objects.using(source).filter(user_id=user_id),
+            UserProfile.objects.using(source).filter(user_id=user_id),
+        ):
+            queryset._raw_delete(source)
+    return True
+
+
+def _user_id_of(instance):
+    if isinstance(instance, User):
+        return instance.pk
+    if hasattr(instance, "user_id"):
+        return instance.user_id
+    return None
+
+
+class ShardRouter:
+    """
+    Роутер шардированных моделей. Должен стоять в DATABASE_ROUTERS первым.
+    """
+
+    def _db(self, model, hints):
+        if not is_sharded():
+            return None
+        instance = hints.get("instance")
+        if model._meta.label_lower not in SHARDED_MODELS:
+            # Без роутера Django читает связанные объекты из базы экземпляра,
+            # а пользователи хранятся только в основной базе
+            if instance is not None and instance._meta.label_lower in SHARDED_MODELS:
+                return DEFAULT_DB_ALIAS
+            return None
+        if instance is not None:
+            if instance._meta.label_lower in SHARDED_MODELS and instance._state.db:
+                return instance._state.db
+            habit = instance._state.fields_cache.get("habit")
+            if habit is not None and habit._state.db:
+                return habit._state.db
+        current = _current_shard.get()
+        if current is not None:
+            return current
+        user_id = _user_id_of(instance) if instance is not None else None
+        if user_id is not None:
+            return shard_for_user(user_id)
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._db(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._db(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        labels = {obj1._meta.label_lower, obj2._meta.label_lower}
+        # Ссылки на пользователей и между привычками разных шардов хранятся
+        # без ограничений СУБД
+        if labels & SHARDED_MODELS:
+            return True
+        return None
@@ -1,16 +1,103 @@
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
 from django.dispatch import receiver
 
-from .models import UserProfile
+from . import events
+from .models import Habit, UserProfile
+from .popularity import mark_stale
+from .sharding import assign_shard, is_sharded, prepare_shard, shard_for_user, use_shard
 
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
-        UserProfile.objects.create(user=instance)
+        with use_shard(assign_shard(instance.pk)):
+            UserProfile.objects.create(user=instance)
 
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance, **kwargs):
     instance.profile.save()
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_user_data(sender, instance, using, **kwargs):
+    # Collector удаляет связанные объекты только в базе пользователя
+    if not is_sharded():
+        return
+    shard = shard_for_user(instance.pk)
+    if shard == using:
+        return
+    with use_shard(shard):
+        Habit.objects.filter(user_id=instance.pk).delete()
+        UserProfile.objects.filter(user_id=instance.pk).delete()
+
+
+@receiver(post_migrate)
+def prepare_habit_shard(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    if sender.name == "habits":
+        prepare_shard(using)
+
+
+@receiver(post_migrate)
+def restore_search_index(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    # SQLite теряет триггеры FTS5 при пересоздании таблицы habits_habit
+    if sender.name != "habits":
+        return
+    connection = connections[using]
+    if connection.vendor != "sqlite":
+        return
+    if "habits_habit" not in connection.introspection.table_names():
+        return
+    from .search import install_sqlite_search
+
+    install_sqlite_search(connection)
+
+
+@receiver(post_save, sender=Habit)
+@receiver(post_delete, sender=Habit)
+def invalidate_schedule(sender, instance, **kwargs):
+    from .schedule import bump_habit_set_version
+
+    bump_habit_set_version(instance.user_id)
+
+
+@receiver(post_save, sender=Habit)
+def mark_popularity_stale_on_change(sender, instance, created, **kwargs):
+    loaded = getattr(instance, "_loaded_popularity", None)
+    instance._loaded_popularity = (
+        instance.is_public,
+        instance.action,
+        instance.place,
+    )
+    if created or loaded is None:
+        return
+    was_public, action, place = loaded
+    if was_public and (
+        not instance.is_public or action != instance.action or place != instance.place
+    ):
+        mark_stale(action, place)
+
+
+@receiver(post_delete, sender=Habit)
+def mark_popularity_stale_on_delete(sender, instance, **kwargs):
+    was_public, action, place = getattr(
+        instance,
+        "_loaded_popularity",
+        (instance.is_public, instance.action, instance.place),
+    )
+    if was_public:
+        mark_stale(action, place)
+
+
+@receiver(post_save, sender=Habit)
+@receiver(post_save, sender=UserProfile)
+def record_change_event(sender, instance, created, using, **kwargs):
+    events.record(instance, events.CREATE if created else events.UPDATE, using)
+
+
+@receiver(post_delete, sender=Habit)
+@receiver(post_delete, sender=UserProfile)
+def record_delete_event(sender, instance, using, **kwargs):
+    events.record(instance, events.DELETE, using)
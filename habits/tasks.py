@@ -1,28 +1,219 @@
-import telegram
+import asyncio
+import time
+from itertools import islice
+
 from celery import shared_task
 from django.conf import settings
 
+from . import telemetry
+
 
 @shared_task
 def send_telegram_notification(chat_id, message):
-    bot = telegram.Bot(token=settings.TELEGRAM_BOT_TOKEN)
-    bot.send_message(chat_id=chat_id, text=message)
+    import telegram
+
+    bot = telegram.Bot(
+        token=settings.TELEGRAM_BOT_TOKEN, base_url=settings.TELEGRAM_API_URL
+    )
+    asyncio.run(bot.send_message(chat_id=chat_id, text=message))
 
 
 @shared_task
-def send_habit_reminders():
-    from django.utils import timezone
+def send_notifications(channel, messages):
+    """
+    Отправляет пачку сообщений [адрес, текст, данные] через канал channel.
+    Возвращает число доставленных сообщений.
+    """
+    from .notifications import get_backend
+
+    failures = get_backend(channel).send_batch(messages)
+    telemetry.record_send_failures(channel, failures)
+    return len(messages) - sum(failures.values())
+
+
+def _reminder_text(action):
+    return f"Напоминание: Время для привычки '{action}'"
+
+
+def _queue_reminders(habits, profiles, scheduled_at):
+    """
+    Ставит в очередь напоминания о привычках (id пользователя, id привычки,
+    действие) по каналам из профилей пользователей. Возвращает число
+    поставленных сообщений.
+    """
+    from .notifications import route
+
+    reminders = [
+        (
+            user_id,
+            _reminder_text(action),
+            {
+                "habit": habit_id,
+                "action": action,
+                "scheduled_at": scheduled_at.isoformat(),
+            },
+        )
+        for user_id, habit_id, action in habits
+    ]
+    queued = 0
+    for channel, messages in route(reminders, profiles).items():
+        queued += len(messages)
+        messages = iter(messages)
+        while batch := list(islice(messages, settings.NOTIFICATION_BATCH_SIZE)):
+            send_notifications.delay(channel, batch)
+    return queued
+
 
+def _shard_reminders(alias, lookup):
+    """
+    Возвращает привычки шарда alias, отобранные условиями lookup, в виде
+    (id пользователя, id привычки, действие) и профили их владельцев.
+    """
     from .models import Habit, UserProfile
+    from .notifications import PROFILE_FIELDS
+    from .sharding import owned_by_shard, sharded
 
-    current_time = timezone.now().time()
-    habits = Habit.objects.filter(
+    habits = list(
+        sharded(Habit, alias).filter(**lookup).values_list("user_id", "id", "action")
+    )
+    owners = owned_by_shard(alias, {habit[0] for habit in habits})
+    habits = [habit for habit in habits if habit[0] in owners]
+    profiles = {
+        profile["user_id"]: profile
+        for profile in sharded(UserProfile, alias)
+        .filter(user_id__in=owners)
+        .values(*PROFILE_FIELDS)
+    }
+    return habits, profiles
+
+
+def _gather_reminders(**lookup):
+    """
+    Собирает привычки и профили владельцев со всех шардов параллельно.
+    """
+    from .sharding import scatter
+
+    results = scatter(lambda alias: _shard_reminders(alias, lookup))
+    habits = [habit for shard_habits, _ in results for habit in shard_habits]
+    profiles = {
+        user_id: profile
+        for _, shard_profiles in results
+        for user_id, profile in shard_profiles.items()
+    }
+    return habits, profiles
+
+
+def _publish_reminders(habits, scheduled_at):
+    from .push import publish
+
+    # Веб-клиенты получают напоминания по SSE независимо от других каналов
+    publish(
+        {
+            "user_id": user_id,
+            "event": "reminder",
+            "data": {"habit": habit_id, "action": action, "scheduled_at": scheduled_at},
+        }
+        for user_id, habit_id, action in habits
+    )
+
+
+@shared_task
+def send_habit_reminders():
+    from django.utils import timezone
+
+    started = time.perf_counter()
+    now = timezone.now()
+    current_time = now.time()
+    # Шарды опрашиваются параллельно, задачи ставятся в очередь из основного
+    # потока, чтобы заголовки несли время расписания
+    habits, profiles = _gather_reminders(
         time__hour=current_time.hour, time__minute=current_time.minute
     )
-    for habit in habits:
-        profile = UserProfile.objects.filter(user=habit.user).first()
-        if profile and profile.telegram_chat_id:
-            send_telegram_notification.delay(
-                profile.telegram_chat_id,
-                f"Напоминание: Время для привычки '{habit.action}'",
-            )
+    scheduled_at = now.replace(second=0, microsecond=0)
+    with telemetry.reminder_schedule(scheduled_at):
+        queued = _queue_reminders(habits, profiles, scheduled_at)
+    _publish_reminders(habits, scheduled_at)
+    telemetry.record_tick(
+        len(habits), queued, time.perf_counter() - started, scheduled_at
+    )
+
+
+def _set_public_on_shard(alias, habit_ids, is_public, now):
+    from django.db import transaction
+
+    from . import events
+    from .models import Habit
+    from .sharding import owned_by_shard, sharded
+
+    with transaction.atomic(using=alias):
+        habits = list(
+            sharded(Habit, alias)
+            .select_for_update()
+            .filter(pk__in=habit_ids)
+            .exclude(is_public=is_public)
+        )
+        # Во время переноса пользователя его привычки есть на двух шардах
+        owners = owned_by_shard(alias, {habit.user_id for habit in habits})
+        habits = [habit for habit in habits if habit.user_id in owners]
+        sharded(Habit, alias).filter(pk__in=[habit.pk for habit in habits]).update(
+            is_public=is_public, updated_at=now
+        )
+        for habit in habits:
+            habit.is_public = is_public
+            habit.updated_at = now
+            events.record(habit, events.UPDATE, habit._state.db)
+    return [(habit.action, habit.place) for habit in habits]
+
+
+@shared_task
+def set_habits_public(habit_ids, is_public):
+    """
+    Публикует или снимает с публикации пачку привычек из действия админки
+    на всех шардах. Возвращает количество измененных привычек.
+    """
+    from django.utils import timezone
+
+    from .popularity import mark_stale
+    from .sharding import scatter
+
+    now = timezone.now()
+    changed = [
+        pair
+        for pairs in scatter(
+            lambda alias: _set_public_on_shard(alias, habit_ids, is_public, now)
+        )
+        for pair in pairs
+    ]
+    if not is_public:
+        # Снятые с публикации пары рейтинг сам не заметит
+        for action, place in set(changed):
+            mark_stale(action, place)
+    return len(changed)
+
+
+@shared_task
+def resend_habit_reminders(habit_ids):
+    """
+    Повторно отправляет напоминания о пачке привычек из действия админки.
+    """
+    from django.utils import timezone
+
+    habits, profiles = _gather_reminders(pk__in=habit_ids)
+    scheduled_at = timezone.now()
+    _queue_reminders(habits, profiles, scheduled_at)
+    _publish_reminders(habits, scheduled_at)
+    return len(habits)
+
+
+@shared_task
+def refresh_popular_habits():
+    from .popularity import refresh_popular_habits
+
+    return refresh_popular_habits()
+
+
+@shared_task
+def refresh_recommendations():
+    from .recommendations import refresh_index
+
+    return refresh_index()
@@ -0,0 +1,242 @@
+"""
+Телеметрия задач Celery и конвейера напоминаний.
+
+Общие метрики задач (время ожидания в очереди, время выполнения, ошибки)
+собираются обработчиками сигналов Celery. Метрики тика напоминаний
+записывает сама задача send_habit_reminders.
+
+Отставание напоминаний считается от самой ранней запланированной минуты,
+напоминания которой поставлены в очередь, но еще ни одно не доставлено.
+Оно пересчитывается на каждом тике и после каждой доставки, поэтому растет,
+даже если воркеры стоят или все отправки падают.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from celery.signals import (
+    before_task_publish,
+    task_failure,
+    task_postrun,
+    task_prerun,
+    task_success,
+)
+
+from .metrics import TASK_REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SEND_TASK_NAME = "habits.tasks.send_telegram_notification"
+BATCH_SEND_TASK_NAME = "habits.tasks.send_notifications"
+SEND_TASK_NAMES = {SEND_TASK_NAME, BATCH_SEND_TASK_NAME}
+
+WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+DUE_BUCKETS = (0, 1, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+LATENCY_BUCKETS = (1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0)
+
+TASK_QUEUE_WAIT = TASK_REGISTRY.histogram(
+    "habits_celery_task_queue_wait_seconds",
+    "Time between publishing a task and a worker starting it.",
+    ("task",),
+    buckets=WAIT_BUCKETS,
+)
+TASK_DURATION = TASK_REGISTRY.histogram(
+    "habits_celery_task_duration_seconds",
+    "Task execution time.",
+    ("task",),
+    buckets=WAIT_BUCKETS,
+)
+TASK_FAILURES = TASK_REGISTRY.counter(
+    "habits_celery_task_failures",
+    "Failed task executions.",
+    ("task", "reason"),
+)
+TICK_DURATION = TASK_REGISTRY.histogram(
+    "habits_reminder_tick_duration_seconds",
+    "Runtime of one send_habit_reminders tick.",
+    buckets=WAIT_BUCKETS,
+)
+TICK_DUE = TASK_REGISTRY.histogram(
+    "habits_reminder_tick_due_habits",
+    "Habits matched by one reminder tick.",
+    buckets=DUE_BUCKETS,
+)
+TICK_QUEUED = TASK_REGISTRY.counter(
+    "habits_reminder_queued",
+    "Reminder messages queued for delivery.",
+)
+LAST_TICK = TASK_REGISTRY.gauge(
+    "habits_reminder_last_tick_timestamp_seconds",
+    "Unix time when the last reminder tick finished.",
+)
+REMINDERS_SENT = TASK_REGISTRY.counter(
+    "habits_reminder_sent",
+    "Reminder messages delivered to notification channels.",
+)
+REMINDER_FAILURES = TASK_REGISTRY.counter(
+    "habits_reminder_send_failures",
+    "Reminder messages that failed to reach notification channels.",
+    ("reason",),
+)
+DELIVERY_LATENCY = TASK_REGISTRY.histogram(
+    "habits_reminder_delivery_latency_seconds",
+    "Time from the scheduled reminder minute to delivery to a channel.",
+    buckets=LATENCY_BUCKETS,
+)
+REMINDER_LAG = TASK_REGISTRY.gauge(
+    "habits_reminder_lag_seconds",
+    "Age of the oldest scheduled minute whose queued reminders are undelivered.",
+)
+PENDING_SCHEDULE = TASK_REGISTRY.gauge(
+    "habits_reminder_pending_schedule_timestamp_seconds",
+    "Oldest scheduled minute queued after the last delivered reminder.",
+)
+DELIVERED_SCHEDULE = TASK_REGISTRY.gauge(
+    "habits_reminder_delivered_schedule_timestamp_seconds",
+    "Scheduled minute of the newest delivered reminder.",
+)
+
+_scheduled_at = ContextVar("habits_reminder_scheduled_at", default=None)
+_task_started = {}
+
+
+@contextmanager
+def reminder_schedule(scheduled_at):
+    """
+    Помечает задачи отправки, поставленные внутри блока, запланированным
+    временем напоминания.
+    """
+    token = _scheduled_at.set(scheduled_at.timestamp())
+    try:
+        yield
+    finally:
+        _scheduled_at.reset(token)
+
+
+def update_lag(now=None):
+    """
+    Пересчитывает REMINDER_LAG по минутам ожидающих и доставленных
+    напоминаний.
+    """
+    pending = PENDING_SCHEDULE.value() or 0.0
+    delivered = DELIVERED_SCHEDULE.value() or 0.0
+    if pending > delivered:
+        lag = max((now or time.time()) - pending, 0.0)
+    else:
+        lag = 0.0
+    REMINDER_LAG.set(lag)
+    return lag
+
+
+def record_tick(due, queued, duration, scheduled_at=None):
+    TICK_DURATION.observe(duration)
+    TICK_DUE.observe(due)
+    TICK_QUEUED.inc(queued)
+    LAST_TICK.set(time.time())
+    if queued and scheduled_at is not None:
+        pending = PENDING_SCHEDULE.value() or 0.0
+        # Ожидающей остается самая ранняя минута, после которой ничего не
+        # доставлено
+        if pending <= (DELIVERED_SCHEDULE.value() or 0.0):
+            PENDING_SCHEDULE.set(scheduled_at.timestamp())
+    update_lag()
+    logger.info(
+        "Reminder tick finished",
+        extra={"due": due, "queued": queued, "duration": round(duration, 4)},
+    )
+
+
+def record_send_failures(channel, failures):
+    """
+    Учитывает сообщения пачки, которые канал channel не доставил.
+    """
+    for reason, count in failures.items():
+        REMINDER_FAILURES.inc(count, reason=reason)
+        logger.warning(
+            "Reminder delivery failed",
+            extra={"channel": channel, "reason": reason, "count": count},
+        )
+
+
+def _headers(task):
+    return getattr(task.request, "headers", None) or {}
+
+
+@before_task_publish.connect
+def stamp_task_headers(sender=None, headers=None, **kwargs):
+    if headers is None:
+        return
+    headers["published_at"] = time.time()
+    scheduled_at = _scheduled_at.get()
+    if scheduled_at is not None and sender in SEND_TASK_NAMES:
+        headers["scheduled_at"] = scheduled_at
+
+
+@task_prerun.connect
+def record_task_start(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    published_at = _headers(task).get("published_at")
+    if published_at is not None:
+        TASK_QUEUE_WAIT.observe(max(time.time() - published_at, 0.0), task=task.name)
+
+
+@task_postrun.connect
+def record_task_finish(task_id=None, task=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_DURATION.observe(time.perf_counter() - started, task=task.name)
+
+
+@task_success.connect
+def record_task_success(sender=None, result=None, **kwargs):
+    if sender is None or sender.name not in SEND_TASK_NAMES:
+        return
+    # Пакетная задача возвращает число доставленных сообщений
+    sent = result if sender.name == BATCH_SEND_TASK_NAME else 1
+    if not sent:
+        return
+    REMINDERS_SENT.inc(sent)
+    scheduled_at = _headers(sender).get("scheduled_at")
+    if scheduled_at is None:
+        return
+    now = time.time()
+    latency = max(now - scheduled_at, 0.0)
+    # Задержка учитывается для каждого доставленного сообщения пачки
+    with TASK_REGISTRY.batch():
+        for _ in range(sent):
+            DELIVERY_LATENCY.observe(latency)
+    if scheduled_at > (DELIVERED_SCHEDULE.value() or 0.0):
+        DELIVERED_SCHEDULE.set(scheduled_at)
+    update_lag(now)
+    logger.info(
+        "Reminder delivered", extra={"latency": round(latency, 3), "sent": sent}
+    )
+
+
+def _batch_size(args, kwargs):
+    messages = kwargs.get("messages")
+    if messages is None and args and len(args) > 1:
+        messages = args[1]
+    return len(messages or ())
+
+
+@task_failure.connect
+def record_task_failure(sender=None, exception=None, args=None, kwargs=None, **extra):
+    if sender is None:
+        return
+    reason = type(exception).__name__
+    TASK_FAILURES.inc(task=sender.name, reason=reason)
+    if sender.name not in SEND_TASK_NAMES:
+        return
+    # Упавшая пакетная задача не доставила ни одного сообщения пачки
+    if sender.name == BATCH_SEND_TASK_NAME:
+        failed = _batch_size(args, kwargs or {})
+    else:
+        failed = 1
+    if failed:
+        REMINDER_FAILURES.inc(failed, reason=reason)
+        logger.warning(
+            "Reminder delivery failed", extra={"reason": reason, "count": failed}
+        )
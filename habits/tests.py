@@ -1,14 +1,80 @@
-from unittest.mock import patch
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+from urllib.parse import parse_qs
 
+import telegram
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import OperationalError, connection, connections, transaction
 from django.forms import ValidationError
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from rest_framework import status
-from rest_framework.test import APIClient, APITestCase
+from rest_framework.test import APIClient, APITestCase, APITransactionTestCase
+from rest_framework_simplejwt.tokens import RefreshToken
+from telegram.request import HTTPXRequest
 
-from .models import Habit, UserProfile
+from . import telemetry
+from .management.commands.benchmark_recommendations import (
+    Command as BenchmarkRecommendationsCommand,
+)
+from .management.commands.benchmark_search import (
+    Command as BenchmarkSearchCommand,
+)
+from .metrics import (
+    REGISTRY,
+    REQUEST_DB_QUERIES,
+    REQUEST_DURATION,
+    TASK_REGISTRY,
+    LocalStore,
+    RedisStore,
+)
+from .importing import Importer, read_rows
+from .models import (
+    Habit,
+    HabitCompletion,
+    PopularHabit,
+    TaskCheckpoint,
+    UserProfile,
+    compute_streaks,
+)
+from .popularity import refresh_popular_habits
+from .profiling import make_profiling_token
+from . import bot, events, popularity, push, routers, search, sharding, tasks
+from .admin import EstimatedCountPaginator
+from .recommendations import (
+    RecommendationIndex,
+    build_index,
+    recommend,
+    refresh_index,
+    vectorize,
+)
+from .schema import clear_schema_cache, generate_schema_documents, schema_artifact_path
+from .schedule import LEGACY_ANCHOR, HabitArrays, habit_set_version, project
+from .search import search_habits
 from .serializers import HabitSerializer, UserSerializer
 from .tasks import send_habit_reminders, send_telegram_notification
 
@@ -28,6 +94,18 @@ class CeleryTestCase(TestCase):
 # Используйте CeleryTestCase вместо TestCase для классов, которые тестируют Celery задачи
 
 
+def queued_messages(mock_send_notifications):
+    """
+    Возвращает (канал, адрес, текст) сообщений, поставленных в очередь
+    через замененный send_notifications.delay.
+    """
+    return [
+        (call.args[0], address, text)
+        for call in mock_send_notifications.call_args_list
+        for address, text, _ in call.args[1]
+    ]
+
+
 class CeleryTaskTests(CeleryTestCase):
     def setUp(self):
         self.user = User.objects.create_user(username="testuser", password="12345")
@@ -41,14 +119,22 @@ class CeleryTaskTests(CeleryTestCase):
             duration=60,
         )
 
-    @patch("habits.tasks.send_telegram_notification.delay")
+    @patch("habits.tasks.send_notifications.delay")
     def test_send_habit_reminders(self, mock_send_notification):
         send_habit_reminders()
-        mock_send_notification.assert_called_once_with(
-            "123456789", "Напоминание: Время для привычки 'Read a book'"
+        mock_send_notification.assert_called_once()
+        self.assertEqual(
+            queued_messages(mock_send_notification),
+            [
+                (
+                    "telegram",
+                    "123456789",
+                    "Напоминание: Время для привычки 'Read a book'",
+                )
+            ],
         )
 
-    @patch("habits.tasks.send_telegram_notification.delay")
+    @patch("habits.tasks.send_notifications.delay")
     def test_send_habit_reminders_no_matching_time(self, mock_send_notification):
         self.habit.time = (timezone.now() - timezone.timedelta(hours=1)).time()
         self.habit.save()
@@ -69,7 +155,7 @@ class TelegramTests(CeleryTestCase):
         self.user.profile.telegram_chat_id = "123456789"
         self.user.profile.save()
 
-    @patch("habits.tasks.telegram.Bot.send_message")
+    @patch("telegram.Bot.send_message")
     def test_send_telegram_notification(self, mock_send_message):
         send_telegram_notification(self.user.profile.telegram_chat_id, "Test message")
         mock_send_message.assert_called_once_with(
@@ -360,3 +446,2844 @@ class HabitViewSetTest(TestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Habit.objects.count(), 0)
         self.assertEqual(Habit.objects.count(), 0)
+
+
+class RequestMetricsTests(APITestCase):
+    def setUp(self):
+        REGISTRY.clear()
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.client.force_authenticate(user=self.user)
+        Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time="12:00:00",
+            action="Read a book",
+            duration=60,
+        )
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse("habit-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        header = response["Server-Timing"]
+        self.assertIn("db;dur=", header)
+        self.assertIn("ser;dur=", header)
+        self.assertIn("total;dur=", header)
+        self.assertNotIn('desc="0 queries"', header)
+
+    def test_histograms_labeled_by_route(self):
+        self.client.get(reverse("habit-list"))
+        self.client.get(reverse("habit-list"))
+        self.client.get(reverse("public-habits"))
+        self.assertEqual(REQUEST_DURATION.count(route="habit-list", method="GET"), 2)
+        self.assertEqual(
+            REQUEST_DB_QUERIES.count(route="public-habits", method="GET"), 1
+        )
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint(self):
+        self.client.get(reverse("habit-list"))
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = response.content.decode()
+        self.assertIn("# TYPE habits_http_request_duration_seconds histogram", body)
+        self.assertIn(
+            'habits_http_request_duration_seconds_count{route="habit-list",method="GET"} 1',
+            body,
+        )
+        self.assertIn('le="+Inf"', body)
+
+    def test_request_metrics_written_in_one_batch(self):
+        store = LocalStore()
+        with (
+            patch.object(REGISTRY, "_store", store),
+            patch.object(store, "add", wraps=store.add) as add,
+            patch.object(store, "add_many", wraps=store.add_many) as add_many,
+        ):
+            self.client.get(reverse("habit-list"))
+        add.assert_not_called()
+        add_many.assert_called_once()
+        self.assertEqual(
+            {metric for metric, _ in add_many.call_args.args[0]},
+            {
+                "habits_http_request_duration_seconds",
+                "habits_http_request_db_seconds",
+                "habits_http_request_db_queries",
+                "habits_http_request_serializer_seconds",
+            },
+        )
+
+    @override_settings(METRICS_TOKEN="secret")
+    def test_metrics_endpoint_token(self):
+        self.assertEqual(
+            self.client.get(reverse("metrics")).status_code, status.HTTP_403_FORBIDDEN
+        )
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer wrong"
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.get(
+            reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(METRICS_TOKEN=None)
+    def test_metrics_endpoint_closed_without_token(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with override_settings(METRICS_PUBLIC=True):
+            response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    @override_settings(METRICS_FLUSH_INTERVAL=3600)
+    def test_redis_store_writes_in_background_and_drops_on_failure(self):
+        store = RedisStore("redis://metrics.invalid:6379/0", "test:")
+        store._client = client = MagicMock()
+        pipe = client.pipeline.return_value
+        store.add_many(
+            [
+                ("requests", [(("a",), 1), (("a", "sum"), 0.5)]),
+                ("requests", [(("a",), 2), (("a", "sum"), 0.25)]),
+            ]
+        )
+        # Запрос не обращается к Redis, запись делает фоновый поток
+        client.pipeline.assert_not_called()
+        store.flush()
+        pipe.hincrby.assert_called_once_with("test:requests", '["a"]', 3)
+        pipe.hincrbyfloat.assert_called_once_with("test:requests", '["a", "sum"]', 0.75)
+        pipe.execute.assert_called_once()
+
+        pipe.execute.side_effect = ConnectionError("down")
+        store.add("requests", [(("a",), 1)])
+        with self.assertLogs("habits.metrics", "WARNING"):
+            store.flush()
+        pipe.reset_mock()
+        store.flush()
+        pipe.execute.assert_not_called()
+
+    def test_redis_store_uses_short_socket_timeouts(self):
+        store = RedisStore("redis://localhost:6379/0")
+        kwargs = store.client.connection_pool.connection_kwargs
+        self.assertEqual(kwargs["socket_timeout"], settings.METRICS_REDIS_TIMEOUT)
+        self.assertEqual(
+            kwargs["socket_connect_timeout"], settings.METRICS_REDIS_TIMEOUT
+        )
+
+
+@override_settings(TELEGRAM_BOT_TOKEN="123:abc")
+class ReminderTelemetryTests(CeleryTestCase):
+    def setUp(self):
+        TASK_REGISTRY.clear()
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.user.profile.telegram_chat_id = "123456789"
+        self.user.profile.save()
+        Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time=timezone.now().time(),
+            action="Read a book",
+            duration=60,
+        )
+
+    @patch("habits.tasks.send_notifications.delay")
+    def test_tick_metrics(self, mock_send_notification):
+        send_habit_reminders()
+        self.assertEqual(telemetry.TICK_DURATION.count(), 1)
+        self.assertEqual(telemetry.TICK_DUE.count(), 1)
+        self.assertEqual(telemetry.TICK_QUEUED.value(), 1)
+        self.assertIsNotNone(telemetry.LAST_TICK.value())
+
+    def test_publish_headers_carry_schedule(self):
+        scheduled_at = timezone.now().replace(second=0, microsecond=0)
+        headers = {}
+        with telemetry.reminder_schedule(scheduled_at):
+            telemetry.stamp_task_headers(
+                sender=telemetry.SEND_TASK_NAME, headers=headers
+            )
+        self.assertEqual(headers["scheduled_at"], scheduled_at.timestamp())
+        self.assertIn("published_at", headers)
+
+    @patch("telegram.Bot.send_message")
+    def test_delivery_latency_and_lag(self, mock_send_message):
+        scheduled_at = time.time() - 30
+        send_telegram_notification.apply(
+            ("123456789", "Test message"),
+            headers={"scheduled_at": scheduled_at, "published_at": time.time() - 2},
+        )
+        self.assertEqual(telemetry.REMINDERS_SENT.value(), 1)
+        self.assertEqual(telemetry.DELIVERY_LATENCY.count(), 1)
+        self.assertEqual(
+            telemetry.TASK_QUEUE_WAIT.count(task=telemetry.SEND_TASK_NAME), 1
+        )
+
+    @patch("habits.tasks.send_notifications.delay")
+    def test_lag_grows_until_reminders_are_delivered(self, mock_send_notification):
+        now = timezone.now()
+        earlier = now - timedelta(minutes=2)
+        Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time=earlier.time(),
+            action="Walk",
+            duration=60,
+        )
+        with patch("django.utils.timezone.now", return_value=earlier):
+            send_habit_reminders()
+        scheduled_at = earlier.replace(second=0, microsecond=0)
+        # Следующие тики не сдвигают самую раннюю недоставленную минуту
+        with patch("django.utils.timezone.now", return_value=now):
+            send_habit_reminders()
+        self.assertGreaterEqual(telemetry.REMINDER_LAG.value(), 120)
+        self.assertAlmostEqual(
+            telemetry.update_lag(), time.time() - scheduled_at.timestamp(), delta=5
+        )
+
+        # Неудачная отправка не сбрасывает отставание
+        messages = [["1", "a", {}], ["2", "b", {}]]
+        with patch(
+            "habits.notifications.TelegramBackend.send_batch",
+            side_effect=telegram.error.NetworkError("down"),
+        ):
+            result = tasks.send_notifications.apply(
+                ("telegram", messages),
+                headers={"scheduled_at": scheduled_at.timestamp()},
+            )
+        self.assertTrue(result.failed())
+        self.assertEqual(telemetry.REMINDER_FAILURES.value(reason="NetworkError"), 2)
+        self.assertGreaterEqual(telemetry.REMINDER_LAG.value(), 120)
+
+        with patch("telegram.Bot.send_message"):
+            tasks.send_notifications.apply(
+                ("telegram", messages),
+                headers={"scheduled_at": scheduled_at.timestamp()},
+            )
+        self.assertEqual(telemetry.DELIVERY_LATENCY.count(), 2)
+        self.assertEqual(telemetry.REMINDER_LAG.value(), 0)
+
+    @patch("telegram.Bot.send_message")
+    def test_failures_by_reason(self, mock_send_message):
+        mock_send_message.side_effect = telegram.error.Forbidden("blocked")
+        result = send_telegram_notification.apply(("123456789", "Test message"))
+        self.assertTrue(result.failed())
+        self.assertEqual(telemetry.REMINDER_FAILURES.value(reason="Forbidden"), 1)
+        self.assertEqual(telemetry.REMINDERS_SENT.value(), 0)
+
+    @patch("habits.tasks.send_notifications.delay")
+    @override_settings(METRICS_PUBLIC=True)
+    def test_metrics_endpoint_includes_task_metrics(self, mock_send_notification):
+        send_habit_reminders()
+        response = self.client.get(reverse("metrics"))
+        body = response.content.decode()
+        self.assertIn("habits_reminder_tick_due_habits_count 1", body)
+        self.assertIn("# TYPE habits_reminder_lag_seconds gauge", body)
+
+
+class ProfilingTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        override = override_settings(PROFILING_DIR=self.tmpdir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.staff = User.objects.create_user(
+            username="staff", password="12345", is_staff=True
+        )
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.client.force_authenticate(user=self.user)
+
+    def test_unflagged_request_not_profiled(self):
+        response = self.client.get(reverse("habit-list"))
+        self.assertNotIn("X-Profile-URL", response)
+        self.assertEqual(os.listdir(self.tmpdir.name), [])
+
+    def test_staff_token_profiles_request(self):
+        token = make_profiling_token(self.staff)
+        response = self.client.get(reverse("habit-list"), HTTP_X_PROFILE=token)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        url = response["X-Profile-URL"]
+
+        self.client.force_authenticate(user=self.staff)
+        report = self.client.get(url)
+        self.assertEqual(report.status_code, status.HTTP_200_OK)
+        body = b"".join(report.streaming_content).decode()
+        self.assertIn("GET /api/habits/", body)
+        self.assertIn("SELECT", body)
+        raw = self.client.get(url, {"raw": "1"})
+        self.assertEqual(raw.status_code, status.HTTP_200_OK)
+
+    def test_report_requires_staff(self):
+        token = make_profiling_token(self.staff)
+        url = self.client.get(reverse("habit-list"), HTTP_X_PROFILE=token)[
+            "X-Profile-URL"
+        ]
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_non_staff_or_forged_token_ignored(self):
+        for token in (make_profiling_token(self.user), "1:forged:signature"):
+            response = self.client.get(reverse("habit-list"), HTTP_X_PROFILE=token)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertNotIn("X-Profile-URL", response)
+
+
+class SchemaArtifactTests(APITestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        override = override_settings(OPENAPI_SCHEMA_DIR=self.tmpdir.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        clear_schema_cache()
+        self.addCleanup(clear_schema_cache)
+
+    def test_fallback_generates_and_memoizes(self):
+        with patch(
+            "habits.schema.generate_schema_documents",
+            wraps=generate_schema_documents,
+        ) as generate:
+            first = self.client.get(reverse("schema"), {"format": "json"})
+            second = self.client.get(reverse("schema"), {"format": "json"})
+        self.assertEqual(first.status_code, status.HTTP_200_OK)
+        self.assertIn("openapi", json.loads(first.content))
+        self.assertEqual(first["ETag"], second["ETag"])
+        self.assertEqual(generate.call_count, 1)
+
+    def test_format_negotiation(self):
+        response = self.client.get(reverse("schema"))
+        self.assertEqual(response["Content-Type"], "application/vnd.oai.openapi")
+        self.assertTrue(response.content.startswith(b"openapi:"))
+        self.assertIn("Accept", response["Vary"])
+
+        response = self.client.get(
+            reverse("schema"), HTTP_ACCEPT="application/vnd.oai.openapi+json"
+        )
+        self.assertEqual(response["Content-Type"], "application/vnd.oai.openapi+json")
+        self.assertIn("openapi", json.loads(response.content))
+
+        response = self.client.get(reverse("schema"), {"format": "yaml"})
+        self.assertTrue(response.content.startswith(b"openapi:"))
+
+    def test_serves_artifact_with_etag(self):
+        call_command("build_schema", stdout=io.StringIO())
+        for format in ("yaml", "json"):
+            path = schema_artifact_path(format)
+            self.assertTrue(path.exists())
+            response = self.client.get(reverse("schema"), {"format": format})
+            self.assertEqual(response.content, path.read_bytes())
+
+            response = self.client.get(
+                reverse("schema"),
+                {"format": format},
+                HTTP_IF_NONE_MATCH=response["ETag"],
+            )
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_check_detects_stale_artifact(self):
+        with self.assertRaises(CommandError):
+            call_command("build_schema", check=True, stdout=io.StringIO())
+        call_command("build_schema", stdout=io.StringIO())
+        call_command("build_schema", check=True, stdout=io.StringIO())
+        schema_artifact_path("yaml").write_text("openapi: 3.0.3\n")
+        with self.assertRaises(CommandError):
+            call_command("build_schema", check=True, stdout=io.StringIO())
+
+
+# Бюджет времени импорта при старте воркера Celery (сумма собственного
+# времени импорта всех модулей по данным python -X importtime)
+WORKER_IMPORT_BUDGET_MS = 1500
+WORKER_FORBIDDEN_MODULES = (
+    "telegram",
+    "rest_framework",
+    "drf_spectacular",
+    "corsheaders",
+    "django.contrib.admin",
+)
+
+
+def measure_import_costs(code, settings_module):
+    """
+    Запускает код в отдельном интерпретаторе и возвращает собственное время
+    импорта каждого модуля в микросекундах.
+    """
+    env = {**os.environ, "DJANGO_SETTINGS_MODULE": settings_module}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        env=env,
+        cwd=settings.BASE_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    costs = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.split(":", 1)[1].split("|")
+        costs[name.strip()] = int(self_us)
+    return costs
+
+
+class WorkerStartupTests(TestCase):
+    def test_worker_import_budget(self):
+        costs = measure_import_costs(
+            "import django; django.setup(); import config.celery, habits.tasks",
+            "config.settings_worker",
+        )
+        total_ms = sum(costs.values()) / 1000
+        top = sorted(costs.items(), key=lambda item: item[1], reverse=True)[:15]
+        report = "\n".join(f"{cost / 1000:8.1f} ms  {name}" for name, cost in top)
+        self.assertLess(
+            total_ms,
+            WORKER_IMPORT_BUDGET_MS,
+            f"Импорт при старте воркера занял {total_ms:.0f} ms:\n{report}",
+        )
+        loaded = [
+            name
+            for name in WORKER_FORBIDDEN_MODULES
+            if name in costs or any(key.startswith(name + ".") for key in costs)
+        ]
+        self.assertEqual(loaded, [], f"Воркер загрузил лишние модули:\n{report}")
+
+
+class HabitCompletionTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.client.force_authenticate(user=self.user)
+        self.habit = Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time="12:00:00",
+            action="Read a book",
+            duration=60,
+        )
+        self.today = timezone.localdate()
+
+    def complete(self, days_ago=None):
+        data = {}
+        if days_ago is not None:
+            data["date"] = (self.today - timedelta(days=days_ago)).isoformat()
+        return self.client.post(
+            reverse("habit-complete", args=[self.habit.id]), data, format="json"
+        )
+
+    def test_compute_streaks(self):
+        day = self.today
+        dates = [day - timedelta(days=n) for n in (9, 8, 5, 4, 3)]
+        self.assertEqual(compute_streaks(dates, 1), (3, 3, day - timedelta(days=3)))
+        self.assertEqual(compute_streaks(dates, 3), (5, 5, day - timedelta(days=3)))
+        self.assertEqual(compute_streaks([], 1), (0, 0, None))
+
+    def test_complete_updates_counters_incrementally(self):
+        for days_ago in (3, 2, 1):
+            self.assertEqual(self.complete(days_ago).status_code, 201)
+        response = self.complete()
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data["current_streak"], 4)
+        self.assertEqual(response.data["longest_streak"], 4)
+        self.assertEqual(response.data["last_completed"], self.today.isoformat())
+
+    def test_complete_is_idempotent_per_date(self):
+        self.complete()
+        response = self.complete()
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.habit.completions.count(), 1)
+        self.assertEqual(response.data["current_streak"], 1)
+
+    def test_gap_resets_streak_and_backfill_recomputes(self):
+        self.complete(5)
+        self.complete(4)
+        self.complete(1)
+        self.habit.refresh_from_db()
+        self.assertEqual((self.habit.current_streak, self.habit.longest_streak), (1, 2))
+        # Выполнение задним числом заполняет пропуск
+        for days_ago in (3, 2):
+            self.complete(days_ago)
+        self.habit.refresh_from_db()
+        self.assertEqual((self.habit.current_streak, self.habit.longest_streak), (5, 5))
+
+    def test_future_date_rejected(self):
+        response = self.complete(-1)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_streak_reads_without_queries_on_log(self):
+        self.complete(10)
+        with self.assertNumQueries(1):
+            habit = Habit.objects.get(pk=self.habit.pk)
+            data = HabitSerializer(habit).data
+        # Срок выполнения пропущен, поэтому текущая серия прервана
+        self.assertEqual(data["current_streak"], 0)
+        self.assertEqual(data["longest_streak"], 1)
+
+    def test_completions_list(self):
+        self.complete(1)
+        self.complete()
+        response = self.client.get(reverse("habit-completions", args=[self.habit.id]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [item["date"] for item in response.data["results"]],
+            [self.today.isoformat(), (self.today - timedelta(days=1)).isoformat()],
+        )
+
+    def test_other_users_habit_not_completable(self):
+        other = User.objects.create_user(username="other", password="12345")
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.complete().status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_rebuild_streaks_command(self):
+        for days_ago in (2, 1, 0):
+            HabitCompletion.objects.create(
+                habit=self.habit, date=self.today - timedelta(days=days_ago)
+            )
+        stale = Habit.objects.create(
+            user=self.user, place="Home", time="12:00:00", action="Run", duration=60
+        )
+        Habit.objects.filter(pk=stale.pk).update(current_streak=7, longest_streak=9)
+        out = io.StringIO()
+        call_command("rebuild_streaks", batch_size=1, stdout=out)
+        self.habit.refresh_from_db()
+        stale.refresh_from_db()
+        self.assertEqual((self.habit.current_streak, self.habit.longest_streak), (3, 3))
+        self.assertEqual((stale.current_streak, stale.longest_streak), (0, 0))
+        self.assertIn("Исправлено привычек: 1", out.getvalue())
+
+
+class HabitExportTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.other = User.objects.create_user(username="other", password="12345")
+        self.client.force_authenticate(user=self.user)
+
+    def seed(self, user, count):
+        Habit.objects.bulk_create(
+            Habit(
+                user=user,
+                place=f"Place {n}",
+                time="12:00:00",
+                action=f"Action {n} " + "x" * 150,
+                duration=60,
+            )
+            for n in range(count)
+        )
+
+    def consume(self, response):
+        # Читает поток, не сохраняя его целиком
+        total = lines = 0
+        for chunk in response.streaming_content:
+            total += len(chunk)
+            lines += chunk.count(b"\n")
+        return total, lines
+
+    def test_user_csv_export(self):
+        self.seed(self.user, 3)
+        self.seed(self.other, 2)
+        response = self.client.get(reverse("habit-export", args=["csv"]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/csv; charset=utf-8")
+        rows = list(
+            csv.reader(io.StringIO(b"".join(response.streaming_content).decode()))
+        )
+        self.assertEqual(rows[0][:3], ["id", "user_id", "place"])
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all(row[1] == str(self.user.id) for row in rows[1:]))
+
+    def test_user_ndjson_export(self):
+        self.seed(self.user, 2)
+        response = self.client.get(reverse("habit-export", args=["ndjson"]))
+        records = [
+            json.loads(line)
+            for line in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]["time"], "12:00:00")
+        self.assertEqual(records[0]["place"], "Place 0")
+
+    def test_admin_export_requires_staff(self):
+        url = reverse("admin-habits-export", args=["ndjson"])
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_403_FORBIDDEN)
+        self.seed(self.user, 2)
+        self.seed(self.other, 3)
+        admin = User.objects.create_user(
+            username="admin", password="12345", is_staff=True
+        )
+        self.client.force_authenticate(user=admin)
+        _, lines = self.consume(self.client.get(url))
+        self.assertEqual(lines, 5)
+
+    def measure_export(self):
+        response = self.client.get(reverse("habit-export", args=["csv"]))
+        tracemalloc.start()
+        try:
+            total, lines = self.consume(response)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return total, lines, peak
+
+    @override_settings(EXPORT_CHUNK_SIZE=500)
+    def test_export_memory_is_constant(self):
+        self.seed(self.user, 2000)
+        small_total, small_lines, small_peak = self.measure_export()
+        self.seed(self.user, 18000)
+        total, lines, peak = self.measure_export()
+        self.assertEqual((small_lines, lines), (2001, 20001))
+        self.assertGreater(total, small_total * 9)
+        # Объем выгрузки вырос в 10 раз, а пиковое потребление памяти - нет
+        self.assertLess(peak, small_peak * 1.5)
+        self.assertLess(peak, total / 2)
+
+
+class PublicHabitSearchTests(APITestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="12345")
+
+    def create(self, action, place="Home", is_public=True):
+        return Habit.objects.create(
+            user=self.user,
+            place=place,
+            time="12:00:00",
+            action=action,
+            duration=60,
+            is_public=is_public,
+        )
+
+    def search(self, query, **params):
+        response = self.client.get(
+            reverse("public-habits"), {"search": query, **params}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response
+
+    def test_search_matches_action_and_place(self):
+        self.create("Morning run", place="Park")
+        self.create("Read a book", place="Library")
+        self.create("Run secretly", is_public=False)
+        actions = [item["action"] for item in self.search("run").data["results"]]
+        self.assertEqual(actions, ["Morning run"])
+        actions = [item["action"] for item in self.search("libr").data["results"]]
+        self.assertEqual(actions, ["Read a book"])
+
+    def test_search_ranks_results(self):
+        self.create("Walk walk walk the dog")
+        self.create("Walk to the office in the morning with coffee")
+        results = self.search("walk").data["results"]
+        self.assertEqual(results[0]["action"], "Walk walk walk the dog")
+
+    def test_index_follows_updates(self):
+        habit = self.create("Swim")
+        habit.action = "Cycle"
+        habit.save()
+        self.assertEqual(self.search("swim").data["count"], 0)
+        self.assertEqual(self.search("cycle").data["count"], 1)
+        habit.is_public = False
+        habit.save()
+        self.assertEqual(self.search("cycle").data["count"], 0)
+
+    def test_search_with_pagination(self):
+        for n in range(7):
+            self.create(f"Stretch {n}")
+        first = self.search("stretch")
+        self.assertEqual(first.data["count"], 7)
+        self.assertEqual(len(first.data["results"]), 5)
+        second = self.search("stretch", page=2)
+        self.assertEqual(len(second.data["results"]), 2)
+
+    def test_search_uses_fts_index(self):
+        queryset = search_habits(Habit.objects.filter(is_public=True), "run")
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row) for row in cursor.fetchall())
+        self.assertIn("VIRTUAL TABLE INDEX", plan)
+
+    def test_postgres_query_matches_prefixes(self):
+        self.assertEqual(search._tsquery("Morning  run!"), "'morning':* & 'run':*")
+        self.assertEqual(search._tsquery("' & !"), "")
+
+    @staticmethod
+    def steps(func):
+        """
+        Возвращает число шагов виртуальной машины SQLite, выполненных func.
+        """
+        counter = [0]
+
+        def count():
+            counter[0] += 1
+            return 0
+
+        connection.ensure_connection()
+        connection.connection.set_progress_handler(count, 100)
+        try:
+            func()
+        finally:
+            connection.connection.set_progress_handler(None, 0)
+        return counter[0]
+
+    def test_index_search_work_is_sublinear(self):
+        rng = random.Random(0)
+        created = 0
+        work = []
+        for size in (2000, 20000):
+            Habit.objects.bulk_create(
+                Habit(
+                    user=self.user,
+                    action=f"{rng.choice(['read', 'walk', 'swim'])} {n}"
+                    + (" zebrafish" if n < 10 else ""),
+                    place="Home",
+                    time="08:00",
+                    duration=60,
+                    is_public=True,
+                )
+                for n in range(created, size)
+            )
+            created = size
+            public = Habit.objects.filter(is_public=True)
+            work.append(
+                (
+                    self.steps(lambda: list(search_habits(public, "zebrafish")[:20])),
+                    self.steps(
+                        lambda: list(public.filter(action__icontains="zebrafish")[:20])
+                    ),
+                )
+            )
+        (small_index, small_scan), (large_index, large_scan) = work
+        # Данных в 10 раз больше: перебор растет вместе с ними, поиск по
+        # индексу - нет
+        self.assertGreater(large_scan, small_scan * 5)
+        self.assertLess(large_index, small_index * 2)
+        self.assertLess(large_index * 10, large_scan)
+
+    def test_benchmark_command_rolls_back_data(self):
+        command = BenchmarkSearchCommand()
+        call_command(command, sizes=[100, 200], repeat=1, stdout=io.StringIO())
+        self.assertEqual([size for size, _, _ in command.results], [100, 200])
+        self.assertEqual(Habit.objects.count(), 0)
+
+
+class PopularHabitsTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.users = [
+            User.objects.create_user(username=f"user{n}", password="12345")
+            for n in range(3)
+        ]
+
+    def create(self, user, action, place="Park", is_public=True, days_ago=30):
+        habit = Habit.objects.create(
+            user=user,
+            place=place,
+            time="07:00:00",
+            action=action,
+            duration=60,
+            is_public=is_public,
+        )
+        Habit.objects.filter(pk=habit.pk).update(
+            created_at=timezone.now() - timedelta(days=days_ago)
+        )
+        return habit
+
+    def ranking(self):
+        response = self.client.get(reverse("popular-habits"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [
+            (item["action"].lower(), item["adoption_count"]) for item in response.data
+        ]
+
+    def test_ranking_groups_normalized_actions(self):
+        self.create(self.users[0], "Morning run")
+        self.create(self.users[1], "  morning RUN ")
+        self.create(self.users[2], "Morning run")
+        self.create(self.users[0], "Yoga")
+        self.create(self.users[1], "Secret", is_public=False)
+        refresh_popular_habits()
+        self.assertEqual(self.ranking(), [("  morning run ", 3), ("yoga", 1)])
+
+    def test_recent_growth_boosts_score(self):
+        for user in self.users:
+            self.create(user, "Read")
+        self.create(self.users[0], "Swim", days_ago=1)
+        self.create(self.users[1], "Swim", days_ago=2)
+        refresh_popular_habits()
+        # 2 + 2 * 2 новых против 3 без роста
+        self.assertEqual(self.ranking(), [("swim", 2), ("read", 3)])
+
+    def test_habits_without_creation_time_are_not_growth(self):
+        for user in self.users:
+            self.create(user, "Read")
+        # Привычки, созданные до появления created_at, хранят NULL
+        Habit.objects.update(created_at=None)
+        self.create(self.users[0], "Swim", days_ago=40)
+        refresh_popular_habits()
+        self.assertEqual(PopularHabit.objects.get(action="read").recent_count, 0)
+        self.assertEqual(self.ranking(), [("read", 3), ("swim", 1)])
+
+    def age_updates(self):
+        Habit.objects.update(updated_at=timezone.now() - 2 * popularity.REFRESH_OVERLAP)
+
+    def test_incremental_refresh(self):
+        self.create(self.users[0], "Read")
+        self.create(self.users[1], "Yoga")
+        self.age_updates()
+        self.assertEqual(refresh_popular_habits(), 2)
+        self.assertEqual(refresh_popular_habits(), 0)
+        self.create(self.users[2], "Read")
+        self.assertEqual(refresh_popular_habits(), 1)
+        self.assertEqual(self.ranking(), [("read", 2), ("yoga", 1)])
+
+    def test_change_committed_after_refresh_is_not_lost(self):
+        self.create(self.users[0], "Yoga")
+        self.age_updates()
+        refresh_popular_habits()
+        # Строка получила updated_at до отметки прошлого обновления, но
+        # ее транзакция зафиксировалась уже после чтения изменений
+        since = parse_datetime(
+            TaskCheckpoint.objects.get(name=popularity.CHECKPOINT_NAME).value["since"]
+        )
+        habit = self.create(self.users[1], "Read")
+        Habit.objects.filter(pk=habit.pk).update(
+            updated_at=since - timedelta(seconds=5)
+        )
+        self.assertEqual(refresh_popular_habits(), 1)
+        self.assertEqual(self.ranking(), [("yoga", 1), ("read", 1)])
+
+    def test_delete_and_unpublish_update_ranking(self):
+        first = self.create(self.users[0], "Read")
+        self.create(self.users[1], "Read")
+        yoga = self.create(self.users[2], "Yoga")
+        refresh_popular_habits()
+        first.delete()
+        yoga = Habit.objects.get(pk=yoga.pk)
+        yoga.is_public = False
+        yoga.save()
+        self.assertEqual(refresh_popular_habits(), 2)
+        self.assertEqual(self.ranking(), [("read", 1)])
+
+    def test_renamed_habit_moves_between_keys(self):
+        habit = self.create(self.users[0], "Read")
+        refresh_popular_habits()
+        habit = Habit.objects.get(pk=habit.pk)
+        habit.action = "Write"
+        habit.save()
+        refresh_popular_habits()
+        self.assertEqual(self.ranking(), [("write", 1)])
+
+    def test_endpoint_served_from_cache(self):
+        self.create(self.users[0], "Read")
+        refresh_popular_habits()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.ranking(), [("read", 1)])
+
+
+class HabitRecommendationTests(APITestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(RECOMMENDATIONS_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username="author", password="12345")
+        self.other = User.objects.create_user(username="other", password="12345")
+        self.client.force_authenticate(user=self.user)
+
+    def create(self, action, place, is_public=True, is_pleasant=False):
+        return Habit.objects.create(
+            user=self.other,
+            action=action,
+            place=place,
+            time="07:00:00",
+            duration=60,
+            is_public=is_public,
+            is_pleasant=is_pleasant,
+        )
+
+    def recommendations(self, **params):
+        response = self.client.get(reverse("habit-recommendations"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return (
+            [item["action"] for item in response.data["similar"]],
+            [item["action"] for item in response.data["related"]],
+        )
+
+    def meta(self):
+        with open(os.path.join(self.directory, "index.json")) as file:
+            return json.load(file)
+
+    def test_similar_and_pleasant_recommendations(self):
+        self.create("Morning run", "Park")
+        self.create("Evening running", "Stadium")
+        self.create("Read a book", "Library")
+        self.create("Running secret", "Park", is_public=False)
+        self.create("Listen to music after run", "Park", is_pleasant=True)
+        self.create("Eat chocolate", "Home", is_pleasant=True)
+        refresh_index()
+
+        similar, related = self.recommendations(action="run", place="park", limit=3)
+        self.assertEqual(similar[0], "Morning run")
+        self.assertNotIn("Running secret", similar)
+        self.assertNotIn("Read a book", similar)
+        self.assertEqual(related, ["Listen to music after run"])
+
+        response = self.client.get(
+            reverse("habit-recommendations"), {"action": "Read", "place": "Library"}
+        )
+        self.assertGreater(response.data["similar"][0]["similarity"], 0.5)
+
+    def test_incremental_refresh(self):
+        first = self.create("Morning run", "Park")
+        self.create("Read a book", "Library")
+        refresh_index(full=True)
+        vectors = self.meta()["vectors"]
+
+        self.create("Swim in the pool", "Gym")
+        first.is_public = False
+        first.save()
+        refresh_index()
+
+        self.assertEqual(self.meta()["vectors"], vectors)
+        self.assertEqual(self.meta()["count"], 3)
+        self.assertEqual(
+            self.recommendations(action="swim")[0][:1], ["Swim in the pool"]
+        )
+        self.assertNotIn("Morning run", self.recommendations(action="morning run")[0])
+
+        first.is_public = True
+        first.action = "Evening run"
+        first.save()
+        refresh_index()
+        self.assertEqual(self.meta()["count"], 3)
+        self.assertEqual(self.recommendations(action="evening")[0][:1], ["Evening run"])
+
+    def test_growth_triggers_full_rebuild(self):
+        self.create("Morning run", "Park")
+        self.create("Read a book", "Library")
+        refresh_index()
+        vectors = self.meta()["vectors"]
+        for action in ("Swim", "Cook dinner", "Write a letter"):
+            self.create(action, "Home")
+        refresh_index()
+        self.assertNotEqual(self.meta()["vectors"], vectors)
+        self.assertEqual(self.meta()["documents"], 5)
+        self.assertEqual(self.recommendations(action="cook")[0][:1], ["Cook dinner"])
+
+    def test_deleted_habits_are_skipped(self):
+        habit = self.create("Morning run", "Park")
+        self.create("Evening run", "Park")
+        refresh_index()
+        habit.delete()
+        self.assertEqual(self.recommendations(action="run")[0][:1], ["Evening run"])
+
+    def test_without_index_and_invalid_params(self):
+        self.assertEqual(self.recommendations(action="run"), ([], []))
+        url = reverse("habit-recommendations")
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(
+            self.client.get(url, {"action": "run", "limit": "x"}).status_code,
+            status.HTTP_400_BAD_REQUEST,
+        )
+
+    def test_blocked_search_matches_brute_force(self):
+        texts = [(f"habit {n % 17} step{n}", f"place {n % 5}") for n in range(200)]
+        rows = [
+            (n + 1, action, place, n % 4 == 0)
+            for n, (action, place) in enumerate(texts)
+        ]
+        directory = Path(tempfile.mkdtemp(dir=self.directory))
+        meta = build_index(directory, iter(rows), len(rows), timezone.now())
+        index = RecommendationIndex(directory, meta)
+        queries = vectorize([("habit 3", "place 1"), ("step42", "")], index.idf)
+        with patch("habits.recommendations.ROWS_PER_BLOCK", 7):
+            similar, related = index.search(queries, 5, masks=(None, index.pleasant))
+
+        matrix = vectorize(texts, index.idf)
+        for number, query in enumerate(queries):
+            scores = matrix @ query
+            expected = sorted(range(len(texts)), key=lambda n: (-scores[n], n))[:5]
+            self.assertEqual(
+                [habit_id for habit_id, _ in similar[number]], [n + 1 for n in expected]
+            )
+            pleasant = [
+                n
+                for n in sorted(range(len(texts)), key=lambda n: (-scores[n], n))
+                if n % 4 == 0 and scores[n] > 0
+            ][:5]
+            self.assertEqual(
+                [habit_id for habit_id, _ in related[number]], [n + 1 for n in pleasant]
+            )
+
+    def test_benchmark_command(self):
+        command = BenchmarkRecommendationsCommand(stdout=io.StringIO())
+        call_command(command, sizes=[500, 2000], repeat=3, batch=4)
+        self.assertEqual([row[0] for row in command.results], [500, 2000])
+
+
+class HabitScheduleTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username="planner", password="12345")
+        self.client.force_authenticate(user=self.user)
+        self.today = timezone.localdate()
+
+    def create(self, time, frequency, days_ago=0, user=None):
+        habit = Habit.objects.create(
+            user=user or self.user,
+            place="Home",
+            time=time,
+            action=f"Habit every {frequency}",
+            duration=60,
+            frequency=frequency,
+        )
+        created_at = timezone.now() - timedelta(days=days_ago)
+        Habit.objects.filter(pk=habit.pk).update(created_at=created_at)
+        habit.created_at = created_at
+        return habit
+
+    @staticmethod
+    def naive(habits, start, days):
+        expected = []
+        for offset in range(days):
+            date = start + timedelta(days=offset)
+            for habit in habits:
+                anchor = timezone.localdate(habit.created_at)
+                if date >= anchor and (date - anchor).days % habit.frequency == 0:
+                    expected.append((date.isoformat(), str(habit.time), habit.id))
+        return sorted(expected)
+
+    def schedule(self, **params):
+        response = self.client.get(reverse("habit-schedule"), params)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        if response.streaming:
+            items = json.loads(b"".join(response.streaming_content))
+        else:
+            items = json.loads(response.content)
+        return [(item["date"], item["time"], item["habit"]) for item in items]
+
+    def test_schedule_matches_naive_projection(self):
+        habits = [
+            self.create("08:00:00", 1),
+            self.create("07:00:00", 3, days_ago=2),
+            self.create("07:00:00", 7, days_ago=30),
+        ]
+        habits.append(self.create("09:30:00", 2, days_ago=-3))
+        self.create("06:00:00", 1, user=User.objects.create_user(username="x"))
+        start = self.today - timedelta(days=1)
+        self.assertEqual(
+            self.schedule(start=start.isoformat(), days=14),
+            self.naive(habits, start, 14),
+        )
+        self.assertEqual(len(self.schedule()), len(self.naive(habits, self.today, 7)))
+
+    def test_projection_for_random_habits(self):
+        rng = random.Random(1)
+        habits = [
+            self.create(
+                f"{rng.randrange(24):02d}:{rng.randrange(60):02d}:00",
+                rng.randint(1, 7),
+                days_ago=rng.randint(-20, 60),
+            )
+            for _ in range(40)
+        ]
+        arrays = HabitArrays.for_user(self.user)
+        for _ in range(10):
+            start = self.today + timedelta(days=rng.randint(-30, 30))
+            days = rng.randint(1, 40)
+            index, dates = project(arrays, start, start + timedelta(days=days))
+            result = [
+                (str(date), str(arrays.times[position]), int(arrays.ids[position]))
+                for position, date in zip(index, dates)
+            ]
+            self.assertEqual(result, self.naive(habits, start, days))
+
+    def test_habit_without_creation_time_uses_legacy_anchor(self):
+        habit = self.create("08:00:00", 2)
+        Habit.objects.filter(pk=habit.pk).update(created_at=None)
+        start = LEGACY_ANCHOR + timedelta(
+            days=(self.today - LEGACY_ANCHOR).days // 2 * 2
+        )
+        self.assertEqual(
+            [date for date, _, _ in self.schedule(start=start.isoformat(), days=4)],
+            [start.isoformat(), (start + timedelta(days=2)).isoformat()],
+        )
+
+    def test_schedule_is_cached_per_habit_set_version(self):
+        self.create("08:00:00", 1)
+        first = self.schedule(days=3)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.schedule(days=3), first)
+        habit = self.create("07:00:00", 1)
+        self.assertEqual(len(self.schedule(days=3)), 6)
+        habit.delete()
+        self.assertEqual(self.schedule(days=3), first)
+
+    def test_long_ranges_are_streamed(self):
+        habits = [self.create("08:00:00", 2), self.create("07:00:00", 5)]
+        response = self.client.get(reverse("habit-schedule"), {"days": 120})
+        self.assertTrue(response.streaming)
+        self.assertEqual(self.schedule(days=120), self.naive(habits, self.today, 120))
+        Habit.objects.all().delete()
+        self.assertEqual(self.schedule(days=120), [])
+
+    def test_invalid_range(self):
+        url = reverse("habit-schedule")
+        for params in ({"days": 0}, {"days": 1000}, {"start": "tomorrow"}):
+            self.assertEqual(
+                self.client.get(url, params).status_code, status.HTTP_400_BAD_REQUEST
+            )
+
+
+def add_sqlite_database(alias):
+    """
+    Подключает отдельную базу SQLite alias. Тестовый раннер создает для нее
+    тестовую базу и применяет миграции так же, как для default.
+    """
+    configured = connections.configure_settings(
+        {
+            "default": connections.settings["default"],
+            alias: {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"},
+        }
+    )
+    connections.settings[alias] = configured[alias]
+
+
+# Реплики для ReplicaRoutingTests должны быть подключены до запуска тестов
+REPLICA_ALIASES = ("replica_1", "replica_2")
+for alias in REPLICA_ALIASES:
+    add_sqlite_database(alias)
+
+
+class ReplicaRoutingTests(APITransactionTestCase):
+    # TestCase держит основную базу в транзакции, а внутри транзакции
+    # роутер не читает из реплик
+    replicas = REPLICA_ALIASES
+    databases = {"default", *REPLICA_ALIASES}
+
+    def setUp(self):
+        cache.clear()
+        routers.health.reset()
+        self.addCleanup(routers.health.reset)
+        override = override_settings(DATABASE_REPLICAS=list(self.replicas))
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="reader", password="12345")
+        self.habit = self.create_habit("default", "Primary habit")
+        for alias in self.replicas:
+            # bulk_create не вызывает сигналы, которые пишут в основную базу
+            User.objects.using(alias).bulk_create(
+                [User(id=self.user.id, username="reader", password="x")]
+            )
+            # Реплика отстает: в ней привычка еще со старым названием
+            self.create_habit(alias, f"Stale in {alias}", pk=self.habit.pk)
+        self.client.force_authenticate(user=self.user)
+
+    def create_habit(self, alias, action, **fields):
+        habit = Habit(
+            user_id=self.user.id,
+            action=action,
+            place="Home",
+            time="08:00:00",
+            duration=60,
+            **fields,
+        )
+        habit.save(using=alias)
+        return habit
+
+    def actions(self, client=None):
+        response = (client or self.client).get(reverse("habit-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [item["action"] for item in response.data["results"]]
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        self.assertIn(self.actions(), [["Stale in replica_1"], ["Stale in replica_2"]])
+        self.assertIn(Habit.objects.all().db, self.replicas)
+        self.assertEqual(Habit.objects.select_for_update().db, "default")
+        with transaction.atomic():
+            self.assertEqual(Habit.objects.all().db, "default")
+
+    def test_reads_are_pinned_to_primary_after_write(self):
+        response = self.client.patch(
+            reverse("habit-detail", args=[self.habit.pk]),
+            {"action": "Renamed"},
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn(routers.PIN_COOKIE, response.cookies)
+        self.assertEqual(self.actions(), ["Renamed"])
+
+        # Другое устройство того же пользователя без cookie
+        other_device = APIClient()
+        token = RefreshToken.for_user(self.user).access_token
+        other_device.credentials(HTTP_AUTHORIZATION=f"Bearer {token}")
+        self.assertEqual(self.actions(other_device), ["Renamed"])
+
+        cache.clear()
+        self.client.cookies.clear()
+        self.assertNotEqual(self.actions(), ["Renamed"])
+
+    def test_lagging_replica_is_avoided(self):
+        def lag(connection):
+            return 60.0 if connection.alias == "replica_1" else 0.0
+
+        with (
+            patch("habits.routers.measure_lag", side_effect=lag),
+            self.assertLogs("habits.routers", "WARNING"),
+        ):
+            for _ in range(5):
+                self.assertEqual(self.actions(), ["Stale in replica_2"])
+
+        routers.health.reset()
+        with (
+            patch("habits.routers.measure_lag", return_value=60.0),
+            self.assertLogs("habits.routers", "WARNING"),
+        ):
+            self.assertEqual(self.actions(), ["Primary habit"])
+
+    def test_unavailable_replica_is_skipped_until_recheck(self):
+        def probe(connection):
+            if connection.alias == "replica_1":
+                raise OperationalError("connection refused")
+            return 0.0
+
+        with (
+            patch("habits.routers.measure_lag", side_effect=probe) as measure,
+            self.assertLogs("habits.routers", "WARNING"),
+        ):
+            for _ in range(5):
+                self.assertEqual(self.actions(), ["Stale in replica_2"])
+            self.assertEqual(measure.call_count, 2)
+            with override_settings(REPLICA_CHECK_INTERVAL=0):
+                self.actions()
+            self.assertGreater(measure.call_count, 2)
+
+
+SHARD_ALIASES = ("shard_1", "shard_2")
+for alias in SHARD_ALIASES:
+    add_sqlite_database(alias)
+
+
+class ShardingTests(APITransactionTestCase):
+    shards = ["default", *SHARD_ALIASES]
+    databases = {"default", *SHARD_ALIASES}
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        # Тесты идут в одном процессе, поэтому кэш назначений общий
+        override = override_settings(
+            HABIT_SHARDS=self.shards,
+            SHARD_MOVE_GRACE=0,
+            SHARD_PLACEMENT_SHARED_CACHE=True,
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        for alias in self.shards:
+            sharding.prepare_shard(alias)
+
+    def user_on(self, alias, username):
+        user = User.objects.create_user(username=username, password="12345")
+        sharding.move_user(user.pk, alias)
+        return user
+
+    def create_habit(self, user, action, **fields):
+        with sharding.use_shard(sharding.shard_for_user(user.pk)):
+            return Habit.objects.create(
+                user=user,
+                action=action,
+                place="Home",
+                time=fields.pop("time", "08:00:00"),
+                duration=60,
+                **fields,
+            )
+
+    def habit_shards(self, user):
+        return [
+            alias
+            for alias in self.shards
+            if Habit.objects.using(alias).filter(user_id=user.pk).exists()
+        ]
+
+    def test_adding_node_moves_keys_only_to_new_node(self):
+        before = sharding.HashRing(["a", "b"])
+        after = sharding.HashRing(["a", "b", "c"])
+        moved = [
+            key for key in range(3000) if before.node_for(key) != after.node_for(key)
+        ]
+        self.assertTrue(all(after.node_for(key) == "c" for key in moved))
+        self.assertLess(len(moved), 3000 * 0.45)
+        self.assertGreater(len(moved), 3000 * 0.2)
+
+    def test_new_user_data_lives_on_assigned_shard(self):
+        user = User.objects.create_user(username="sharded", password="12345")
+        shard = sharding.shard_for_user(user.pk)
+        self.assertEqual(shard, sharding.ring().node_for(user.pk))
+        self.assertTrue(
+            UserProfile.objects.using(shard).filter(user_id=user.pk).exists()
+        )
+
+        self.client.force_authenticate(user=user)
+        response = self.client.post(
+            reverse("habit-list"),
+            {"action": "Read", "place": "Home", "time": "08:00:00", "duration": 60},
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(self.habit_shards(user), [shard])
+        response = self.client.get(reverse("habit-list"))
+        self.assertEqual(
+            [item["action"] for item in response.data["results"]], ["Read"]
+        )
+
+        response = self.client.post(reverse("set-telegram-chat-id"), {"chat_id": "42"})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = UserProfile.objects.using(shard).get(user_id=user.pk)
+        self.assertEqual(profile.telegram_chat_id, "42")
+
+    def test_habit_ids_do_not_overlap_between_shards(self):
+        for index, alias in enumerate(self.shards):
+            habit = self.create_habit(self.user_on(alias, alias), "Read")
+            self.assertEqual(habit.pk // sharding.ID_RANGE, index)
+
+    @patch("habits.tasks.send_notifications.delay")
+    def test_reminder_tick_gathers_all_shards(self, mock_send_notification):
+        now = timezone.now()
+        for alias in self.shards:
+            user = self.user_on(alias, alias)
+            with sharding.use_shard(alias):
+                UserProfile.objects.filter(user=user).update(telegram_chat_id=alias)
+            self.create_habit(user, f"Habit on {alias}", time=now.time())
+        # Тик должен прийтись на ту же минуту, что и время привычек
+        with patch("django.utils.timezone.now", return_value=now):
+            send_habit_reminders()
+        self.assertCountEqual(
+            queued_messages(mock_send_notification),
+            [
+                (
+                    "telegram",
+                    alias,
+                    f"Напоминание: Время для привычки 'Habit on {alias}'",
+                )
+                for alias in self.shards
+            ],
+        )
+
+    def test_rebalance_moves_users_and_keeps_habit_ids(self):
+        with override_settings(HABIT_SHARDS=["default"]):
+            users = [
+                User.objects.create_user(username=f"user{number}", password="12345")
+                for number in range(6)
+            ]
+            habits = {
+                user.pk: self.create_habit(user, f"Habit {user.pk}") for user in users
+            }
+            for habit in habits.values():
+                HabitCompletion.objects.create(habit=habit, date=timezone.localdate())
+        targets = {user.pk: sharding.ring().node_for(user.pk) for user in users}
+        expected = sum(target != "default" for target in targets.values())
+        self.assertGreater(expected, 0)
+
+        out = io.StringIO()
+        call_command("rebalance_shards", "--dry-run", stdout=out)
+        self.assertIn(f"Требуют переноса пользователей: {expected}.", out.getvalue())
+        self.assertEqual(Habit.objects.using("default").count(), 6)
+
+        out = io.StringIO()
+        call_command("rebalance_shards", stdout=out)
+        self.assertIn(f"Перенесено пользователей: {expected}.", out.getvalue())
+        for user in users:
+            target = targets[user.pk]
+            self.assertEqual(sharding.shard_for_user(user.pk), target)
+            self.assertEqual(self.habit_shards(user), [target])
+            habit = Habit.objects.using(target).get(user_id=user.pk)
+            self.assertEqual(habit.pk, habits[user.pk].pk)
+            self.assertEqual(habit.completions.count(), 1)
+            self.assertTrue(
+                UserProfile.objects.using(target).filter(user_id=user.pk).exists()
+            )
+        self.assertEqual(HabitCompletion.objects.using("default").count(), 6 - expected)
+
+        out = io.StringIO()
+        call_command("rebalance_shards", stdout=out)
+        self.assertIn("Перенесено пользователей: 0.", out.getvalue())
+
+    def test_writes_are_rejected_while_user_is_moving(self):
+        user = self.user_on("shard_1", "moving")
+        self.create_habit(user, "Read")
+        sharding.set_placement(user.pk, "shard_1", moving=True)
+        self.client.force_authenticate(user=user)
+        response = self.client.post(
+            reverse("habit-list"),
+            {"action": "Write", "place": "Home", "time": "08:00:00", "duration": 60},
+        )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        response = self.client.get(reverse("habit-list"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data["count"], 1)
+
+    def test_import_places_users_on_ring_shards(self):
+        path = Path(tempfile.mkdtemp()) / "users.ndjson"
+        self.addCleanup(path.unlink)
+        path.write_text(
+            "\n".join(
+                json.dumps(
+                    {
+                        "username": f"imported{number}",
+                        "telegram_chat_id": number,
+                        "action": "Read",
+                        "place": "Home",
+                        "time": "08:00",
+                        "duration": 60,
+                    }
+                )
+                for number in range(6)
+            ),
+            encoding="utf-8",
+        )
+        call_command("import_habits", str(path), "--workers", "0", stdout=io.StringIO())
+        for user in User.objects.filter(username__startswith="imported"):
+            shard = sharding.ring().node_for(user.pk)
+            self.assertEqual(sharding.shard_for_user(user.pk), shard)
+            self.assertEqual(self.habit_shards(user), [shard])
+            self.assertTrue(
+                UserProfile.objects.using(shard).filter(user_id=user.pk).exists()
+            )
+
+    def test_import_retries_batch_after_failed_shard_write(self):
+        def rows():
+            return read_rows(
+                io.StringIO(
+                    "\n".join(
+                        json.dumps(
+                            {
+                                "username": f"batch{number}",
+                                "action": "Read",
+                                "place": "Home",
+                                "time": "08:00",
+                                "duration": 60,
+                            }
+                        )
+                        for number in range(12)
+                    )
+                ),
+                "ndjson",
+            )
+
+        write_habits = Importer._write_habits
+
+        def fail_on_shard_2(alias, habits):
+            if alias == "shard_2":
+                raise OperationalError("shard_2 is down")
+            write_habits(alias, habits)
+
+        with (
+            patch.object(Importer, "_write_habits", side_effect=fail_on_shard_2),
+            self.assertRaises(OperationalError),
+        ):
+            Importer("users.ndjson").run(rows())
+        users = list(User.objects.filter(username__startswith="batch"))
+        user_ids = [user.pk for user in users]
+        self.assertEqual(len(users), 12)
+        self.assertIn("shard_2", {sharding.shard_for_user(pk) for pk in user_ids})
+        self.assertFalse(
+            UserProfile.objects.using("shard_2").filter(user_id__in=user_ids).exists()
+        )
+
+        # Повтор дописывает незавершенный пакет без повторной записи на
+        # шарды, где он уже есть
+        importer = Importer("users.ndjson")
+        self.assertEqual(importer.run(rows()), 12)
+        self.assertEqual((importer.users, importer.habits), (12, 12))
+        self.assertEqual(User.objects.filter(username__startswith="batch").count(), 12)
+        for user in users:
+            shard = sharding.shard_for_user(user.pk)
+            self.assertEqual(self.habit_shards(user), [shard])
+            self.assertEqual(Habit.objects.using(shard).filter(user=user).count(), 1)
+            self.assertEqual(
+                UserProfile.objects.using(shard).filter(user_id=user.pk).count(), 1
+            )
+
+    def test_streaming_responses_read_the_user_shard(self):
+        user = self.user_on("shard_1", "streamer")
+        self.create_habit(user, "Read", time="07:30:00")
+        self.client.force_authenticate(user=user)
+
+        response = self.client.get(
+            reverse("habit-export", kwargs={"file_format": "ndjson"})
+        )
+        rows = [
+            json.loads(line)
+            for line in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual([row["action"] for row in rows], ["Read"])
+
+        response = self.client.get(
+            reverse("habit-schedule"),
+            {"days": settings.SCHEDULE_STREAM_DAYS + 1},
+        )
+        self.assertTrue(response.streaming)
+        items = json.loads(b"".join(response.streaming_content))
+        self.assertEqual(len(items), settings.SCHEDULE_STREAM_DAYS + 1)
+        self.assertEqual(items[0]["action"], "Read")
+
+    def test_complete_locks_habit_in_its_shard_transaction(self):
+        user = self.user_on("shard_1", "completer")
+        habit_id = self.create_habit(user, "Read").pk
+        habit = Habit.objects.using("shard_1").get(pk=habit_id)
+        shard = connections["shard_1"]
+        in_transaction = []
+
+        def check(execute, sql, params, many, context):
+            # BEGIN SQLite выполняет до входа в блок
+            if sql != "BEGIN":
+                in_transaction.append(shard.in_atomic_block)
+            return execute(sql, params, many, context)
+
+        with shard.execute_wrapper(check):
+            habit.complete(timezone.localdate())
+        self.assertTrue(in_transaction)
+        self.assertTrue(all(in_transaction))
+        self.assertEqual(
+            Habit.objects.using("shard_1").get(pk=habit_id).current_streak, 1
+        )
+
+    def test_maintenance_tasks_cover_all_shards(self):
+        habits = []
+        for alias in self.shards:
+            user = self.user_on(alias, alias)
+            with sharding.use_shard(alias):
+                UserProfile.objects.filter(user=user).update(telegram_chat_id=alias)
+            habit = self.create_habit(user, f"Habit on {alias}", current_streak=5)
+            HabitCompletion.objects.using(alias).create(
+                habit=habit, date=timezone.localdate()
+            )
+            habits.append(habit.pk)
+
+        self.assertEqual(tasks.set_habits_public(habits, True), len(self.shards))
+        for alias in self.shards:
+            self.assertTrue(Habit.objects.using(alias).get().is_public)
+
+        with patch("habits.tasks.send_notifications.delay") as send:
+            self.assertEqual(tasks.resend_habit_reminders(habits), len(self.shards))
+        self.assertCountEqual(
+            [chat_id for _, chat_id, _ in queued_messages(send)], self.shards
+        )
+
+        out = io.StringIO()
+        call_command("rebuild_streaks", stdout=out)
+        self.assertIn(f"Исправлено привычек: {len(self.shards)},", out.getvalue())
+        for alias in self.shards:
+            self.assertEqual(Habit.objects.using(alias).get().current_streak, 1)
+
+        admin = User.objects.create_superuser(username="admin", password="12345")
+        self.client.force_authenticate(user=admin)
+        response = self.client.get(
+            reverse("admin-habits-export", kwargs={"file_format": "ndjson"})
+        )
+        actions = [
+            json.loads(line)["action"]
+            for line in b"".join(response.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(actions, [f"Habit on {alias}" for alias in self.shards])
+
+    def test_cross_user_reads_cover_all_shards(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(RECOMMENDATIONS_DIR=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        habits = [
+            self.create_habit(
+                self.user_on(alias, alias),
+                f"Morning run {alias}",
+                is_public=True,
+                is_pleasant=True,
+            )
+            for alias in self.shards
+        ]
+        actions = [habit.action for habit in habits]
+
+        with patch("rest_framework.pagination.PageNumberPagination.page_size", 2):
+            first = self.client.get(reverse("public-habits")).data
+            second = self.client.get(reverse("public-habits"), {"page": 2}).data
+        self.assertEqual(first["count"], 3)
+        self.assertEqual([item["action"] for item in first["results"]], actions[:2])
+        self.assertEqual([item["action"] for item in second["results"]], actions[2:])
+        response = self.client.get(reverse("public-habits"), {"search": "run shard"})
+        self.assertCountEqual(
+            [item["action"] for item in response.data["results"]], actions[1:]
+        )
+
+        refresh_popular_habits()
+        self.assertCountEqual(
+            [item["action"] for item in popularity.get_popular_habits()], actions
+        )
+
+        refresh_index()
+        similar, related = recommend("Morning run", "Home", 5)
+        self.assertCountEqual([habit.pk for habit in similar], [h.pk for h in habits])
+        self.assertCountEqual([habit.pk for habit in related], [h.pk for h in habits])
+
+        # Связанной может быть приятная привычка с другого шарда
+        user = self.user_on("shard_1", "linker")
+        self.client.force_authenticate(user=user)
+        response = self.client.post(
+            reverse("habit-list"),
+            {
+                "action": "Stretch",
+                "place": "Home",
+                "time": "08:00:00",
+                "duration": 60,
+                "related_habit": habits[2].pk,
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(
+            Habit.objects.using("shard_1").get(pk=response.data["id"]).related_habit_id,
+            habits[2].pk,
+        )
+        response = self.client.post(
+            reverse("habit-list"),
+            {
+                "action": "Stretch",
+                "place": "Home",
+                "time": "08:00:00",
+                "duration": 60,
+                "related_habit": 3 * sharding.ID_RANGE,
+            },
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_admin_lists_and_opens_objects_on_any_shard(self):
+        habit = self.create_habit(self.user_on("shard_2", "owner"), "Read")
+        admin = User.objects.create_superuser(username="admin", password="12345")
+        self.client.force_login(admin)
+        url = reverse("admin:habits_habit_changelist")
+        self.assertNotContains(self.client.get(url), "owner")
+        response = self.client.get(url, {"shard": "shard_2"})
+        self.assertContains(response, "owner")
+        response = self.client.get(url, {"shard": "shard_2", "q": "owner"})
+        self.assertContains(response, "owner")
+        response = self.client.get(
+            reverse("admin:habits_habit_change", args=[habit.pk])
+        )
+        self.assertContains(response, 'value="Read"')
+
+    def test_placement_cache_expires_and_moves_wait_for_it(self):
+        user = User.objects.create_user(username="cached", password="12345")
+        with patch.object(sharding.cache, "set", wraps=cache.set) as cache_set:
+            cache.clear()
+            sharding.placement(user.pk)
+        self.assertEqual(
+            cache_set.call_args.args[2], settings.SHARD_PLACEMENT_CACHE_TTL
+        )
+
+        target = next(
+            alias for alias in self.shards if alias != sharding.shard_for_user(user.pk)
+        )
+        with (
+            override_settings(
+                SHARD_PLACEMENT_SHARED_CACHE=False, SHARD_PLACEMENT_CACHE_TTL=30
+            ),
+            patch("habits.sharding.time.sleep") as sleep,
+        ):
+            sharding.move_user(user.pk, target)
+        # Перед копированием и перед удалением со старого шарда
+        self.assertEqual([call.args[0] for call in sleep.call_args_list], [30, 30])
+
+    def test_deleting_user_removes_sharded_data(self):
+        user = self.user_on("shard_2", "leaving")
+        self.create_habit(user, "Read")
+        user.delete()
+        self.assertFalse(Habit.objects.using("shard_2").exists())
+        self.assertFalse(UserProfile.objects.using("shard_2").exists())
+
+
+class ImportHabitsTests(TestCase):
+    header = (
+        "username,email,password,telegram_chat_id,action,place,time,duration,"
+        "frequency,reward,is_pleasant,is_public"
+    )
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def write(self, name, lines):
+        path = Path(self.tmpdir.name) / name
+        path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return str(path)
+
+    def run_import(self, path, *args):
+        out = io.StringIO()
+        call_command("import_habits", path, "--workers", "0", *args, stdout=out)
+        return out.getvalue()
+
+    def test_imports_users_profiles_and_habits(self):
+        path = self.write(
+            "habits.csv",
+            [
+                self.header,
+                "anna,anna@example.com,secret123,100,Read a book,Home,08:00,60,1,,,1",
+                "anna,,,,Walk,Park,18:30,120,2,Cake,false,0",
+                "boris,boris@example.com,secret456,,,,,,,,,",
+                "carl,,pass,,Run,Street,07:00,30,8,,,",
+                "dina,,pass,,Rest,Sofa,25:00,30,1,,,",
+                "egor,,pass,,Nap,Bed,13:00,30,1,Cookie,yes,",
+                "fedor,,pass,,Swim,Pool,09:00,121,1,,,",
+            ],
+        )
+        errors = str(Path(self.tmpdir.name) / "errors.csv")
+        output = self.run_import(path, "--errors", errors)
+
+        self.assertIn("привычек: 2, отклонено строк: 4.", output)
+        self.assertIn("строк/с", output)
+        self.assertEqual(
+            sorted(User.objects.values_list("username", flat=True)), ["anna", "boris"]
+        )
+        anna = User.objects.get(username="anna")
+        self.assertTrue(anna.check_password("secret123"))
+        self.assertEqual(anna.email, "anna@example.com")
+        self.assertEqual(anna.profile.telegram_chat_id, "100")
+        self.assertEqual(UserProfile.objects.count(), 2)
+        self.assertFalse(User.objects.get(username="boris").profile.telegram_chat_id)
+        habits = {habit.action: habit for habit in Habit.objects.filter(user=anna)}
+        self.assertEqual(set(habits), {"Read a book", "Walk"})
+        self.assertTrue(habits["Read a book"].is_public)
+        self.assertEqual(habits["Walk"].frequency, 2)
+        self.assertEqual(habits["Walk"].reward, "Cake")
+        self.assertEqual(str(habits["Walk"].time), "18:30:00")
+
+        with open(errors, encoding="utf-8") as stream:
+            rejected = dict(list(csv.reader(stream))[1:])
+        self.assertEqual(
+            rejected,
+            {
+                "4": "Нельзя выполнять привычку реже, чем раз в 7 дней.",
+                "5": "Некорректное значение поля time.",
+                "6": "Приятные привычки не могут иметь вознаграждения или связанных привычек.",
+                "7": "Некорректное значение поля duration.",
+            },
+        )
+
+    def test_validation_matches_model_clean(self):
+        rows = [
+            ("Cake", "true", "1"),
+            ("", "true", "1"),
+            ("Cake", "false", "7"),
+            ("", "false", "8"),
+        ]
+        path = self.write(
+            "rules.csv",
+            [self.header]
+            + [
+                f"user{index},,,,Act,Home,08:00,60,{frequency},{reward},{pleasant},"
+                for index, (reward, pleasant, frequency) in enumerate(rows)
+            ],
+        )
+        self.run_import(path)
+        user = User.objects.create_user(username="model", password="12345")
+        for index, (reward, pleasant, frequency) in enumerate(rows):
+            habit = Habit(
+                user=user,
+                action="Act",
+                place="Home",
+                time="08:00",
+                duration=60,
+                frequency=int(frequency),
+                reward=reward,
+                is_pleasant=pleasant == "true",
+            )
+            try:
+                habit.clean()
+                valid = True
+            except ValidationError:
+                valid = False
+            imported = Habit.objects.filter(user__username=f"user{index}").exists()
+            self.assertEqual(imported, valid, rows[index])
+
+    def test_import_resumes_from_checkpoint(self):
+        path = self.write(
+            "resume.ndjson",
+            [
+                json.dumps(
+                    {
+                        "username": f"user{number}",
+                        "action": f"Habit {number}",
+                        "place": "Home",
+                        "time": "08:00",
+                        "duration": 60,
+                    }
+                )
+                for number in range(5)
+            ],
+        )
+        original = Importer._write_habits
+        calls = []
+
+        def fail_on_second_batch(alias, habits):
+            calls.append(alias)
+            if len(calls) == 2:
+                raise OperationalError("connection lost")
+            original(alias, habits)
+
+        with patch.object(Importer, "_write_habits", side_effect=fail_on_second_batch):
+            with self.assertRaises(OperationalError):
+                self.run_import(path, "--batch-size", "2")
+        self.assertEqual(Habit.objects.count(), 2)
+        # Пользователи прерванного пакета остаются и не создаются повторно
+        self.assertEqual(User.objects.count(), 4)
+        checkpoint = TaskCheckpoint.objects.get(name="import:resume.ndjson")
+        self.assertEqual(checkpoint.value["rows"], 2)
+        self.assertEqual(sorted(checkpoint.value["batch"]["users"]), ["user2", "user3"])
+
+        output = self.run_import(path, "--batch-size", "2")
+        self.assertIn("Обработано строк: 3.", output)
+        self.assertIn("пользователей: 5, привычек: 5", output)
+        self.assertEqual(
+            sorted(Habit.objects.values_list("action", flat=True)),
+            [f"Habit {number}" for number in range(5)],
+        )
+        self.assertIn("Обработано строк: 0.", self.run_import(path))
+        # Заново импортируются только привычки, пользователи уже существуют
+        self.assertIn("Обработано строк: 5.", self.run_import(path, "--restart"))
+        self.assertEqual(Habit.objects.count(), 10)
+        self.assertEqual(User.objects.count(), 5)
+
+    def test_existing_users_keep_password_and_get_habits(self):
+        user = User.objects.create_user(username="anna", password="original")
+        version = habit_set_version(user.pk)
+        path = self.write(
+            "existing.csv",
+            [self.header, "anna,,changed,,Read,Home,08:00,60,1,,,"],
+        )
+        self.run_import(path)
+        user.refresh_from_db()
+        self.assertTrue(user.check_password("original"))
+        self.assertEqual(user.habits.count(), 1)
+        self.assertNotEqual(habit_set_version(user.pk), version)
+        self.assertEqual(UserProfile.objects.count(), 1)
+
+    def test_passwords_are_hashed_in_worker_processes(self):
+        path = self.write(
+            "pool.csv",
+            [self.header, "anna,,first,,,,,,,,,", "boris,,second,,,,,,,,,"],
+        )
+        call_command("import_habits", path, "--workers", "2", stdout=io.StringIO())
+        self.assertTrue(User.objects.get(username="anna").check_password("first"))
+        self.assertTrue(User.objects.get(username="boris").check_password("second"))
+
+
+class HabitEventTests(TestCase):
+    def setUp(self):
+        events.get_stream().clear()
+        self.addCleanup(events.get_stream().clear)
+        self.user = User.objects.create_user(username="testuser", password="12345")
+
+    def create_habit(self, action):
+        return Habit.objects.create(
+            user=self.user, place="Home", time="08:00:00", action=action, duration=60
+        )
+
+    def test_transaction_is_published_after_commit_as_one_batch(self):
+        habit = self.create_habit("Read")
+        events.get_stream().clear()
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                created = self.create_habit("Walk")
+                habit.action = "Read a book"
+                habit.save()
+                habit.delete()
+                self.assertEqual(events.replay(), [])
+
+        batch = events.replay()
+        self.assertEqual(
+            [(event["op"], event["pk"]) for event in batch],
+            [
+                (events.CREATE, created.pk),
+                (events.UPDATE, batch[1]["pk"]),
+                (events.DELETE, batch[1]["pk"]),
+            ],
+        )
+        self.assertEqual(len({event["tx"] for event in batch}), 1)
+        self.assertEqual(batch[0]["model"], "habits.habit")
+        self.assertEqual(batch[0]["user_id"], self.user.pk)
+        self.assertEqual(batch[1]["data"]["action"], "Read a book")
+        self.assertEqual(batch[1]["data"]["time"], "08:00:00")
+        self.assertIsNone(batch[2]["data"])
+
+    def test_rolled_back_changes_are_not_published(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                kept = self.create_habit("Kept")
+                try:
+                    with transaction.atomic():
+                        self.create_habit("Lost")
+                        raise OperationalError("rollback")
+                except OperationalError:
+                    pass
+        self.assertEqual([event["pk"] for event in events.replay()], [kept.pk])
+
+    def test_profile_changes_are_published(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            user = User.objects.create_user(username="other", password="12345")
+        self.assertEqual(
+            [(event["model"], event["op"]) for event in events.replay()],
+            [
+                ("habits.userprofile", events.CREATE),
+                ("habits.userprofile", events.UPDATE),
+            ],
+        )
+        self.assertEqual(events.replay()[0]["user_id"], user.pk)
+
+    def test_consumer_groups_and_replay(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            habits = [self.create_habit(f"Habit {number}") for number in range(4)]
+        ids = [event["id"] for event in events.replay()]
+        self.assertEqual(len(ids), 4)
+        self.assertEqual(
+            [event["pk"] for event in events.replay(after=ids[1])],
+            [habit.pk for habit in habits[2:]],
+        )
+
+        events.create_group("analytics")
+        first = events.read_group("analytics", "worker-1", count=3)
+        second = events.read_group("analytics", "worker-2", count=3)
+        self.assertEqual([event["id"] for event in first + second], ids)
+        self.assertEqual(events.read_group("analytics", "worker-1"), [])
+
+        # После перезапуска потребитель получает свои неподтвержденные события
+        self.assertEqual(
+            events.read_group("analytics", "worker-1", pending=True), first
+        )
+        self.assertEqual(events.ack("analytics", ids[:2]), 2)
+        self.assertEqual(
+            [
+                event["id"]
+                for event in events.read_group("analytics", "worker-1", pending=True)
+            ],
+            ids[2:3],
+        )
+
+        # Каждая группа читает поток независимо
+        events.create_group("search")
+        self.assertEqual(len(events.read_group("search", "indexer")), 4)
+
+    def test_stream_errors_do_not_break_commit(self):
+        with (
+            patch.object(
+                events.get_stream(), "add", side_effect=ConnectionError("down")
+            ),
+            self.assertLogs("habits.events", "WARNING"),
+            self.captureOnCommitCallbacks(execute=True),
+        ):
+            self.create_habit("Read")
+        self.assertEqual(Habit.objects.count(), 1)
+
+    @override_settings(EVENTS_PUBLISH_IN_BACKGROUND=True)
+    def test_batches_are_written_in_background(self):
+        stream = events.get_stream()
+        threads = []
+
+        def add(encoded, add=stream.add):
+            threads.append(threading.current_thread())
+            return add(encoded)
+
+        with patch.object(stream, "add", side_effect=add):
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    first = self.create_habit("Read")
+                    second = self.create_habit("Walk")
+            events._publisher.join()
+        self.assertEqual(
+            [event["pk"] for event in events.replay()], [first.pk, second.pk]
+        )
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.current_thread())
+
+    def test_command_reads_group_and_acknowledges(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            habit = self.create_habit("Read")
+        out = io.StringIO()
+        call_command("habit_events", "--group", "cli", "--consumer", "me", stdout=out)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([line["pk"] for line in lines], [habit.pk])
+        self.assertEqual(events.read_group("cli", "me", pending=True), [])
+
+        out = io.StringIO()
+        call_command("habit_events", "--after", lines[0]["id"], stdout=out)
+        self.assertEqual(out.getvalue(), "")
+
+
+class EventStreamTests(TestCase):
+    def setUp(self):
+        push.get_backend().clear()
+        self.addCleanup(push.get_backend().clear)
+        events.get_stream().clear()
+        self.addCleanup(events.get_stream().clear)
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.other = User.objects.create_user(username="other", password="12345")
+        token = RefreshToken.for_user(self.user).access_token
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+    async def connect(self, **headers):
+        response = await self.async_client.get(
+            reverse("event-stream"), headers={**self.headers, **headers}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        content = response.streaming_content
+        self.assertEqual(await anext(content), b"retry: 3000\n\n")
+        return content
+
+    @staticmethod
+    async def next_event(content):
+        chunk = (await anext(content)).decode()
+        fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+        return fields["id"], fields["event"], json.loads(fields["data"])
+
+    def reminder(self, user, action):
+        return {"user_id": user.pk, "event": "reminder", "data": {"action": action}}
+
+    def change_habit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                habit = Habit.objects.create(
+                    user=self.user,
+                    place="Home",
+                    time="08:00",
+                    action="Read",
+                    duration=60,
+                )
+        return habit
+
+    async def test_requires_authentication(self):
+        response = await self.async_client.get(reverse("event-stream"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_streams_own_reminders_and_habit_changes(self):
+        content = await self.connect()
+        self.assertEqual(push.hub.connections(), 1)
+        push.publish(
+            [self.reminder(self.other, "Other"), self.reminder(self.user, "Mine")]
+        )
+        _, event, data = await self.next_event(content)
+        self.assertEqual((event, data), ("reminder", {"action": "Mine"}))
+
+        habit = await sync_to_async(self.change_habit)()
+        _, event, data = await self.next_event(content)
+        self.assertEqual(event, "habit")
+        self.assertEqual((data["op"], data["pk"]), (events.CREATE, habit.pk))
+        self.assertEqual(data["data"]["action"], "Read")
+
+        # Так ASGI-обработчик Django прерывает ответ при отключении клиента
+        waiting = asyncio.ensure_future(anext(content))
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        self.assertEqual(push.hub.connections(), 0)
+
+    async def test_resumes_from_last_event_id(self):
+        push.publish(
+            [self.reminder(self.user, f"Habit {number}") for number in range(3)]
+        )
+        history = await push.get_backend().history(self.user.pk, "0-0")
+        content = await self.connect(**{"Last-Event-ID": history[0]["id"]})
+        received = [await self.next_event(content) for _ in range(2)]
+        self.assertEqual(
+            [data["action"] for _, _, data in received], ["Habit 1", "Habit 2"]
+        )
+        push.publish([self.reminder(self.user, "Habit 3")])
+        event_id, _, data = await self.next_event(content)
+        self.assertEqual(data["action"], "Habit 3")
+        self.assertGreater(events.parse_id(event_id), events.parse_id(received[-1][0]))
+        await content.aclose()
+
+    @override_settings(SSE_HEARTBEAT=0.01)
+    async def test_idle_connection_gets_heartbeats(self):
+        content = await self.connect()
+        self.assertEqual(await anext(content), b": ping\n\n")
+        await content.aclose()
+
+    @override_settings(SSE_QUEUE_SIZE=2)
+    async def test_slow_client_is_disconnected(self):
+        content = await self.connect()
+        push.publish(
+            [self.reminder(self.user, f"Habit {number}") for number in range(3)]
+        )
+        with self.assertRaises(StopAsyncIteration):
+            await anext(content)
+        self.assertEqual(push.hub.connections(), 0)
+
+    async def test_single_use_ticket(self):
+        token = self.headers["Authorization"].split()[1]
+        response = await self.async_client.get(
+            reverse("event-stream"), {"token": token}
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        response = await self.async_client.post(
+            reverse("event-stream-ticket"), headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        ticket = response.json()["ticket"]
+        response = await self.async_client.get(
+            reverse("event-stream"), {"ticket": ticket}
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        await response.streaming_content.aclose()
+
+        response = await self.async_client.get(
+            reverse("event-stream"), {"ticket": ticket}
+        )
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_refused_outside_asgi(self):
+        response = self.client.get(reverse("event-stream"), headers=self.headers)
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(push.hub.connections(), 0)
+
+    @patch("habits.tasks.send_notifications.delay")
+    def test_reminder_tick_publishes_events(self, mock_send_notification):
+        habit = Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time=timezone.now().time(),
+            action="Read",
+            duration=60,
+        )
+        send_habit_reminders()
+        mock_send_notification.assert_not_called()
+        history = async_to_sync(push.get_backend().history)(self.user.pk, "0-0")
+        reminders = [item for item in history if item["event"] == "reminder"]
+        self.assertEqual(len(reminders), 1)
+        self.assertEqual(reminders[0]["data"]["habit"], habit.pk)
+        self.assertEqual(reminders[0]["data"]["action"], "Read")
+
+
+class HabitAdminTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(username="admin", password="12345")
+        self.client.force_login(self.admin)
+        self.user = User.objects.create_user(username="owner", password="12345")
+        self.user.profile.telegram_chat_id = "555"
+        self.user.profile.save()
+        self.pleasant = self.create_habit("Relax", is_pleasant=True)
+
+    def create_habit(self, action, **fields):
+        return Habit.objects.create(
+            user=self.user,
+            place="Home",
+            time="08:00",
+            action=action,
+            duration=60,
+            **fields,
+        )
+
+    def changelist_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("admin:habits_habit_changelist"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [query["sql"] for query in queries.captured_queries]
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        for number in range(3):
+            self.create_habit(f"Habit {number}", related_habit=self.pleasant)
+        few = self.changelist_queries()
+        for number in range(20):
+            self.create_habit(f"More {number}", related_habit=self.pleasant)
+        self.assertEqual(len(self.changelist_queries()), len(few))
+
+    def test_changelist_counts_are_bounded(self):
+        for sql in self.changelist_queries():
+            if "COUNT(" in sql:
+                self.assertIn("LIMIT", sql)
+
+    def test_paginator_uses_estimate_for_large_tables(self):
+        with patch("habits.admin.estimated_count", return_value=5_000_000):
+            paginator = EstimatedCountPaginator(Habit.objects.order_by("id"), 50)
+            self.assertEqual(paginator.count, 5_000_000)
+            self.assertEqual(paginator.num_pages, 100_000)
+        for number in range(4):
+            self.create_habit(f"Habit {number}")
+        with override_settings(ADMIN_COUNT_LIMIT=3):
+            paginator = EstimatedCountPaginator(
+                Habit.objects.filter(is_pleasant=False).order_by("id"), 2
+            )
+            self.assertEqual(paginator.count, 3)
+
+    def test_change_form_does_not_list_all_habits(self):
+        habit = self.create_habit("Read", related_habit=self.pleasant)
+        response = self.client.get(
+            reverse("admin:habits_habit_change", args=[habit.pk])
+        )
+        self.assertContains(response, "vForeignKeyRawIdAdminField")
+        self.assertContains(response, "admin-autocomplete")
+        self.assertNotContains(response, f'<option value="{self.pleasant.pk}"')
+
+    def run_action(self, action, habits):
+        return self.client.post(
+            reverse("admin:habits_habit_changelist"),
+            {"action": action, "_selected_action": [habit.pk for habit in habits]},
+            follow=True,
+        )
+
+    @override_settings(ADMIN_ACTION_BATCH_SIZE=2)
+    def test_publication_actions_run_in_batches(self):
+        habits = [self.create_habit(f"Habit {number}") for number in range(5)]
+        with patch.object(
+            tasks.set_habits_public, "delay", side_effect=tasks.set_habits_public
+        ) as delay:
+            response = self.run_action("make_public", habits)
+        self.assertContains(response, "Поставлено в очередь привычек: 5.")
+        self.assertEqual(
+            [len(call.args[0]) for call in delay.call_args_list], [2, 2, 1]
+        )
+        self.assertEqual(Habit.objects.filter(is_public=True).count(), 5)
+
+        refresh_popular_habits()
+        with patch.object(
+            tasks.set_habits_public, "delay", side_effect=tasks.set_habits_public
+        ):
+            self.run_action("make_private", habits[:1])
+        self.assertEqual(Habit.objects.filter(is_public=True).count(), 4)
+        self.assertTrue(PopularHabit.objects.get(action="habit 0").dirty)
+
+    def test_resend_reminders_action(self):
+        habit = self.create_habit("Read")
+        with (
+            patch.object(
+                tasks.resend_habit_reminders,
+                "delay",
+                side_effect=tasks.resend_habit_reminders,
+            ),
+            patch("habits.tasks.send_notifications.delay") as send,
+        ):
+            self.run_action("resend_reminders", [habit])
+        self.assertEqual(
+            queued_messages(send),
+            [("telegram", "555", "Напоминание: Время для привычки 'Read'")],
+        )
+
+    def test_profile_changelist_and_search(self):
+        response = self.client.get(
+            reverse("admin:habits_userprofile_changelist"), {"q": "555"}
+        )
+        self.assertContains(response, "owner")
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user(username="mobile", password="12345")
+        self.client.force_authenticate(user=self.user)
+        self.data = {
+            "place": "Office",
+            "time": "09:00:00",
+            "action": "Check emails",
+            "duration": 30,
+        }
+
+    def post_habit(self, data, key="key-1"):
+        return self.client.post(
+            reverse("habit-list"), data, format="json", HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def test_retry_replays_created_habit(self):
+        first = self.post_habit(self.data)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn("Idempotent-Replayed", first)
+
+        with self.assertNumQueries(0):
+            retry = self.post_habit(dict(reversed(self.data.items())))
+        self.assertEqual(retry.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    def test_reused_key_with_other_body_conflicts(self):
+        self.post_habit(self.data)
+        response = self.post_habit({**self.data, "duration": 60})
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    def test_key_in_progress_conflicts(self):
+        def retry_during_create(serializer):
+            retry = APIClient()
+            retry.force_authenticate(user=self.user)
+            responses.append(
+                retry.post(
+                    reverse("habit-list"),
+                    self.data,
+                    format="json",
+                    HTTP_IDEMPOTENCY_KEY="key-1",
+                )
+            )
+            serializer.save(user=self.user)
+
+        responses = []
+        with patch(
+            "habits.views.HabitViewSet.perform_create",
+            side_effect=retry_during_create,
+        ):
+            first = self.post_habit(self.data)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(responses[0].status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 1)
+
+    def test_requests_without_key_or_with_other_keys_run(self):
+        self.client.post(reverse("habit-list"), self.data, format="json")
+        self.client.post(reverse("habit-list"), self.data, format="json")
+        self.post_habit(self.data, key="key-2")
+        self.assertEqual(Habit.objects.filter(user=self.user).count(), 3)
+
+    def test_keys_are_scoped_to_user(self):
+        self.post_habit(self.data)
+        other = User.objects.create_user(username="other", password="12345")
+        self.client.force_authenticate(user=other)
+        response = self.post_habit(self.data)
+        self.assertNotIn("Idempotent-Replayed", response)
+        self.assertEqual(Habit.objects.filter(user=other).count(), 1)
+
+    def test_failed_request_releases_key(self):
+        response = self.post_habit({**self.data, "duration": 500})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.post_habit(self.data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_invalid_key(self):
+        response = self.post_habit(self.data, key="x" * 256)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Habit.objects.exists())
+
+    def test_telegram_chat_id_retry_is_not_saved_again(self):
+        url = reverse("set-telegram-chat-id")
+        response = self.client.post(
+            url, {"chat_id": "42"}, format="json", HTTP_IDEMPOTENCY_KEY="chat"
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        with self.assertNumQueries(0):
+            retry = self.client.post(
+                url, {"chat_id": "42"}, format="json", HTTP_IDEMPOTENCY_KEY="chat"
+            )
+        self.assertEqual(retry.data, response.data)
+        self.assertEqual(retry["Idempotent-Replayed"], "true")
+        response = self.client.post(
+            url, {"chat_id": "43"}, format="json", HTTP_IDEMPOTENCY_KEY="chat"
+        )
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(UserProfile.objects.get(user=self.user).telegram_chat_id, "42")
+
+
+def resolved(address):
+    """
+    Результат socket.getaddrinfo для хоста с одним адресом.
+    """
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    return [(family, socket.SOCK_STREAM, 6, "", (address, 443))]
+
+
+class FakeWebhookServer:
+    """
+    HTTP-сервер в потоке теста, принимающий вебхуки. Запросы на пути,
+    начинающиеся с /fail, получают ответ 500.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.connections = set()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                server.requests.append((self.path, json.loads(body)))
+                server.connections.add(self.client_address)
+                self.send_response(500 if self.path.startswith("/fail") else 200)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@override_settings(
+    NOTIFICATION_BATCH_SIZE=2, TELEGRAM_BOT_TOKEN="123:abc", WEBHOOK_ALLOW_LOCAL=True
+)
+class NotificationChannelTests(APITestCase):
+    def setUp(self):
+        TASK_REGISTRY.clear()
+        self.webhooks = FakeWebhookServer()
+        self.addCleanup(self.webhooks.close)
+        self.now = timezone.now()
+        self.users = {}
+        for name, channels in (
+            ("tg", ["telegram"]),
+            ("mail", ["email"]),
+            ("hook", ["webhook"]),
+            ("all", ["telegram", "email", "webhook"]),
+            ("none", []),
+        ):
+            user = User.objects.create_user(
+                username=name, password="12345", email=f"{name}@example.com"
+            )
+            UserProfile.objects.filter(user=user).update(
+                telegram_chat_id=f"chat-{name}",
+                webhook_url=f"{self.webhooks.url}/{name}",
+                notification_channels=channels,
+            )
+            Habit.objects.create(
+                user=user, place="Home", time=self.now.time(), action=name, duration=5
+            )
+            self.users[name] = user
+
+    def run_tick(self):
+        with (
+            patch("django.utils.timezone.now", return_value=self.now),
+            patch("habits.tasks.send_notifications.delay") as delay,
+        ):
+            send_habit_reminders()
+        return delay
+
+    def test_tick_routes_reminders_by_channel_preferences(self):
+        delay = self.run_tick()
+        self.assertCountEqual(
+            [(channel, address) for channel, address, _ in queued_messages(delay)],
+            [
+                ("telegram", "chat-tg"),
+                ("telegram", "chat-all"),
+                ("email", "mail@example.com"),
+                ("email", "all@example.com"),
+                ("webhook", f"{self.webhooks.url}/hook"),
+                ("webhook", f"{self.webhooks.url}/all"),
+            ],
+        )
+        # Одна задача на пачку сообщений канала
+        self.assertEqual(
+            sorted(call.args[0] for call in delay.call_args_list),
+            ["email", "telegram", "webhook"],
+        )
+        self.assertEqual(telemetry.TICK_QUEUED.value(), 6)
+
+    @override_settings(NOTIFICATION_BATCH_SIZE=1)
+    def test_large_channel_batches_are_split(self):
+        delay = self.run_tick()
+        self.assertEqual(len(delay.call_args_list), 6)
+
+    def test_email_batch_uses_one_connection(self):
+        messages = [
+            [f"user{number}@example.com", "Напоминание", {}] for number in range(3)
+        ]
+        with patch("django.core.mail.get_connection", wraps=mail.get_connection) as get:
+            delivered = tasks.send_notifications("email", messages)
+        self.assertEqual(delivered, 3)
+        get.assert_called_once()
+        self.assertEqual(
+            [message.to for message in mail.outbox],
+            [[address] for address, _, _ in messages],
+        )
+
+    @override_settings(NOTIFICATION_CONCURRENCY=1)
+    def test_webhook_batch_reuses_connection_and_reports_failures(self):
+        messages = [
+            [f"{self.webhooks.url}/{path}", "Напоминание", {"habit": number}]
+            for number, path in enumerate(["a", "fail", "b"])
+        ]
+        delivered = tasks.send_notifications.apply(
+            ("webhook", messages), headers={"scheduled_at": time.time() - 5}
+        ).get()
+        self.assertEqual(delivered, 2)
+        self.assertEqual(
+            [body for _, body in self.webhooks.requests],
+            [
+                {"event": "reminder", "text": "Напоминание", "habit": number}
+                for number in range(3)
+            ],
+        )
+        self.assertEqual(len(self.webhooks.connections), 1)
+        self.assertEqual(telemetry.REMINDERS_SENT.value(), 2)
+        self.assertEqual(telemetry.REMINDER_FAILURES.value(reason="HTTPStatusError"), 1)
+        self.assertEqual(telemetry.DELIVERY_LATENCY.count(), 2)
+
+    @patch("telegram.Bot.send_message")
+    def test_telegram_batch_shares_one_bot(self, mock_send_message):
+        async def send_message(chat_id, text):
+            if chat_id == "blocked":
+                raise telegram.error.Forbidden("blocked")
+
+        mock_send_message.side_effect = send_message
+        with (
+            patch("telegram.request.HTTPXRequest", wraps=HTTPXRequest) as request,
+            patch.object(
+                HTTPXRequest,
+                "shutdown",
+                autospec=True,
+                side_effect=HTTPXRequest.shutdown,
+            ) as shutdown,
+        ):
+            delivered = tasks.send_notifications(
+                "telegram", [["1", "a", {}], ["blocked", "b", {}], ["2", "c", {}]]
+            )
+        self.assertEqual(delivered, 2)
+        # Вся пачка отправляется через один пул соединений, а оба пула бота
+        # (отправки и getUpdates) закрываются
+        self.assertEqual(request.call_count, 2)
+        self.assertEqual(len({call.args[0] for call in shutdown.call_args_list}), 2)
+        self.assertEqual(mock_send_message.call_count, 3)
+        self.assertEqual(telemetry.REMINDER_FAILURES.value(reason="Forbidden"), 1)
+
+    def test_end_to_end_delivery(self):
+        with (
+            patch("django.utils.timezone.now", return_value=self.now),
+            patch.object(
+                tasks.send_notifications, "delay", side_effect=tasks.send_notifications
+            ),
+            patch("telegram.Bot.send_message") as send_message,
+        ):
+            send_habit_reminders()
+        self.assertCountEqual(
+            [call.kwargs["chat_id"] for call in send_message.call_args_list],
+            ["chat-tg", "chat-all"],
+        )
+        self.assertCountEqual(
+            [message.to[0] for message in mail.outbox],
+            ["mail@example.com", "all@example.com"],
+        )
+        self.assertCountEqual(
+            [path for path, _ in self.webhooks.requests], ["/hook", "/all"]
+        )
+        self.assertEqual(
+            self.webhooks.requests[0][1]["text"],
+            f"Напоминание: Время для привычки '{self.webhooks.requests[0][0][1:]}'",
+        )
+
+    def test_notification_settings_api(self):
+        user = self.users["tg"]
+        self.client.force_authenticate(user=user)
+        url = reverse("notification-settings")
+        response = self.client.get(url)
+        self.assertEqual(response.data["notification_channels"], ["telegram"])
+
+        response = self.client.patch(
+            url, {"notification_channels": ["sms"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        UserProfile.objects.filter(user=user).update(webhook_url=None)
+        response = self.client.patch(
+            url, {"notification_channels": ["webhook"]}, format="json"
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn("webhook_url", response.data)
+
+        with patch("socket.getaddrinfo", return_value=resolved("93.184.215.14")):
+            response = self.client.patch(
+                url,
+                {
+                    "notification_channels": ["email", "webhook", "email"],
+                    "webhook_url": "https://example.com/hook",
+                },
+                format="json",
+            )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        profile = UserProfile.objects.get(user=user)
+        self.assertEqual(profile.notification_channels, ["email", "webhook"])
+        self.assertEqual(profile.webhook_url, "https://example.com/hook")
+
+    @override_settings(WEBHOOK_ALLOW_LOCAL=False)
+    def test_webhook_url_must_be_public_https(self):
+        self.client.force_authenticate(user=self.users["hook"])
+        url = reverse("notification-settings")
+        for webhook_url, address in (
+            ("http://example.com/hook", "93.184.215.14"),
+            ("https://127.0.0.1/hook", "127.0.0.1"),
+            ("https://169.254.169.254/latest/meta-data", "169.254.169.254"),
+            ("https://internal.example.com/hook", "10.0.0.5"),
+            ("https://mapped.example.com/hook", "::ffff:192.168.0.1"),
+        ):
+            with (
+                self.subTest(webhook_url=webhook_url),
+                patch("socket.getaddrinfo", return_value=resolved(address)),
+            ):
+                response = self.client.patch(
+                    url, {"webhook_url": webhook_url}, format="json"
+                )
+                self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn("webhook_url", response.data)
+
+    @override_settings(WEBHOOK_ALLOW_LOCAL=False)
+    def test_webhook_address_is_checked_before_sending(self):
+        # Хост мог начать разрешаться во внутренний адрес после сохранения
+        delivered = tasks.send_notifications(
+            "webhook",
+            [[self.webhooks.url.replace("http:", "https:"), "Напоминание", {}]],
+        )
+        self.assertEqual(delivered, 0)
+        self.assertEqual(self.webhooks.requests, [])
+        self.assertEqual(
+            telemetry.REMINDER_FAILURES.value(reason="UnsafeWebhookURL"), 1
+        )
+
+    @override_settings(WEBHOOK_ALLOW_LOCAL=False)
+    def test_webhook_connects_to_checked_address(self):
+        connected = []
+
+        async def connect_tcp(backend, host, port, **options):
+            connected.append((host, port))
+            raise OSError("unreachable")
+
+        loop_getaddrinfo = MagicMock(return_value=resolved("93.184.215.14"))
+
+        async def getaddrinfo(self, *args, **kwargs):
+            return loop_getaddrinfo(*args, **kwargs)
+
+        with (
+            patch("asyncio.base_events.BaseEventLoop.getaddrinfo", getaddrinfo),
+            patch("httpcore.AnyIOBackend.connect_tcp", connect_tcp),
+        ):
+            delivered = tasks.send_notifications(
+                "webhook", [["https://hooks.example.com/a", "Напоминание", {}]]
+            )
+        self.assertEqual(delivered, 0)
+        # Имя разрешается один раз, и подключение идет к проверенному адресу,
+        # а не к результату нового запроса DNS
+        loop_getaddrinfo.assert_called_once()
+        self.assertEqual(connected, [("93.184.215.14", 443)])
+
+    def test_new_profiles_default_to_telegram(self):
+        user = User.objects.create_user(username="new", password="12345")
+        self.assertEqual(user.profile.notification_channels, ["telegram"])
+
+
+class FakeBotAPI:
+    """
+    Локальный Bot API: отдает поставленные сообщения через getUpdates с
+    учетом offset и записывает отправленные ботом сообщения.
+    """
+
+    def __init__(self):
+        self.updates = []
+        self.sent = []
+        self.offsets = []
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+                params = {key: values[0] for key, values in parse_qs(body).items()}
+                method = self.path.rsplit("/", 1)[-1]
+                result = getattr(api, method)(params)
+                payload = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/bot"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def add_message(self, chat_id, text):
+        update_id = 1000 + len(self.updates)
+        self.updates.append(
+            {
+                "update_id": update_id,
+                "message": {
+                    "message_id": update_id,
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": text,
+                },
+            }
+        )
+        return update_id
+
+    def getUpdates(self, params):
+        offset = int(params.get("offset", 0))
+        self.offsets.append(offset)
+        limit = int(params.get("limit", 100))
+        # Как и Telegram, обновления до offset считаются подтвержденными
+        return [update for update in self.updates if update["update_id"] >= offset][
+            :limit
+        ]
+
+    def sendMessage(self, params):
+        self.sent.append((int(params["chat_id"]), params["text"]))
+        return {
+            "message_id": len(self.sent),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "text": params["text"],
+        }
+
+    def replies(self, chat_id):
+        return [text for chat, text in self.sent if chat == chat_id]
+
+
+@override_settings(TELEGRAM_BOT_TOKEN="123:abc")
+class TelegramBotTests(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.api = FakeBotAPI()
+        self.addCleanup(self.api.close)
+        override = override_settings(TELEGRAM_API_URL=self.api.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.user = User.objects.create_user(username="anna", password="12345")
+        self.habit = Habit.objects.create(
+            user=self.user, place="Home", time="08:30", action="Read", duration=5
+        )
+
+    def poll(self):
+        call_command(
+            "telegram_updates", "--once", "--timeout", "0", stdout=io.StringIO()
+        )
+
+    def link_token(self, user):
+        self.client.force_authenticate(user=user)
+        response = self.client.post(reverse("telegram-link"))
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data["token"]
+
+    def link(self, user, chat_id):
+        self.api.add_message(chat_id, f"/start {self.link_token(user)}")
+        self.poll()
+
+    def test_link_token_links_chat_once(self):
+        token = self.link_token(self.user)
+        self.api.add_message(77, f"/start {token}")
+        self.api.add_message(88, f"/start {token}")
+        self.poll()
+        self.assertEqual(UserProfile.objects.get(user=self.user).telegram_chat_id, "77")
+        self.assertIn("Чат привязан", self.api.replies(77)[0])
+        self.assertIn("недействительна", self.api.replies(88)[0])
+
+    @override_settings(TELEGRAM_BOT_USERNAME="habits_bot")
+    def test_link_url(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.post(reverse("telegram-link"))
+        self.assertEqual(
+            response.data["url"],
+            f"https://t.me/habits_bot?start={response.data['token']}",
+        )
+
+    def test_commands_in_one_batch(self):
+        other = User.objects.create_user(username="boris", password="12345")
+        foreign = Habit.objects.create(
+            user=other, place="Park", time="09:00", action="Run", duration=5
+        )
+        self.api.add_message(77, f"/start {self.link_token(self.user)}")
+        self.api.add_message(77, f"/done {self.habit.pk}")
+        self.api.add_message(77, f"/done@habits_bot {self.habit.pk}")
+        self.api.add_message(77, f"/done {foreign.pk}")
+        self.api.add_message(77, "/habits")
+        self.api.add_message(99, "/habits")
+        self.api.add_message(99, "привет")
+        self.poll()
+
+        replies = self.api.replies(77)
+        self.assertEqual(len(replies), 5)
+        self.assertEqual(
+            replies[1], "Выполнение привычки «Read» отмечено. Текущая серия: 1."
+        )
+        self.assertIn("уже отмечена", replies[2])
+        self.assertEqual(replies[3], f"Привычка {foreign.pk} не найдена.")
+        self.assertEqual(replies[4], f"{self.habit.pk}. Read в 08:30")
+        self.assertEqual(self.api.replies(99), [bot.NOT_LINKED_TEXT, bot.HELP_TEXT])
+        self.assertEqual(HabitCompletion.objects.filter(habit=self.habit).count(), 1)
+        self.assertFalse(HabitCompletion.objects.filter(habit=foreign).exists())
+
+    def test_offset_is_committed_and_updates_are_not_reprocessed(self):
+        self.link(self.user, 77)
+        last = self.api.add_message(77, f"/done {self.habit.pk}")
+        self.poll()
+        self.assertEqual(bot.current_offset(), last + 1)
+        self.poll()
+        self.assertEqual(self.api.offsets[-1], last + 1)
+        self.assertEqual(len(self.api.replies(77)), 2)
+
+        # Повторная выдача уже обработанных обновлений ничего не меняет
+        updates = [telegram.Update.de_json(update, None) for update in self.api.updates]
+        self.assertEqual(bot.process_updates(updates), [])
+        self.assertEqual(HabitCompletion.objects.count(), 1)
+
+    def test_failed_batch_is_rolled_back_with_offset(self):
+        token = self.link_token(self.user)
+        self.api.add_message(77, f"/start {token}")
+        self.api.add_message(77, f"/done {self.habit.pk}")
+        with (
+            patch.object(Habit, "complete", side_effect=OperationalError("down")),
+            self.assertRaises(OperationalError),
+        ):
+            self.poll()
+        self.assertEqual(bot.current_offset(), 0)
+        self.assertIsNone(UserProfile.objects.get(user=self.user).telegram_chat_id)
+        self.assertEqual(self.api.sent, [])
+
+        self.poll()
+        self.assertEqual(UserProfile.objects.get(user=self.user).telegram_chat_id, "77")
+        self.assertEqual(HabitCompletion.objects.filter(habit=self.habit).count(), 1)
+
+    def test_done_rejects_invalid_habit_ids(self):
+        self.link(self.user, 77)
+        for argument in ("²", "٣", "0", str(2**63), "9" * 5000):
+            self.api.add_message(77, f"/done {argument}")
+        last = self.api.add_message(77, f"/done {self.habit.pk}")
+        self.poll()
+        replies = self.api.replies(77)[1:]
+        self.assertEqual(replies[:5], ["Укажите номер привычки: /done <id>."] * 5)
+        self.assertIn("отмечено", replies[5])
+        self.assertEqual(bot.current_offset(), last + 1)
+
+    def test_failing_update_is_skipped(self):
+        self.link(self.user, 77)
+        parse_command = bot.parse_command
+
+        def parse(text):
+            if text == "boom":
+                raise ValueError("boom")
+            return parse_command(text)
+
+        self.api.add_message(77, "/habits")
+        self.api.add_message(77, "boom")
+        last = self.api.add_message(77, f"/done {self.habit.pk}")
+        with (
+            patch("habits.bot.parse_command", side_effect=parse),
+            self.assertLogs("habits.bot", "ERROR"),
+        ):
+            self.poll()
+        self.assertEqual(bot.current_offset(), last + 1)
+        replies = self.api.replies(77)
+        self.assertEqual(replies[1], f"{self.habit.pk}. Read в 08:30")
+        self.assertIn("отмечено", replies[2])
+        self.assertEqual(HabitCompletion.objects.filter(habit=self.habit).count(), 1)
+
+    def test_relinking_chat_and_stop(self):
+        other = User.objects.create_user(username="boris", password="12345")
+        self.link(self.user, 77)
+        self.link(other, 77)
+        self.assertIsNone(UserProfile.objects.get(user=self.user).telegram_chat_id)
+        self.assertEqual(UserProfile.objects.get(user=other).telegram_chat_id, "77")
+
+        self.api.add_message(77, "/stop")
+        self.api.add_message(77, "/habits")
+        self.poll()
+        self.assertIsNone(UserProfile.objects.get(user=other).telegram_chat_id)
+        self.assertEqual(self.api.replies(77)[-1], bot.NOT_LINKED_TEXT)
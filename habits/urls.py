@@ -1,8 +1,19 @@
-from django.urls import include, path
+from django.urls import include, path, re_path
 from rest_framework.routers import DefaultRouter
 
 from .auth import RegisterView
-from .views import HabitViewSet, PublicHabitListView, set_telegram_chat_id
+from .profiling import profile_report
+from .views import (
+    HabitViewSet,
+    NotificationSettingsView,
+    PopularHabitListView,
+    PublicHabitListView,
+    event_stream,
+    event_stream_ticket,
+    export_all_habits,
+    set_telegram_chat_id,
+    telegram_link,
+)
 
 router = DefaultRouter()
 router.register(r"habits", HabitViewSet, basename="habit")
@@ -10,6 +21,21 @@ router.register(r"habits", HabitViewSet, basename="habit")
 urlpatterns = [
     path("", include(router.urls)),
     path("public-habits/", PublicHabitListView.as_view(), name="public-habits"),
+    path("popular-habits/", PopularHabitListView.as_view(), name="popular-habits"),
     path("register/", RegisterView.as_view(), name="register"),
+    path("events/", event_stream, name="event-stream"),
+    path("events/ticket/", event_stream_ticket, name="event-stream-ticket"),
     path("set-telegram-chat-id/", set_telegram_chat_id, name="set-telegram-chat-id"),
+    path("telegram-link/", telegram_link, name="telegram-link"),
+    path(
+        "notification-settings/",
+        NotificationSettingsView.as_view(),
+        name="notification-settings",
+    ),
+    re_path(
+        r"^admin/habits/export/(?P<file_format>csv|ndjson)/$",
+        export_all_habits,
+        name="admin-habits-export",
+    ),
+    path("profiles/<uuid:profile_id>/", profile_report, name="profile-report"),
 ]
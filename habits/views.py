@@ -1,11 +1,50 @@
+from operator import attrgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.views.decorators.http import require_GET
 from drf_spectacular.utils import OpenApiParameter, extend_schema
 from rest_framework import generics, permissions, status, viewsets
-from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import APIException, AuthenticationFailed
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.views import APIView
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
 
+from . import push
+from .bot import make_link_token
+from .exports import export_response
+from .idempotency import idempotent
 from .models import Habit, UserProfile
-from .serializers import HabitSerializer
+from .popularity import get_popular_habits
+from .recommendations import recommend
+from .schedule import get_schedule, iter_schedule_json
+from .search import search_habits, search_order_key
+from .sharding import (
+    ScatteredQuery,
+    activate_shard,
+    deactivate_shard,
+    is_sharded,
+    iter_in_shard,
+    placement,
+    sharded,
+    use_shard,
+)
+from .serializers import (
+    HabitCompletionSerializer,
+    HabitRecommendationsSerializer,
+    HabitSerializer,
+    NotificationSettingsSerializer,
+    PopularHabitSerializer,
+    ScheduleOccurrenceSerializer,
+    ScheduleQuerySerializer,
+)
 
 
 class IsOwnerOrReadOnly(permissions.BasePermission):
@@ -25,16 +64,48 @@ class IsOwnerOrReadOnly(permissions.BasePermission):
         return obj.user == request.user
 
 
+class UserDataMoving(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Данные пользователя переносятся, повторите запрос позже."
+    default_code = "user_data_moving"
+
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(
+    name="Idempotency-Key",
+    location=OpenApiParameter.HEADER,
+    description=(
+        "Ключ для безопасного повтора запроса: повтор с тем же ключом "
+        "возвращает сохраненный ответ без повторного выполнения"
+    ),
+    required=False,
+    type=str,
+)
+
+
+def user_shard(request):
+    """
+    Возвращает шард данных текущего пользователя. Запросы на изменение
+    во время переноса данных пользователя отклоняются.
+    """
+    shard, moving = placement(request.user.pk)
+    if moving and request.method not in permissions.SAFE_METHODS:
+        raise UserDataMoving()
+    return shard
+
+
 @extend_schema(
     description="Установка Telegram chat ID для пользователя",
     request={"application/json": {"chat_id": "string"}},
     responses={
         200: {"description": "Telegram chat ID успешно установлен"},
         400: {"description": "Отсутствует chat_id в запросе"},
+        409: {"description": "Idempotency-Key уже использован для другого запроса"},
     },
+    parameters=[IDEMPOTENCY_KEY_PARAMETER],
 )
 @api_view(["POST"])
 @permission_classes([IsAuthenticated])
+@idempotent
 def set_telegram_chat_id(request):
     """
     Устанавливает Telegram chat ID для текущего пользователя.
@@ -43,9 +114,10 @@ def set_telegram_chat_id(request):
     """
     chat_id = request.data.get("chat_id")
     if chat_id:
-        profile, created = UserProfile.objects.get_or_create(user=request.user)
-        profile.telegram_chat_id = chat_id
-        profile.save()
+        with use_shard(user_shard(request)):
+            profile, created = UserProfile.objects.get_or_create(user=request.user)
+            profile.telegram_chat_id = chat_id
+            profile.save()
         return Response(
             {"status": "telegram chat ID установлен"}, status=status.HTTP_200_OK
         )
@@ -55,10 +127,78 @@ def set_telegram_chat_id(request):
     )
 
 
+@extend_schema(
+    description=(
+        "Создает одноразовую ссылку для привязки чата Telegram: пользователь "
+        "открывает ее и отправляет боту команду /start с токеном"
+    ),
+    request=None,
+    responses={
+        201: {
+            "type": "object",
+            "properties": {
+                "token": {"type": "string"},
+                "url": {"type": "string", "nullable": True},
+                "expires_in": {"type": "integer"},
+            },
+        }
+    },
+)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def telegram_link(request):
+    """
+    Выдает токен привязки чата Telegram к текущему пользователю.
+    """
+    token = make_link_token(request.user.pk)
+    username = settings.TELEGRAM_BOT_USERNAME
+    return Response(
+        {
+            "token": token,
+            "url": f"https://t.me/{username}?start={token}" if username else None,
+            "expires_in": settings.TELEGRAM_LINK_TTL,
+        },
+        status=status.HTTP_201_CREATED,
+    )
+
+
+class NotificationSettingsView(generics.RetrieveUpdateAPIView):
+    """
+    API endpoint для выбора каналов уведомлений текущего пользователя.
+    """
+
+    serializer_class = NotificationSettingsSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self):
+        # Сохранение идет в шард, из которого загружен профиль
+        with use_shard(user_shard(self.request)):
+            profile, _ = UserProfile.objects.get_or_create(user=self.request.user)
+        return profile
+
+
 class HabitViewSet(viewsets.ModelViewSet):
     serializer_class = HabitSerializer
     permission_classes = [permissions.IsAuthenticated, IsOwnerOrReadOnly]
 
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        # Все запросы к привычкам пользователя идут в его шард
+        self._shard = user_shard(request)
+        self._shard_token = activate_shard(self._shard)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, "_shard_token", None)
+        if token is not None:
+            deactivate_shard(token)
+            self._shard_token = None
+            if response.streaming:
+                # Тело потокового ответа читается после выхода из обработчика
+                response.streaming_content = iter_in_shard(
+                    self._shard, response.streaming_content
+                )
+        return super().finalize_response(request, response, *args, **kwargs)
+
     def get_queryset(self):
         return Habit.objects.filter(user=self.request.user).order_by("id")
 
@@ -89,8 +229,14 @@ class HabitViewSet(viewsets.ModelViewSet):
 
     @extend_schema(
         summary="Создание привычки",
-        description="Создает новую привычку для текущего пользователя.",
+        description=(
+            "Создает новую привычку для текущего пользователя. Повтор запроса "
+            "с тем же Idempotency-Key возвращает ранее созданную привычку, "
+            "повтор ключа с другими данными - ошибку 409."
+        ),
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
     )
+    @idempotent
     def create(self, request, *args, **kwargs):
         """
         Создает новую привычку для текущего пользователя.
@@ -136,6 +282,142 @@ class HabitViewSet(viewsets.ModelViewSet):
         """
         return super().destroy(request, *args, **kwargs)
 
+    @extend_schema(
+        summary="Отметка о выполнении привычки",
+        description=(
+            "Отмечает выполнение привычки за указанную дату (по умолчанию "
+            "за сегодня) и возвращает обновленные счетчики серий."
+        ),
+        request=HabitCompletionSerializer,
+        responses={201: HabitSerializer, 200: HabitSerializer},
+    )
+    @action(detail=True, methods=["post"])
+    def complete(self, request, pk=None):
+        """
+        Отмечает выполнение привычки. Повторная отметка за ту же дату
+        ничего не меняет.
+        """
+        habit = self.get_object()
+        serializer = HabitCompletionSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        date = serializer.validated_data.get("date") or timezone.localdate()
+        _, created = habit.complete(date)
+        return Response(
+            HabitSerializer(habit).data,
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK,
+        )
+
+    @extend_schema(
+        summary="Журнал выполнения привычки",
+        description="Возвращает отметки о выполнении привычки, начиная с последних.",
+        responses=HabitCompletionSerializer(many=True),
+    )
+    @action(detail=True, methods=["get"])
+    def completions(self, request, pk=None):
+        """
+        Возвращает журнал выполнения привычки. Поддерживает пагинацию.
+        """
+        habit = self.get_object()
+        queryset = habit.completions.order_by("-date")
+        page = self.paginate_queryset(queryset)
+        serializer = HabitCompletionSerializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @extend_schema(
+        summary="Выгрузка привычек",
+        description=(
+            "Потоково выгружает все привычки текущего пользователя в CSV "
+            "или NDJSON без пагинации."
+        ),
+        responses={(200, "text/csv"): str, (200, "application/x-ndjson"): str},
+    )
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path=r"export/(?P<file_format>csv|ndjson)",
+        url_name="export",
+    )
+    def export(self, request, file_format=None):
+        """
+        Выгружает все привычки текущего пользователя.
+        """
+        return export_response([self.get_queryset()], file_format, "habits")
+
+    @extend_schema(
+        summary="Рекомендации для новой привычки",
+        description=(
+            "Возвращает публичные привычки, похожие на указанные действие "
+            "и место, и приятные публичные привычки, которые можно указать "
+            "как связанную привычку."
+        ),
+        parameters=[
+            OpenApiParameter(name="action", description="Действие", type=str),
+            OpenApiParameter(name="place", description="Место", type=str),
+            OpenApiParameter(
+                name="limit",
+                description="Количество привычек в каждом списке (до 50)",
+                required=False,
+                type=int,
+            ),
+        ],
+        responses=HabitRecommendationsSerializer,
+    )
+    @action(detail=False, methods=["get"])
+    def recommendations(self, request):
+        """
+        Подбирает похожие публичные привычки по индексу рекомендаций.
+        """
+        action_text = request.query_params.get("action", "").strip()
+        place = request.query_params.get("place", "").strip()
+        if not action_text and not place:
+            return Response(
+                {"error": "Пожалуйста, укажите action или place"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        try:
+            limit = int(
+                request.query_params.get("limit", settings.RECOMMENDATIONS_LIMIT)
+            )
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= 50:
+            return Response(
+                {"error": "limit должен быть числом от 1 до 50"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        similar, related = recommend(action_text, place, limit)
+        serializer = HabitRecommendationsSerializer(
+            {"similar": similar, "related": related}
+        )
+        return Response(serializer.data)
+
+    @extend_schema(
+        summary="Расписание привычек",
+        description=(
+            "Возвращает выполнения привычек текущего пользователя за days дней "
+            "начиная с start (по умолчанию с сегодняшнего дня), упорядоченные "
+            "по дате и времени. Диапазоны длиннее SCHEDULE_STREAM_DAYS дней "
+            "отдаются потоком."
+        ),
+        parameters=[ScheduleQuerySerializer],
+        responses=ScheduleOccurrenceSerializer(many=True),
+    )
+    @action(detail=False, methods=["get"])
+    def schedule(self, request):
+        """
+        Возвращает расписание выполнения привычек на диапазон дат.
+        """
+        query = ScheduleQuerySerializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        start = query.validated_data.get("start") or timezone.localdate()
+        days = query.validated_data["days"]
+        if days > settings.SCHEDULE_STREAM_DAYS:
+            return StreamingHttpResponse(
+                iter_schedule_json(request.user, start, days),
+                content_type="application/json",
+            )
+        return Response(get_schedule(request.user, start, days))
+
 
 class PublicHabitListView(generics.ListAPIView):
     """
@@ -144,12 +426,35 @@ class PublicHabitListView(generics.ListAPIView):
     Не требует аутентификации.
     """
 
-    queryset = Habit.objects.filter(is_public=True)
     serializer_class = HabitSerializer
     permission_classes = [permissions.AllowAny]
 
+    def get_queryset(self):
+        query = self.request.query_params.get("search", "").strip()
+
+        def public(manager):
+            queryset = manager.filter(is_public=True)
+            if query:
+                return search_habits(queryset, query)
+            return queryset.order_by("id")
+
+        if not is_sharded():
+            return public(Habit.objects)
+        # Публичные привычки пользователей всех шардов сливаются в одну выдачу
+        return ScatteredQuery(
+            lambda alias: public(sharded(Habit, alias)),
+            key=search_order_key if query else attrgetter("pk"),
+        )
+
     @extend_schema(
         parameters=[
+            OpenApiParameter(
+                name="search",
+                description="Поиск по действию и месту, результаты сортируются "
+                "по релевантности",
+                required=False,
+                type=str,
+            ),
             OpenApiParameter(
                 name="page", description="Номер страницы", required=False, type=int
             ),
@@ -165,6 +470,129 @@ class PublicHabitListView(generics.ListAPIView):
         """
         Возвращает список публичных привычек.
 
-        Поддерживает пагинацию.
+        Поддерживает поиск и пагинацию.
         """
         return super().get(request, *args, **kwargs)
+
+
+class PopularHabitListView(APIView):
+    """
+    API endpoint для рейтинга популярных публичных привычек.
+
+    Рейтинг заранее рассчитывается периодической задачей, поэтому запрос
+    читает готовый список из кэша. Не требует аутентификации.
+    """
+
+    permission_classes = [permissions.AllowAny]
+
+    @extend_schema(responses=PopularHabitSerializer(many=True))
+    def get(self, request, *args, **kwargs):
+        """
+        Возвращает популярные публичные привычки, начиная с самых популярных.
+        """
+        return Response(get_popular_habits())
+
+
+@extend_schema(
+    description="Потоковая выгрузка привычек всех пользователей в CSV или NDJSON",
+    responses={(200, "text/csv"): str, (200, "application/x-ndjson"): str},
+)
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def export_all_habits(request, file_format):
+    """
+    Выгружает привычки всех пользователей со всех шардов по очереди.
+    Доступно только администраторам.
+    """
+    return export_response(
+        [sharded(Habit, alias) for alias in settings.HABIT_SHARDS],
+        file_format,
+        "all-habits",
+    )
+
+
+@extend_schema(
+    description=(
+        "Выдает одноразовый билет для подключения к потоку событий: "
+        "GET /api/events/?ticket=<билет>"
+    ),
+    request=None,
+    responses={
+        201: {
+            "type": "object",
+            "properties": {
+                "ticket": {"type": "string"},
+                "expires_in": {"type": "integer"},
+            },
+        }
+    },
+)
+@api_view(["POST"])
+@permission_classes([IsAuthenticated])
+def event_stream_ticket(request):
+    """
+    Выдает билет для подключения текущего пользователя к потоку событий.
+    """
+    return Response(
+        {
+            "ticket": push.make_ticket(request.user.pk),
+            "expires_in": settings.SSE_TICKET_TTL,
+        },
+        status=status.HTTP_201_CREATED,
+    )
+
+
+def _stream_user(request):
+    if request.user.is_authenticated:
+        return request.user
+    # EventSource в браузере не передает заголовки, поэтому вместо токена
+    # доступа он передает одноразовый билет
+    ticket = request.GET.get("ticket")
+    if ticket:
+        user_id = push.consume_ticket(ticket)
+        if user_id is None:
+            return None
+        return User.objects.filter(pk=user_id, is_active=True).first()
+    authentication = JWTAuthentication()
+    header = authentication.get_header(request)
+    raw_token = authentication.get_raw_token(header) if header else None
+    if raw_token is None:
+        return None
+    try:
+        return authentication.get_user(authentication.get_validated_token(raw_token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+@require_GET
+async def event_stream(request):
+    """
+    Поток событий пользователя в формате Server-Sent Events: напоминания
+    (reminder) и изменения его привычек (habit). После переподключения с
+    заголовком Last-Event-ID отдаются пропущенные события.
+
+    Ожидающее соединение не занимает поток и не обращается к БД, поэтому
+    эндпоинт обслуживается только ASGI-сервером: под WSGI каждое соединение
+    заняло бы рабочий поток на все время подключения.
+    """
+    if not isinstance(request, ASGIRequest):
+        return JsonResponse(
+            {"detail": "Поток событий доступен только через ASGI-сервер."},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return JsonResponse(
+            {"detail": "Учетные данные не были предоставлены."},
+            status=status.HTTP_401_UNAUTHORIZED,
+        )
+    last_event_id = request.headers.get("Last-Event-ID") or request.GET.get(
+        "lastEventId"
+    )
+    response = StreamingHttpResponse(
+        push.stream(user.pk, last_event_id), content_type="text/event-stream"
+    )
+    response["Cache-Control"] = "no-cache"
+    # Отключает буферизацию ответа в nginx
+    response["X-Accel-Buffering"] = "no"
+    return response